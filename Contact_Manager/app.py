@@ -1,24 +1,93 @@
+import base64
+import codecs
+import csv
+import json
+import re
 import sqlite3
-from flask import Flask, render_template, request, redirect, url_for, flash, g
+import sys
+from datetime import datetime, timezone
+import click
+from flask import (Blueprint, Flask, Response, abort, current_app, flash, g, jsonify, make_response, redirect,
+                   render_template, request, session, stream_with_context, url_for)
 
-app = Flask(__name__)
-app.secret_key = 'your_secret_key'
-DATABASE = 'contacts.db'
+import cache
+import db as database
+import transfer
 
+# Routes and commands of the application, registered on each app made by create_app
+bp = Blueprint('contacts', __name__, cli_group=None)
 
-# Database connection management
+# Contacts shown per page unless ?per_page= asks otherwise, and the most a page may show
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Most search results shown, best matches first
+SEARCH_LIMIT = 50
+
+# Weights of the name, phone and email columns when search results are ranked
+SEARCH_WEIGHTS = (10.0, 5.0, 2.0)
+
+# Fields of a contact in the JSON API, ?fields= picks some of them
+API_FIELDS = ('id', 'name', 'phone', 'email', 'version', 'updated_at')
+
+# Most contacts one bulk update may change
+MAX_BULK_UPDATE = 1000
+
+# Current time in seconds since the epoch, as an SQL expression for the triggers
+SQL_NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+
+
+# Application factory, for gunicorn and waitress (see wsgi.py), the flask command and tests
+# Settings come from the defaults below, then CONTACTS_* environment variables (CONTACTS_DATABASE,
+# CONTACTS_POOL_SIZE, ...), then the config mapping
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.from_mapping(
+        SECRET_KEY='your_secret_key',
+        DATABASE='contacts.db',
+        POOL_SIZE=database.POOL_SIZE,
+        CACHE_ENTRIES=cache.CACHE_ENTRIES,
+        CACHE_URL=None,
+    )
+    app.config.from_prefixed_env('CONTACTS')
+    if config:
+        app.config.update(config)
+
+    # Warm connections reused by every request of this process
+    pool = database.ConnectionPool(app.config['DATABASE'], app.config['POOL_SIZE'])
+    app.extensions['contact_pool'] = pool
+    # Rendered pages and query results, keyed by the data version so a write makes every older entry unreachable
+    # CACHE_URL (redis://host:port/db) adds a cache shared by all workers behind each worker's LRU cache
+    shared = cache.connect_shared(app.config['CACHE_URL']) if app.config['CACHE_URL'] else None
+    app.extensions['contact_cache'] = cache.Cache(app.config['CACHE_ENTRIES'], shared)
+
+    app.register_blueprint(bp)
+    app.teardown_appcontext(close_db)
+
+    # The schema is created or migrated once, when the application is made, not on a request
+    # No connection is kept afterwards, so servers that fork workers after loading the app (gunicorn
+    # preload_app) never share one between processes
+    with app.app_context():
+        init_db()
+    pool.close()
+    return app
+
+
+# Database connection management: each request borrows a pooled connection and returns it when it ends
 def get_db():
     if 'db' not in g:
-        g.db = sqlite3.connect(DATABASE)
-        g.db.row_factory = sqlite3.Row
+        g.db = current_app.extensions['contact_pool'].acquire()
     return g.db
 
 
-@app.teardown_appcontext
 def close_db(error):
     db = g.pop('db', None)
     if db is not None:
-        db.close()
+        current_app.extensions['contact_pool'].release(db)
+
+
+def get_cache():
+    return current_app.extensions['contact_cache']
 
 
 # Initialize the database
@@ -29,22 +98,244 @@ def init_db():
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
             phone TEXT,
-            email TEXT
+            email TEXT,
+            version INTEGER NOT NULL DEFAULT 1,
+            updated_at REAL,
+            phone_search TEXT
+        )
+    ''')
+    # The listing is ordered by name, then id, and pages seek into this index instead of skipping rows
+    db.execute('CREATE INDEX IF NOT EXISTS contacts_name_id ON contacts (name, id)')
+    # The total shown with the listing, and the change counter and time of the last write behind the API's
+    # ETag and Last-Modified, are kept up to date by triggers instead of worked out on every request
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS contact_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total INTEGER NOT NULL,
+            changes INTEGER NOT NULL DEFAULT 0,
+            modified_at REAL,
+            search_index_paused INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    migrate_db(db)
+    db.execute(f'INSERT OR IGNORE INTO contact_stats (id, total, modified_at) '
+               f'SELECT 1, COUNT(*), {SQL_NOW} FROM contacts')
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS contacts_stats_insert AFTER INSERT ON contacts BEGIN
+            UPDATE contact_stats SET total = total + 1, changes = changes + 1, modified_at = {SQL_NOW} WHERE id = 1;
+        END
+    ''')
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS contacts_stats_update AFTER UPDATE OF name, phone, email ON contacts BEGIN
+            UPDATE contact_stats SET changes = changes + 1, modified_at = {SQL_NOW} WHERE id = 1;
+        END
+    ''')
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS contacts_stats_delete AFTER DELETE ON contacts BEGIN
+            UPDATE contact_stats SET total = total - 1, changes = changes + 1, modified_at = {SQL_NOW} WHERE id = 1;
+        END
+    ''')
+    # Every contact carries a version, raised by each change, and the time of that change
+    # Bulk imports set updated_at themselves and skip the extra UPDATE per row
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS contacts_version_insert AFTER INSERT ON contacts
+        WHEN new.updated_at IS NULL BEGIN
+            UPDATE contacts SET updated_at = {SQL_NOW} WHERE id = new.id;
+        END
+    ''')
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS contacts_version_update AFTER UPDATE OF name, phone, email ON contacts BEGIN
+            UPDATE contacts SET version = old.version + 1, updated_at = {SQL_NOW} WHERE id = new.id;
+        END
+    ''')
+
+    # Full-text index over name, phone and email, kept in step with the contacts by triggers
+    # Phone numbers are indexed as digits only (see db.phone_tokens), names and emails by their words
+    # The triggers are plain SQL, so any sqlite3 client may write contacts.db: the app stores the phone tokens
+    # in phone_search, a row written without them is indexed by its phone as typed until the app saves it again
+    new_index = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'contacts_fts'").fetchone() is None
+    db.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS contacts_fts USING fts5(
+            name, phone, email,
+            tokenize = 'unicode61 remove_diacritics 2',
+            prefix = '2 3'
         )
     ''')
+    if new_index:
+        transfer.index_contacts(db)
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS contacts_fts_insert AFTER INSERT ON contacts
+        WHEN (SELECT search_index_paused FROM contact_stats WHERE id = 1) = 0 BEGIN
+            INSERT INTO contacts_fts (rowid, name, phone, email)
+            VALUES (new.id, new.name, COALESCE(new.phone_search, new.phone), new.email);
+        END
+    ''')
+    # A phone changed without its tokens (by another client) is indexed as typed instead of by stale tokens
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS contacts_fts_update AFTER UPDATE OF name, phone, email, phone_search ON contacts
+        BEGIN
+            UPDATE contacts_fts SET name = new.name, email = new.email,
+                phone = CASE WHEN new.phone IS NOT old.phone AND new.phone_search IS old.phone_search
+                             THEN new.phone ELSE COALESCE(new.phone_search, new.phone) END
+            WHERE rowid = old.id;
+        END
+    ''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS contacts_fts_delete AFTER DELETE ON contacts BEGIN
+            DELETE FROM contacts_fts WHERE rowid = old.id;
+        END
+    ''')
     db.commit()
 
 
-# Index route to list all contacts
-@app.route('/')
+# Function to bring a database created by an earlier version of the app up to the current schema
+def migrate_db(db):
+    columns = {row[1] for row in db.execute('PRAGMA table_info(contacts)')}
+    if 'version' not in columns:
+        db.execute('ALTER TABLE contacts ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+    if 'updated_at' not in columns:
+        db.execute('ALTER TABLE contacts ADD COLUMN updated_at REAL')
+        db.execute(f'UPDATE contacts SET updated_at = {SQL_NOW}')
+    # The search triggers used to call SQL functions only the app's connections had, see init_db
+    for name in ('contacts_fts_insert', 'contacts_fts_update'):
+        trigger = db.execute('SELECT sql FROM sqlite_master WHERE name = ?', (name,)).fetchone()
+        if trigger is not None and 'phone_tokens(' in trigger[0]:
+            db.execute(f'DROP TRIGGER {name}')
+    if 'phone_search' not in columns:
+        db.execute('ALTER TABLE contacts ADD COLUMN phone_search TEXT')
+        db.executemany('UPDATE contacts SET phone_search = ? WHERE id = ?',
+                       [(database.phone_tokens(phone), contact_id)
+                        for contact_id, phone in db.execute('SELECT id, phone FROM contacts WHERE phone IS NOT NULL')])
+    columns = {row[1] for row in db.execute('PRAGMA table_info(contact_stats)')}
+    if 'changes' not in columns:
+        db.execute('ALTER TABLE contact_stats ADD COLUMN changes INTEGER NOT NULL DEFAULT 0')
+    if 'modified_at' not in columns:
+        db.execute('ALTER TABLE contact_stats ADD COLUMN modified_at REAL')
+        db.execute(f'UPDATE contact_stats SET modified_at = {SQL_NOW}')
+    if 'search_index_paused' not in columns:
+        db.execute('ALTER TABLE contact_stats ADD COLUMN search_index_paused INTEGER NOT NULL DEFAULT 0')
+    # The counting triggers were replaced by the contacts_stats_* ones
+    db.execute('DROP TRIGGER IF EXISTS contacts_count_insert')
+    db.execute('DROP TRIGGER IF EXISTS contacts_count_delete')
+    # The search index is only updated when a field it indexes changes, not when the version is raised
+    trigger = db.execute("SELECT sql FROM sqlite_master WHERE name = 'contacts_fts_update'").fetchone()
+    if trigger is not None and 'UPDATE OF' not in trigger[0]:
+        db.execute('DROP TRIGGER contacts_fts_update')
+
+
+# Function to turn the position of a contact in the listing into an opaque cursor for the page links
+def encode_cursor(contact):
+    raw = json.dumps([contact['name'], contact['id']]).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+# Function to read a cursor back as (name, id), None if it is missing or invalid
+def decode_cursor(cursor):
+    if not cursor:
+        return None
+    try:
+        name, contact_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(name, str) or not isinstance(contact_id, int):
+        return None
+    return name, contact_id
+
+
+# Function to build an FTS5 query from what was typed in the search box, every word matching as a prefix
+# A query of digits and phone punctuation only is looked up as (part of) a phone number
+def search_query(text):
+    if re.fullmatch(r'[\d\s()+\-./]+', text):
+        digits = re.sub(r'\D', '', text)
+        if digits:
+            return f'phone : "{digits}"*'
+    words = ('"{}"*'.format(word.replace('"', '""')) for word in text.split())
+    return ' '.join(words)
+
+
+# Function to read the data version: the change counter that every insert, update and delete of a contact
+# raises in the same transaction (see the contacts_stats_* triggers), whichever process or route made it
+# It is read before the data it versions, so an entry may hold newer data than its key but never older
+def data_version(db):
+    return db.execute('SELECT changes FROM contact_stats WHERE id = 1').fetchone()[0]
+
+
+def cache_key(*parts):
+    return json.dumps(parts, separators=(',', ':'))
+
+
+# Function to read the page size from the query string
+def read_page_size():
+    per_page = request.args.get('per_page', PAGE_SIZE, type=int)
+    return min(max(per_page, 1), MAX_PAGE_SIZE)
+
+
+# Index route to list the contacts one page at a time
+# ?after= and ?before= hold the cursor of the last or first contact of the neighbouring page, so every page
+# is a seek into the (name, id) index whatever its position in the listing
+@bp.route('/')
 def index():
     db = get_db()
-    contacts = db.execute('SELECT * FROM contacts').fetchall()
-    return render_template('index.html', contacts=contacts)
+    # Flashed messages are part of the page, a page showing them is rendered for this request only
+    if '_flashes' in session:
+        return render_index(db)
+    key = cache_key('index', data_version(db), read_page_size(), request.args.get('after'),
+                    request.args.get('before'))
+    return get_cache().get_or_set(key, lambda: render_index(db))
+
+
+def render_index(db):
+    per_page = read_page_size()
+    after = decode_cursor(request.args.get('after'))
+    before = decode_cursor(request.args.get('before'))
+
+    if before is not None:
+        rows = db.execute('SELECT id, name, phone, email FROM contacts WHERE (name, id) < (?, ?) '
+                          'ORDER BY name DESC, id DESC LIMIT ?', (*before, per_page + 1)).fetchall()
+        contacts = rows[:per_page][::-1]
+        has_previous, has_next = len(rows) > per_page, True
+    elif after is not None:
+        rows = db.execute('SELECT id, name, phone, email FROM contacts WHERE (name, id) > (?, ?) '
+                          'ORDER BY name, id LIMIT ?', (*after, per_page + 1)).fetchall()
+        contacts = rows[:per_page]
+        has_previous, has_next = True, len(rows) > per_page
+    else:
+        rows = db.execute('SELECT id, name, phone, email FROM contacts ORDER BY name, id LIMIT ?',
+                          (per_page + 1,)).fetchall()
+        contacts = rows[:per_page]
+        has_previous, has_next = False, len(rows) > per_page
+
+    total = db.execute('SELECT total FROM contact_stats WHERE id = 1').fetchone()[0]
+    return render_template('index.html', contacts=contacts, total=total, per_page=per_page,
+                           previous_cursor=encode_cursor(contacts[0]) if has_previous and contacts else None,
+                           next_cursor=encode_cursor(contacts[-1]) if has_next and contacts else None)
+
+
+# Search route: contacts whose name, phone or email match every word typed, the best matches first
+@bp.route('/search')
+def search():
+    query = request.args.get('q', '').strip()
+    contacts = []
+    if query:
+        try:
+            db = get_db()
+            contacts = get_cache().get_or_set(cache_key('search', data_version(db), query),
+                                              lambda: find_contacts(db, query))
+        except sqlite3.Error as e:
+            flash(f'An error occurred: {e}', 'error')
+    return render_template('search.html', contacts=contacts, query=query, limit=SEARCH_LIMIT)
+
+
+def find_contacts(db, query):
+    rows = db.execute('SELECT contacts.id, contacts.name, contacts.phone, contacts.email '
+                      'FROM contacts_fts JOIN contacts ON contacts.id = contacts_fts.rowid '
+                      'WHERE contacts_fts MATCH ? ORDER BY bm25(contacts_fts, ?, ?, ?) LIMIT ?',
+                      (search_query(query), *SEARCH_WEIGHTS, SEARCH_LIMIT))
+    return [dict(row) for row in rows]
 
 
 # Add contact route
-@app.route('/add', methods=('GET', 'POST'))
+@bp.route('/add', methods=('GET', 'POST'))
 def add_contact():
     if request.method == 'POST':
         name = request.form['name']
@@ -57,18 +348,18 @@ def add_contact():
 
         try:
             db = get_db()
-            db.execute('INSERT INTO contacts (name, phone, email) VALUES (?, ?, ?)',
-                       (name, phone, email))
+            db.execute('INSERT INTO contacts (name, phone, email, phone_search) VALUES (?, ?, ?, ?)',
+                       (name, phone, email, database.phone_tokens(phone)))
             db.commit()
             flash('Contact successfully added!', 'success')
-            return redirect(url_for('index'))
+            return redirect(url_for('.index'))
         except sqlite3.Error as e:
             flash(f'An error occurred: {e}', 'error')
     return render_template('add_contact.html')
 
 
 # Edit contact route
-@app.route('/edit/<int:id>', methods=('GET', 'POST'))
+@bp.route('/edit/<int:id>', methods=('GET', 'POST'))
 def edit_contact(id):
     db = get_db()
     contact = db.execute('SELECT * FROM contacts WHERE id = ?', (id,)).fetchone()
@@ -83,11 +374,11 @@ def edit_contact(id):
             return render_template('edit_contact.html', contact=contact)
 
         try:
-            db.execute('UPDATE contacts SET name = ?, phone = ?, email = ? WHERE id = ?',
-                       (name, phone, email, id))
+            db.execute('UPDATE contacts SET name = ?, phone = ?, email = ?, phone_search = ? WHERE id = ?',
+                       (name, phone, email, database.phone_tokens(phone), id))
             db.commit()
             flash('Contact successfully updated!', 'success')
-            return redirect(url_for('index'))
+            return redirect(url_for('.index'))
         except sqlite3.Error as e:
             flash(f'An error occurred: {e}', 'error')
 
@@ -95,7 +386,7 @@ def edit_contact(id):
 
 
 # Delete contact route
-@app.route('/delete/<int:id>', methods=('POST',))
+@bp.route('/delete/<int:id>', methods=('POST',))
 def delete_contact(id):
     try:
         db = get_db()
@@ -104,11 +395,249 @@ def delete_contact(id):
         flash('Contact successfully deleted!', 'success')
     except sqlite3.Error as e:
         flash(f'An error occurred: {e}', 'error')
-    return redirect(url_for('index'))
+    return redirect(url_for('.index'))
+
+
+# Import route: add the contacts of an uploaded CSV or vCard file in one transaction
+@bp.route('/import', methods=('GET', 'POST'))
+def import_contacts():
+    report = None
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if upload is None or not upload.filename:
+            flash('Choose a file to import!', 'error')
+            return render_template('import.html', formats=transfer.FORMATS)
+
+        fmt = request.form.get('format') or transfer.guess_format(upload.filename)
+        # The upload is a SpooledTemporaryFile, which lacks the io methods TextIOWrapper needs before Python 3.11
+        stream = codecs.getreader('utf-8-sig')(upload.stream)
+        try:
+            report = transfer.import_contacts(get_db(), transfer.read_contacts(stream, fmt))
+            flash(f'{report.imported} contacts imported, {report.rejected} rejected', 'success')
+        except (ValueError, csv.Error, sqlite3.Error) as e:
+            flash(f'Nothing was imported: {e}', 'error')
+    return render_template('import.html', formats=transfer.FORMATS, report=report)
+
+
+# Export route: all contacts as a CSV (or ?format=vcard) download, streamed a batch of rows at a time
+@bp.route('/export')
+def export_contacts():
+    if request.args.get('format') == 'vcard':
+        chunks, mimetype, filename = transfer.export_vcard(get_db()), 'text/vcard', 'contacts.vcf'
+    else:
+        chunks, mimetype, filename = transfer.export_csv(get_db()), 'text/csv', 'contacts.csv'
+    # stream_with_context keeps the pooled connection of the request until the last chunk is sent
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+
+# Function to end an API request with a JSON error
+def api_abort(status, message):
+    abort(make_response(jsonify(error=message), status))
 
 
-# Initialize the database when the app starts
+# Function to read the fields a client asked for with ?fields=name,email, all of them by default
+def read_fields():
+    fields = request.args.get('fields')
+    if not fields:
+        return API_FIELDS
+    fields = tuple(field.strip() for field in fields.split(',') if field.strip())
+    unknown = [field for field in fields if field not in API_FIELDS]
+    if unknown or not fields:
+        api_abort(400, f"Unknown fields: {', '.join(unknown)}; choose from {', '.join(API_FIELDS)}")
+    return fields
+
+
+def http_time(timestamp):
+    return datetime.fromtimestamp(timestamp or 0, timezone.utc).replace(microsecond=0)
+
+
+# Function to turn a contact row into JSON with only the requested fields
+def contact_json(contact, fields):
+    data = {field: contact[field] for field in fields}
+    if 'updated_at' in data:
+        data['updated_at'] = datetime.fromtimestamp(contact['updated_at'] or 0, timezone.utc).isoformat()
+    return data
+
+
+def contact_etag(contact):
+    return f"contact-{contact['id']}-{contact['version']}"
+
+
+# Function to answer a conditional GET before the response is built
+# Returns a 304 when the client's copy (If-None-Match, or If-Modified-Since without it) is current, else None
+def not_modified(etag, modified):
+    if request.if_none_match:
+        current = request.if_none_match.contains(etag)
+    elif request.if_modified_since:
+        current = modified <= request.if_modified_since
+    else:
+        return None
+    return with_validators(Response(status=304), etag, modified) if current else None
+
+
+# Function to add the ETag and Last-Modified headers, clients must check them again before reusing a copy
+def with_validators(response, etag, modified):
+    response.set_etag(etag)
+    response.last_modified = modified
+    response.cache_control.no_cache = True
+    return response
+
+
+# Function to read a JSON contact sent by a client, returns (name, phone, email) or ends the request
+def read_contact(data, current=None):
+    if not isinstance(data, dict):
+        api_abort(400, "Expected a JSON object")
+    fields = {}
+    for field in ('name', 'phone', 'email'):
+        value = data.get(field, current[field] if current is not None else None)
+        if value is not None and not isinstance(value, str):
+            api_abort(400, f"The {field} must be a string")
+        fields[field] = value
+    try:
+        return transfer.validate(fields)
+    except ValueError as e:
+        api_abort(400, str(e))
+
+
+# API list route: contacts ordered by name, ?per_page= at a time, ?after= is the "next" cursor of the previous page
+# The ETag is the table's change counter, so a poll of an unchanged table is answered without a query
+@bp.route('/api/contacts')
+def api_list_contacts():
+    db = get_db()
+    fields = read_fields()
+    per_page = read_page_size()
+    stats = db.execute('SELECT total, changes, modified_at FROM contact_stats WHERE id = 1').fetchone()
+    etag, modified = f"contacts-{stats['changes']}", http_time(stats['modified_at'])
+    response = not_modified(etag, modified)
+    if response is not None:
+        return response
+
+    after = decode_cursor(request.args.get('after'))
+    if after is not None:
+        rows = db.execute('SELECT * FROM contacts WHERE (name, id) > (?, ?) ORDER BY name, id LIMIT ?',
+                          (*after, per_page + 1)).fetchall()
+    else:
+        rows = db.execute('SELECT * FROM contacts ORDER BY name, id LIMIT ?', (per_page + 1,)).fetchall()
+    contacts = rows[:per_page]
+    return with_validators(jsonify(
+        contacts=[contact_json(contact, fields) for contact in contacts],
+        total=stats['total'],
+        next=encode_cursor(contacts[-1]) if len(rows) > per_page else None,
+    ), etag, modified)
+
+
+# API route for one contact, its ETag is its version
+@bp.route('/api/contacts/<int:id>')
+def api_get_contact(id):
+    fields = read_fields()
+    contact = get_db().execute('SELECT * FROM contacts WHERE id = ?', (id,)).fetchone()
+    if contact is None:
+        api_abort(404, f"No contact with id {id}")
+    etag, modified = contact_etag(contact), http_time(contact['updated_at'])
+    response = not_modified(etag, modified)
+    if response is not None:
+        return response
+    return with_validators(jsonify(contact_json(contact, fields)), etag, modified)
+
+
+# API create route: a JSON object with a name and optionally a phone and an email
+@bp.route('/api/contacts', methods=('POST',))
+def api_create_contact():
+    fields = read_fields()
+    name, phone, email = read_contact(request.get_json(silent=True))
+    db = get_db()
+    cursor = db.execute('INSERT INTO contacts (name, phone, email, phone_search) VALUES (?, ?, ?, ?)',
+                        (name, phone, email, database.phone_tokens(phone)))
+    db.commit()
+    contact = db.execute('SELECT * FROM contacts WHERE id = ?', (cursor.lastrowid,)).fetchone()
+    response = with_validators(jsonify(contact_json(contact, fields)), contact_etag(contact),
+                               http_time(contact['updated_at']))
+    response.status_code = 201
+    response.headers['Location'] = url_for('.api_get_contact', id=contact['id'])
+    return response
+
+
+# API bulk update route: a JSON list of objects with an id and the fields to change, all applied or none
+# An object may carry the version it was read at, a contact changed since then fails the update with 409
+@bp.route('/api/contacts', methods=('PATCH',))
+def api_update_contacts():
+    fields = read_fields()
+    changes = request.get_json(silent=True)
+    if not isinstance(changes, list) or not changes:
+        api_abort(400, "Expected a JSON list of contacts to update")
+    if len(changes) > MAX_BULK_UPDATE:
+        api_abort(400, f"At most {MAX_BULK_UPDATE} contacts can be updated at once")
+
+    # A request ended by api_abort leaves its transaction open, the pool rolls it back
+    db = get_db()
+    updated = {}
+    for change in changes:
+        contact_id = change.get('id') if isinstance(change, dict) else None
+        if not isinstance(contact_id, int):
+            api_abort(400, "Every contact to update needs an integer id")
+        current = db.execute('SELECT * FROM contacts WHERE id = ?', (contact_id,)).fetchone()
+        if current is None:
+            api_abort(404, f"No contact with id {contact_id}")
+        if 'version' in change and change['version'] != current['version']:
+            api_abort(409, f"Contact {contact_id} was changed since version {change['version']}, "
+                           f"it is at version {current['version']}")
+        name, phone, email = read_contact(change, current)
+        db.execute('UPDATE contacts SET name = ?, phone = ?, email = ?, phone_search = ? WHERE id = ?',
+                   (name, phone, email, database.phone_tokens(phone), contact_id))
+        # Read back in the same transaction, so the response shows exactly what this request committed
+        updated[contact_id] = db.execute('SELECT * FROM contacts WHERE id = ?', (contact_id,)).fetchone()
+    db.commit()
+    return jsonify(contacts=[contact_json(contact, fields) for contact in updated.values()])
+
+
+# API delete route
+@bp.route('/api/contacts/<int:id>', methods=('DELETE',))
+def api_delete_contact(id):
+    db = get_db()
+    if db.execute('DELETE FROM contacts WHERE id = ?', (id,)).rowcount == 0:
+        api_abort(404, f"No contact with id {id}")
+    db.commit()
+    return '', 204
+
+
+# Command to import a CSV or vCard file: flask --app app import-contacts contacts.csv
+@bp.cli.command('import-contacts')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(transfer.FORMATS), default=None,
+              help='Format of the file, guessed from its extension by default.')
+@click.option('--batch-size', type=int, default=transfer.IMPORT_BATCH, show_default=True,
+              help='Rows inserted per executemany call.')
+def import_command(path, fmt, batch_size):
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        try:
+            report = transfer.import_contacts(get_db(), transfer.read_contacts(f, fmt or transfer.guess_format(path)),
+                                              batch_size)
+        except (ValueError, csv.Error, sqlite3.Error) as e:
+            raise click.ClickException(f'Nothing was imported: {e}')
+    for line, message in report.errors:
+        click.echo(f'{path}:{line}: {message}', err=True)
+    if report.rejected > len(report.errors):
+        click.echo(f'... and {report.rejected - len(report.errors)} more rejected rows', err=True)
+    click.echo(f'{report.imported} contacts imported, {report.rejected} rejected')
+
+
+# Command to export the contacts to a file or stdout: flask --app app export-contacts contacts.csv
+@bp.cli.command('export-contacts')
+@click.argument('path', type=click.Path(dir_okay=False, allow_dash=True), default='-')
+@click.option('--format', 'fmt', type=click.Choice(transfer.FORMATS), default=None,
+              help='Format of the file, guessed from its extension by default.')
+def export_command(path, fmt):
+    fmt = fmt or transfer.guess_format(path)
+    chunks = transfer.export_vcard(get_db()) if fmt == 'vcard' else transfer.export_csv(get_db())
+    if path == '-':
+        sys.stdout.writelines(chunks)
+        return
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.writelines(chunks)
+
+
+# Development server only, production runs wsgi.py under gunicorn or waitress
+# flask --app app run --debug turns the debugger and the reloader on
 if __name__ == '__main__':
-    with app.app_context():
-        init_db()
-    app.run(debug=True)
+    create_app().run()
@@ -0,0 +1,115 @@
+import json
+import threading
+from collections import OrderedDict
+
+# redis is optional, without it only the in-process cache is used
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# Entries kept by the in-process cache of each worker, 0 turns it off
+CACHE_ENTRIES = 1024
+
+# Seconds an entry lives in the shared cache; keys carry the data version, so entries of older versions are
+# never read again and only wait there to expire
+SHARED_TTL = 3600
+
+# Errors of the shared cache that make a lookup a miss instead of failing the request
+SHARED_ERRORS = (OSError,) + ((redis.RedisError,) if redis is not None else ())
+
+MISSING = object()
+
+
+# Least recently used entries are dropped first once the cache holds max_entries
+class LRUCache:
+    def __init__(self, max_entries=CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key, MISSING)
+            if value is not MISSING:
+                self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# Cache shared by every worker through a client with the redis get(key) / set(key, value, ex=seconds) calls,
+# a redis.Redis or any local stand-in offering the same two methods; values are stored as JSON
+class SharedCache:
+    def __init__(self, client, prefix='contacts', ttl=SHARED_TTL):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    def get(self, key):
+        try:
+            raw = self.client.get(f'{self.prefix}:{key}')
+        except SHARED_ERRORS:
+            return MISSING
+        return MISSING if raw is None else json.loads(raw)
+
+    def set(self, key, value):
+        try:
+            self.client.set(f'{self.prefix}:{key}', json.dumps(value), ex=self.ttl)
+        except SHARED_ERRORS:
+            pass
+
+
+# Function to connect to the shared cache named by a redis:// URL
+def connect_shared(url):
+    if redis is None:
+        raise RuntimeError(f"A shared cache at {url} needs the redis package (pip install redis)")
+    return SharedCache(redis.Redis.from_url(url))
+
+
+# In-process LRU cache in front of an optional shared one
+# Values must be JSON-serializable when a shared cache is used, and are never modified once cached
+class Cache:
+    def __init__(self, max_entries=CACHE_ENTRIES, shared=None):
+        self.local = LRUCache(max_entries)
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is MISSING and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not MISSING:
+                self.local.set(key, value)
+        # The request threads of a worker share the cache, the counters are updated under the LRU lock
+        with self.local.lock:
+            if value is MISSING:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+    # Return the cached value of key, computing and storing it on a miss
+    def get_or_set(self, key, compute):
+        value = self.get(key)
+        if value is MISSING:
+            value = compute()
+            self.set(key, value)
+        return value
@@ -0,0 +1,119 @@
+import os
+import queue
+import sqlite3
+import threading
+
+# Connections kept open per process, and seconds a request waits for one when all are busy
+POOL_SIZE = 8
+POOL_TIMEOUT = 30.0
+
+# Seconds a connection waits for a lock held by another writer before giving up
+BUSY_TIMEOUT = 5.0
+
+# Prepared statements kept per connection, every query of the app is a constant string so it is parsed once
+CACHED_STATEMENTS = 256
+
+# Page cache per connection in KiB, and how much of the database file is memory-mapped
+CACHE_SIZE_KIB = 64 * 1024
+MMAP_SIZE = 256 * 1024 * 1024
+
+# Shortest tail of a phone number that gets its own search token
+MIN_PHONE_TOKEN = 3
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    pass
+
+
+# Connection opened by a pool, it remembers the process of that pool (see ConnectionPool.release)
+class Connection(sqlite3.Connection):
+    pool_pid = None
+
+
+# Function to turn a phone number into the tokens the search index stores for it: its digits, then every
+# shorter tail of them, so a prefix query finds any part of the number ("0123" finds "+1 (555) 012-3456")
+# The app stores them in contacts.phone_search with every write, the search triggers only copy that column
+def phone_tokens(phone):
+    digits = ''.join(ch for ch in phone or '' if '0' <= ch <= '9')
+    return ' '.join(digits[i:] for i in range(max(len(digits) - MIN_PHONE_TOKEN + 1, 1)))
+
+
+# Function to open a connection tuned for many short requests
+# WAL lets readers go on while a write is committed, NORMAL only syncs at checkpoints, which WAL keeps safe
+def connect(database):
+    db = sqlite3.connect(database, timeout=BUSY_TIMEOUT, check_same_thread=False,
+                         cached_statements=CACHED_STATEMENTS, factory=Connection)
+    db.row_factory = sqlite3.Row
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = NORMAL')
+    db.execute(f'PRAGMA cache_size = -{CACHE_SIZE_KIB}')
+    db.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    db.execute('PRAGMA temp_store = MEMORY')
+    return db
+
+
+# Warm connections shared by the threads of one process
+# A connection is used by one request at a time, so it can move between threads; after a fork the child
+# starts a pool of its own instead of sharing the parent's connections
+class ConnectionPool:
+    def __init__(self, database, size=POOL_SIZE, timeout=POOL_TIMEOUT):
+        self.database = database
+        self.size = size
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # The most recently returned connection is handed out first, its cache is the warmest
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.pid = os.getpid()
+
+    def acquire(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                self._reset()
+            idle = self.idle
+            create = idle.empty() and self.opened < self.size
+            if create:
+                self.opened += 1
+        if create:
+            try:
+                db = connect(self.database)
+            except sqlite3.Error:
+                with self.lock:
+                    self.opened -= 1
+                raise
+            db.pool_pid = self.pid
+            return db
+        try:
+            return idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise PoolTimeout(f"No database connection became free within {self.timeout:.0f} s")
+
+    # Give a connection back, a transaction left open by a failed request is rolled back first
+    # A connection the child inherited from its parent is never taken into the child's pool
+    def release(self, db):
+        if self.pid != os.getpid() or db.pool_pid != self.pid:
+            return
+        try:
+            if db.in_transaction:
+                db.rollback()
+        except sqlite3.Error:
+            # A broken connection is replaced by a fresh one on a later acquire
+            db.close()
+            with self.lock:
+                self.opened -= 1
+            return
+        self.idle.put(db)
+
+    # Close the idle connections, for example when the application shuts down
+    def close(self):
+        while True:
+            try:
+                db = self.idle.get_nowait()
+            except queue.Empty:
+                return
+            db.close()
+            with self.lock:
+                self.opened -= 1
@@ -0,0 +1,33 @@
+import multiprocessing
+import os
+
+# gunicorn -c gunicorn.conf.py
+# Every setting can be overridden on the command line or through the CONTACTS_* variables read below
+
+wsgi_app = 'wsgi:app'
+bind = os.environ.get('CONTACTS_BIND', '127.0.0.1:8000')
+
+# One worker per core: requests spend most of their time in SQLite and template rendering, which hold the GIL,
+# so more processes scale reads; SQLite lets one writer in at a time whatever the number of workers
+workers = int(os.environ.get('CONTACTS_WORKERS', multiprocessing.cpu_count()))
+
+# Threads cover the time a request waits on disk, on a lock or on a slow client; each worker's connection
+# pool is as large as its thread count, so a thread never waits for a connection
+worker_class = 'gthread'
+threads = int(os.environ.get('CONTACTS_THREADS', 8))
+os.environ.setdefault('CONTACTS_POOL_SIZE', str(threads))
+
+# The app is loaded, and its schema set up, once in the master before the workers are forked
+preload_app = True
+
+# Keep-alive lets a client (or a proxy in front) reuse its connection for the next request
+keepalive = 5
+timeout = 30
+graceful_timeout = 30
+
+# Workers are replaced now and then, at staggered times, to bound the growth of their caches
+max_requests = 10000
+max_requests_jitter = 1000
+
+accesslog = os.environ.get('CONTACTS_ACCESS_LOG')
+errorlog = '-'
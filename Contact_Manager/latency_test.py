@@ -0,0 +1,296 @@
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import urlencode, urlsplit
+
+from load_test import seed_database
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Share of each operation in the mix, and the status a successful request answers with
+OPERATIONS = {
+    'list': (70, 200),
+    'add': (10, 302),
+    'edit': (10, 302),
+    'delete': (10, 302),
+}
+
+SERVERS = ('gunicorn', 'waitress', 'flask')
+
+# Seconds the server gets to start answering
+STARTUP_TIMEOUT = 30.0
+
+
+# One keep-alive HTTP/1.1 connection, reopened when the server closes it
+class Connection:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, form=None):
+        body = urlencode(form).encode('utf-8') if form is not None else b''
+        head = f"{method} {path} HTTP/1.1\r\nHost: {self.host}:{self.port}\r\nContent-Length: {len(body)}\r\n"
+        if form is not None:
+            head += "Content-Type: application/x-www-form-urlencoded\r\n"
+        reused = self.writer is not None
+        if not reused:
+            self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            self.writer.write(head.encode('ascii') + b"\r\n" + body)
+            await self.writer.drain()
+            return await self.read_response()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            self.close()
+            # A kept-alive connection the server had already closed, the request never reached it
+            if reused:
+                return await self.request(method, path, form)
+            raise
+
+    async def read_response(self):
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionResetError("The server closed the connection")
+        version, status = status_line.split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = version == b'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        if 'content-length' in headers:
+            body = await self.reader.readexactly(int(headers['content-length']))
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            body = await self.read_chunks()
+        else:
+            body = await self.reader.read()
+            keep_alive = False
+        if not keep_alive:
+            self.close()
+        return int(status), body
+
+    async def read_chunks(self):
+        parts = []
+        while True:
+            size = int((await self.reader.readline()).split(b';', 1)[0], 16)
+            if size == 0:
+                while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(parts)
+            parts.append(await self.reader.readexactly(size))
+            await self.reader.readexactly(2)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+# Latencies in seconds and error count of every operation
+class Results:
+    def __init__(self):
+        self.latencies = {operation: [] for operation in OPERATIONS}
+        self.errors = {operation: 0 for operation in OPERATIONS}
+
+
+# Function to read the ids of the contacts through the JSON API
+async def fetch_ids(host, port, limit):
+    connection = Connection(host, port)
+    ids, cursor = [], None
+    try:
+        while len(ids) < limit:
+            query = {'fields': 'id', 'per_page': 500, **({'after': cursor} if cursor else {})}
+            status, body = await connection.request('GET', f"/api/contacts?{urlencode(query)}")
+            if status != 200:
+                raise RuntimeError(f"GET /api/contacts answered {status}")
+            page = json.loads(body)
+            ids.extend(contact['id'] for contact in page['contacts'])
+            cursor = page['next']
+            if cursor is None:
+                break
+    finally:
+        connection.close()
+    return ids[:limit]
+
+
+# Function to run the mix of operations from one client until the deadline
+# Edits go to the first half of the contacts, deletes take theirs from the second half, each id once
+async def client(index, host, port, deadline, edit_ids, delete_ids, results):
+    rng = random.Random(index)
+    connection = Connection(host, port)
+    names = list(OPERATIONS)
+    weights = [weight for weight, _ in OPERATIONS.values()]
+    count = 0
+    try:
+        while time.perf_counter() < deadline:
+            operation = rng.choices(names, weights)[0]
+            count += 1
+            if operation == 'list':
+                request = ('GET', '/', None)
+            elif operation == 'add':
+                request = ('POST', '/add', {'name': f"Load {index}-{count}", 'phone': f"+1 555 {count:07d}",
+                                            'email': f"load{index}.{count}@example.com"})
+            elif operation == 'edit' and edit_ids:
+                request = ('POST', f"/edit/{rng.choice(edit_ids)}",
+                           {'name': f"Edited {index}-{count}", 'phone': '', 'email': ''})
+            elif operation == 'delete' and delete_ids:
+                request = ('POST', f"/delete/{delete_ids.pop()}", None)
+            else:
+                continue
+
+            started = time.perf_counter()
+            try:
+                status, _ = await connection.request(*request)
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                connection.close()
+                results.errors[operation] += 1
+                continue
+            results.latencies[operation].append(time.perf_counter() - started)
+            if status != OPERATIONS[operation][1]:
+                results.errors[operation] += 1
+    finally:
+        connection.close()
+
+
+# Function to run the clients for a while, returns the Results and the seconds they ran
+async def hammer(host, port, clients, duration, edit_ids, delete_ids):
+    results = Results()
+    deadline = time.perf_counter() + duration
+    started = time.perf_counter()
+    await asyncio.gather(*(client(i, host, port, deadline, edit_ids, delete_ids, results) for i in range(clients)))
+    return results, time.perf_counter() - started
+
+
+async def measure(host, port, args):
+    ids = await fetch_ids(host, port, args.contacts)
+    middle = len(ids) // 2
+    edit_ids, delete_ids = ids[:middle], ids[middle:]
+    random.Random(0).shuffle(delete_ids)
+    if args.warmup > 0:
+        await hammer(host, port, args.clients, args.warmup, edit_ids, delete_ids)
+    return await hammer(host, port, args.clients, args.duration, edit_ids, delete_ids)
+
+
+def report(results, elapsed):
+    print(f"{'operation':<10} {'requests':>9} {'errors':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    everything = []
+    for operation, latencies in results.latencies.items():
+        everything.extend(latencies)
+        print_row(operation, latencies, results.errors[operation])
+    print_row('all', everything, sum(results.errors.values()))
+    print(f"{len(everything) / elapsed:.1f} requests/s over {elapsed:.1f} s")
+
+
+def print_row(label, latencies, errors):
+    if len(latencies) < 2:
+        print(f"{label:<10} {len(latencies):>9} {errors:>7}")
+        return
+    cuts = statistics.quantiles(latencies, n=100, method='inclusive')
+    p50, p95, p99 = (cuts[i] * 1000 for i in (49, 94, 98))
+    print(f"{label:<10} {len(latencies):>9} {errors:>7} {p50:>8.2f} {p95:>8.2f} {p99:>8.2f} "
+          f"{max(latencies) * 1000:>8.2f}")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# Function to pick the first installed server, the Flask development server is the fallback
+def default_server():
+    for server in SERVERS[:-1]:
+        if importlib.util.find_spec(server) is not None:
+            return server
+    return 'flask'
+
+
+# Function to start the app on a free port in its own process, returns (process, port)
+def start_server(server, database, args, log):
+    port = free_port()
+    env = dict(os.environ, CONTACTS_DATABASE=database, CONTACTS_POOL_SIZE=str(args.threads))
+    if server == 'gunicorn':
+        env.update(CONTACTS_WORKERS=str(args.workers), CONTACTS_THREADS=str(args.threads))
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f"127.0.0.1:{port}"]
+    elif server == 'waitress':
+        env.update(CONTACTS_PORT=str(port))
+        command = [sys.executable, 'wsgi.py']
+    else:
+        command = [sys.executable, '-m', 'flask', '--app', 'app', 'run', '--port', str(port), '--with-threads']
+    process = subprocess.Popen(command, cwd=APP_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{server} exited with status {process.returncode}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"{server} did not answer within {STARTUP_TIMEOUT:.0f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure p50/p95/p99 latency of listing, adding, editing and "
+                                                 "deleting contacts under concurrent load.")
+    parser.add_argument("--url", default=None,
+                        help="server to test (http://host:port); by default the app is started on a seeded database")
+    parser.add_argument("--server", choices=SERVERS, default=None,
+                        help="server to start the app with, the first installed one by default")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="gunicorn worker processes")
+    parser.add_argument("--threads", type=int, default=8, help="threads (and pooled connections) per worker")
+    parser.add_argument("--contacts", type=int, default=10000, help="contacts in the seeded database")
+    parser.add_argument("--clients", type=int, default=32, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds measured")
+    parser.add_argument("--warmup", type=float, default=2.0, help="seconds run before measuring")
+    parser.add_argument("--workdir", default=None, help="directory for the test database")
+    args = parser.parse_args()
+
+    if args.url:
+        address = urlsplit(args.url)
+        results, elapsed = asyncio.run(measure(address.hostname, address.port or 80, args))
+        report(results, elapsed)
+        return
+
+    server = args.server or default_server()
+    work_dir = tempfile.mkdtemp(prefix="contacts_latency_", dir=args.workdir)
+    try:
+        database = os.path.join(work_dir, "contacts.db")
+        seed_database(database, args.contacts)
+        log_path = os.path.join(work_dir, "server.log")
+        with open(log_path, 'wb') as log:
+            try:
+                process, port = start_server(server, database, args, log)
+            except RuntimeError:
+                with open(log_path, errors='replace') as f:
+                    sys.stderr.write(f.read())
+                raise
+            try:
+                print(f"{server} on 127.0.0.1:{port}, {args.contacts} contacts, {args.clients} clients")
+                results, elapsed = asyncio.run(measure('127.0.0.1', port, args))
+            finally:
+                process.terminate()
+                process.wait()
+        report(results, elapsed)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import argparse
+import http.client
+import logging
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+from app import create_app
+from db import ConnectionPool
+
+
+# Stand-in for how get_db() worked before the pool: a new connection for every request, closed at its end
+class ConnectionPerRequest:
+    def __init__(self, database):
+        self.database = database
+
+    def acquire(self):
+        db = sqlite3.connect(self.database)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def release(self, db):
+        db.close()
+
+    def close(self):
+        pass
+
+
+# Function to create a database with the given number of contacts
+def seed_database(database, count):
+    db = sqlite3.connect(database)
+    db.execute('CREATE TABLE contacts (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, phone TEXT, '
+               'email TEXT)')
+    db.executemany('INSERT INTO contacts (name, phone, email) VALUES (?, ?, ?)',
+                   ((f"Contact {i:06d}", f"+1 555 {i:07d}", f"contact{i}@example.com") for i in range(count)))
+    db.commit()
+    db.close()
+
+
+# Function to send requests from several threads for a while, returns (requests, errors, seconds)
+def hammer(port, paths, threads, duration):
+    deadline = time.perf_counter() + duration
+    counts = [0] * threads
+    errors = [0] * threads
+
+    def client(index):
+        rng = random.Random(index)
+        while time.perf_counter() < deadline:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            try:
+                connection.request('GET', rng.choice(paths))
+                response = connection.getresponse()
+                response.read()
+                if response.status == 200:
+                    counts[index] += 1
+                else:
+                    errors[index] += 1
+            except OSError:
+                errors[index] += 1
+            finally:
+                connection.close()
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=client, args=(i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(counts), sum(errors), time.perf_counter() - started
+
+
+# Function to serve the app with the given connection source and measure it
+# The page cache is off, both variants query the database for every request
+def run(label, database, connections, args):
+    app = create_app({'DATABASE': database, 'CACHE_ENTRIES': 0})
+    app.extensions['contact_pool'] = connections
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        paths = ['/'] + [f"/edit/{random.randint(1, args.contacts)}" for _ in range(50)]
+        hammer(server.server_port, paths, args.threads, min(1.0, args.duration))  # Warm up
+        requests, errors, elapsed = hammer(server.server_port, paths, args.threads, args.duration)
+    finally:
+        server.shutdown()
+        connections.close()
+    print(f"{label:<24} {requests / elapsed:10.1f} requests/s  ({requests} requests, {errors} errors)")
+    return requests / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare requests per second with a connection per request "
+                                                 "and with the connection pool.")
+    parser.add_argument("--contacts", type=int, default=50, help="contacts in the test database")
+    parser.add_argument("--threads", type=int, default=8, help="concurrent clients")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds each variant is measured")
+    parser.add_argument("--workdir", default=None, help="directory for the test database")
+    args = parser.parse_args()
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    work_dir = tempfile.mkdtemp(prefix="contacts_load_", dir=args.workdir)
+    try:
+        database = os.path.join(work_dir, "contacts.db")
+        seed_database(database, args.contacts)
+        before = run("connection per request", database, ConnectionPerRequest(database), args)
+        after = run("connection pool", database, ConnectionPool(database), args)
+        print(f"Speedup: {after / before:.2f}x")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
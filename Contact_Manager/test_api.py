@@ -0,0 +1,135 @@
+import sqlite3
+
+import pytest
+
+pytest.importorskip('flask')
+
+from app import MAX_BULK_UPDATE, create_app  # noqa: E402
+
+
+@pytest.fixture
+def client(tmp_path):
+    app = create_app({'DATABASE': str(tmp_path / 'contacts.db'), 'TESTING': True})
+    return app.test_client()
+
+
+def add(client, name, phone='', email=''):
+    response = client.post('/api/contacts', json={'name': name, 'phone': phone, 'email': email})
+    assert response.status_code == 201
+    return response.get_json()
+
+
+def test_create_and_get(client):
+    contact = add(client, 'Ada Lovelace', '+44 20 7946 0000', 'ada@example.com')
+    assert contact['version'] == 1
+
+    response = client.get(f"/api/contacts/{contact['id']}?fields=name,email")
+    assert response.status_code == 200
+    assert response.get_json() == {'name': 'Ada Lovelace', 'email': 'ada@example.com'}
+    assert response.headers['ETag'] == f'"contact-{contact["id"]}-1"'
+
+
+@pytest.mark.parametrize('body', [None, [], {'phone': '123'}, {'name': 'Bob', 'email': 'not an email'},
+                                  {'name': 5}])
+def test_create_rejects(client, body):
+    response = client.post('/api/contacts', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_unknown_fields(client):
+    assert client.get('/api/contacts?fields=name,secret').status_code == 400
+
+
+def test_missing_contact(client):
+    assert client.get('/api/contacts/999').status_code == 404
+    assert client.delete('/api/contacts/999').status_code == 404
+
+
+# A client whose copy is current gets a 304 until something changes
+def test_conditional_get(client):
+    contact = add(client, 'Ada')
+    response = client.get(f"/api/contacts/{contact['id']}")
+    etag = response.headers['ETag']
+    assert client.get(f"/api/contacts/{contact['id']}", headers={'If-None-Match': etag}).status_code == 304
+
+    listing = client.get('/api/contacts')
+    list_etag = listing.headers['ETag']
+    assert client.get('/api/contacts', headers={'If-None-Match': list_etag}).status_code == 304
+
+    response = client.patch('/api/contacts', json=[{'id': contact['id'], 'phone': '555 0100'}])
+    assert response.status_code == 200
+    assert client.get(f"/api/contacts/{contact['id']}", headers={'If-None-Match': etag}).status_code == 200
+    assert client.get('/api/contacts', headers={'If-None-Match': list_etag}).status_code == 200
+
+
+# An update carrying the version it was read at fails once someone else changed the contact
+def test_update_conflict(client):
+    contact = add(client, 'Ada')
+    first = client.patch('/api/contacts', json=[{'id': contact['id'], 'version': 1, 'name': 'Ada L.'}])
+    assert first.status_code == 200
+    assert first.get_json()['contacts'][0]['version'] == 2
+
+    stale = client.patch('/api/contacts', json=[{'id': contact['id'], 'version': 1, 'name': 'Ada K.'}])
+    assert stale.status_code == 409
+    assert client.get(f"/api/contacts/{contact['id']}").get_json()['name'] == 'Ada L.'
+
+
+# A bulk update is applied completely or not at all
+def test_bulk_update_is_atomic(client):
+    ada, bob = add(client, 'Ada'), add(client, 'Bob')
+    response = client.patch('/api/contacts', json=[{'id': ada['id'], 'name': 'Ada L.'},
+                                                   {'id': bob['id'], 'version': 7, 'name': 'Bob B.'}])
+    assert response.status_code == 409
+    assert client.get(f"/api/contacts/{ada['id']}").get_json()['name'] == 'Ada'
+
+
+# The largest bulk update allowed goes through, more contacts than SQLite's 999 bound parameters in one statement
+def test_largest_bulk_update(client):
+    db = sqlite3.connect(client.application.config['DATABASE'])
+    db.executemany('INSERT INTO contacts (name) VALUES (?)', ((f'Person {i:04d}',) for i in range(MAX_BULK_UPDATE)))
+    db.commit()
+    ids = [row[0] for row in db.execute('SELECT id FROM contacts ORDER BY id')]
+    db.close()
+
+    changes = [{'id': contact_id, 'email': f'p{contact_id}@example.com'} for contact_id in ids]
+    assert client.patch('/api/contacts', json=changes + [{'id': ids[0]}]).status_code == 400
+    response = client.patch('/api/contacts?fields=id,email,version', json=changes)
+    assert response.status_code == 200
+    assert response.get_json()['contacts'] == [dict(change, version=2) for change in changes]
+
+    # A contact listed twice is shown once, in the state the request committed
+    response = client.patch('/api/contacts?fields=id,name,phone,version',
+                            json=[{'id': ids[0], 'name': 'First'}, {'id': ids[0], 'phone': '555 0100'}])
+    assert response.get_json()['contacts'] == [{'id': ids[0], 'name': 'First', 'phone': '555 0100', 'version': 4}]
+
+
+# Following the next cursors visits every contact once, in name order, even with equal names
+def test_keyset_pages(client):
+    names = ['Carol', 'Ada', 'Bob', 'Ada', 'Dave', 'Eve', 'Bob']
+    ids = [add(client, name)['id'] for name in names]
+
+    seen, cursor = [], None
+    while True:
+        url = '/api/contacts?per_page=2&fields=id,name' + (f'&after={cursor}' if cursor else '')
+        page = client.get(url).get_json()
+        assert page['total'] == len(names)
+        assert len(page['contacts']) <= 2
+        seen.extend((contact['name'], contact['id']) for contact in page['contacts'])
+        cursor = page['next']
+        if cursor is None:
+            break
+
+    assert seen == sorted(zip(names, ids))
+
+
+def test_invalid_cursor_starts_over(client):
+    add(client, 'Ada')
+    page = client.get('/api/contacts?after=not-a-cursor').get_json()
+    assert [contact['name'] for contact in page['contacts']] == ['Ada']
+
+
+def test_delete(client):
+    contact = add(client, 'Ada')
+    assert client.delete(f"/api/contacts/{contact['id']}").status_code == 204
+    assert client.get('/api/contacts').get_json() == {'contacts': [], 'total': 0, 'next': None}
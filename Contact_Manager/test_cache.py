@@ -0,0 +1,100 @@
+import sqlite3
+
+import pytest
+
+import cache
+from cache import MISSING, Cache, LRUCache, SharedCache
+
+
+# Stand-in for a redis client, with the two calls SharedCache makes
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+        self.down = False
+
+    def get(self, key):
+        if self.down:
+            raise ConnectionError("redis is down")
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        if self.down:
+            raise ConnectionError("redis is down")
+        self.data[key] = value
+
+
+def test_lru_drops_the_least_recently_used():
+    lru = LRUCache(2)
+    lru.set('a', 1)
+    lru.set('b', 2)
+    assert lru.get('a') == 1
+    lru.set('c', 3)
+    assert (lru.get('a'), lru.get('b'), lru.get('c')) == (1, MISSING, 3)
+
+    off = LRUCache(0)
+    off.set('a', 1)
+    assert off.get('a') is MISSING
+
+
+def test_get_or_set_computes_once():
+    values = Cache(4)
+    calls = []
+    assert values.get_or_set('key', lambda: calls.append(1) or 'value') == 'value'
+    assert values.get_or_set('key', lambda: calls.append(1) or 'other') == 'value'
+    assert calls == [1]
+    assert (values.hits, values.misses) == (1, 1)
+
+
+# A worker finds what another worker put into the shared cache, and a broken shared cache is only a miss
+def test_shared_cache():
+    client = FakeRedis()
+    first, second = Cache(4, SharedCache(client)), Cache(4, SharedCache(client))
+    first.set('key', {'rows': [1, 2]})
+    assert client.data == {'contacts:key': '{"rows": [1, 2]}'}
+    assert second.get('key') == {'rows': [1, 2]}
+    assert second.local.get('key') == {'rows': [1, 2]}
+
+    client.down = True
+    assert second.get('other') is MISSING
+    second.set('other', 1)
+    assert second.get('other') == 1
+
+
+def test_shared_cache_needs_redis(monkeypatch):
+    monkeypatch.setattr(cache, 'redis', None)
+    with pytest.raises(RuntimeError):
+        cache.connect_shared('redis://localhost:6379/0')
+
+
+# Pages are cached under the data version, any write (also by another program) makes the next request miss
+def test_write_invalidates_cached_pages(tmp_path):
+    pytest.importorskip('flask')
+    from app import create_app
+
+    app = create_app({'DATABASE': str(tmp_path / 'contacts.db'), 'TESTING': True})
+    client = app.test_client()
+    contact_cache = app.extensions['contact_cache']
+    client.post('/api/contacts', json={'name': 'Ada Lovelace'})
+
+    assert 'Ada Lovelace' in client.get('/').get_data(as_text=True)
+    hits = contact_cache.hits
+    client.get('/')
+    assert contact_cache.hits == hits + 1
+
+    db = sqlite3.connect(app.config['DATABASE'])
+    try:
+        version = db.execute('SELECT changes FROM contact_stats').fetchone()[0]
+        db.execute("UPDATE contacts SET name = 'Ada King' WHERE name = 'Ada Lovelace'")
+        db.commit()
+        assert db.execute('SELECT changes FROM contact_stats').fetchone()[0] == version + 1
+    finally:
+        db.close()
+    misses = contact_cache.misses
+    page = client.get('/').get_data(as_text=True)
+    assert contact_cache.misses == misses + 1
+    assert 'Ada King' in page and 'Ada Lovelace' not in page
+
+    # The search results follow the same version
+    assert 'Ada King' in client.get('/search?q=king').get_data(as_text=True)
+    client.delete(f"/api/contacts/{client.get('/api/contacts?fields=id').get_json()['contacts'][0]['id']}")
+    assert 'Ada King' not in client.get('/search?q=king').get_data(as_text=True)
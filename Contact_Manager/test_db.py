@@ -0,0 +1,113 @@
+import os
+import sqlite3
+import threading
+
+import pytest
+
+import db as database
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = database.ConnectionPool(str(tmp_path / 'contacts.db'), size=2, timeout=0.1)
+    yield pool
+    pool.close()
+
+
+def test_connect_is_tuned(tmp_path):
+    db = database.connect(str(tmp_path / 'contacts.db'))
+    try:
+        assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert db.execute('PRAGMA synchronous').fetchone()[0] == 1
+        assert db.execute('SELECT 1 AS one').fetchone()['one'] == 1
+    finally:
+        db.close()
+
+
+# A returned connection is handed out again instead of a new one being opened
+def test_connections_are_reused(pool):
+    first = pool.acquire()
+    pool.release(first)
+    assert pool.acquire() is first
+    second = pool.acquire()
+    assert second is not first
+    assert pool.opened == 2
+    pool.release(second)
+    pool.release(first)
+    assert pool.acquire() is first
+
+
+def test_exhausted_pool_times_out(pool):
+    held = [pool.acquire(), pool.acquire()]
+    with pytest.raises(database.PoolTimeout):
+        pool.acquire()
+
+    # A connection released by another thread is picked up by a waiting request
+    pool.timeout = 5.0
+    threading.Timer(0.05, pool.release, (held.pop(),)).start()
+    held.append(pool.acquire())
+    assert pool.opened == 2
+    for db in held:
+        pool.release(db)
+
+
+# An open transaction of a failed request is rolled back before the connection is used again
+def test_release_rolls_back(pool):
+    db = pool.acquire()
+    db.execute('CREATE TABLE items (name TEXT)')
+    db.commit()
+    db.execute("INSERT INTO items VALUES ('lost')")
+    assert db.in_transaction
+    pool.release(db)
+    db = pool.acquire()
+    assert not db.in_transaction
+    assert db.execute('SELECT COUNT(*) FROM items').fetchone()[0] == 0
+    pool.release(db)
+
+
+# A connection that cannot be rolled back is closed, and its place in the pool becomes free again
+def test_broken_connection_is_dropped(pool):
+    db = pool.acquire()
+    db.execute('CREATE TABLE items (name TEXT)')
+    db.execute("INSERT INTO items VALUES ('lost')")
+    db.close()
+    pool.release(db)
+    assert pool.opened == 0
+    fresh = pool.acquire()
+    assert fresh is not db
+    pool.release(fresh)
+
+
+# A forked child never uses the connections of its parent, it opens its own
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs os.fork")
+def test_fork_starts_a_new_pool(pool):
+    parent_db = pool.acquire()
+    pool.release(parent_db)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            db = pool.acquire()
+            ok = db is not parent_db and pool.opened == 1 and pool.pid == os.getpid()
+            db.execute('SELECT 1')
+            pool.release(db)
+            pool.release(parent_db)
+            ok = ok and pool.idle.qsize() == 1
+        except BaseException:
+            ok = False
+        os._exit(0 if ok else 1)
+    assert os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) == 0
+
+    # The parent's pool is untouched by what the child did
+    assert pool.acquire() is parent_db
+    assert pool.opened == 1
+    pool.release(parent_db)
+
+
+# The pool also closes connections that are idle when the application shuts down
+def test_close(pool):
+    db = pool.acquire()
+    pool.release(db)
+    pool.close()
+    assert pool.opened == 0
+    with pytest.raises(sqlite3.ProgrammingError):
+        db.execute('SELECT 1')
@@ -0,0 +1,86 @@
+import sqlite3
+
+import pytest
+
+pytest.importorskip('flask')
+
+from app import create_app, find_contacts, get_db  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    return create_app({'DATABASE': str(tmp_path / 'contacts.db'), 'TESTING': True})
+
+
+def search(app, query):
+    with app.app_context():
+        return [contact['name'] for contact in find_contacts(get_db(), query)]
+
+
+def test_search_by_name_phone_and_email(app):
+    client = app.test_client()
+    client.post('/api/contacts', json={'name': 'Ada Lovelace', 'phone': '+1 (555) 012-3456', 'email': 'ada@example.com'})
+    client.post('/api/contacts', json={'name': 'Bob Byron', 'phone': '555 9999', 'email': 'bob@example.org'})
+    assert search(app, 'lov') == ['Ada Lovelace']
+    assert search(app, '0123') == ['Ada Lovelace']
+    assert sorted(search(app, '555')) == ['Ada Lovelace', 'Bob Byron']
+    assert search(app, 'example.org') == ['Bob Byron']
+
+    # An edit re-indexes the new number, the old one is no longer found
+    contact_id = client.get('/api/contacts?fields=id,name').get_json()['contacts'][0]['id']
+    client.patch('/api/contacts', json=[{'id': contact_id, 'phone': '777 4242'}])
+    assert search(app, '4242') == ['Ada Lovelace']
+    assert search(app, '0123') == []
+
+
+# The triggers need nothing but SQLite, so other tools can write the database without the app's functions
+def test_plain_sqlite_client_can_write(app):
+    db = sqlite3.connect(app.config['DATABASE'])
+    try:
+        db.execute("INSERT INTO contacts (name, phone, email) VALUES ('Carol Plain', '555 1234', 'carol@example.com')")
+        db.execute("UPDATE contacts SET phone = '888 5678' WHERE name = 'Carol Plain'")
+        db.execute("INSERT INTO contacts (name) VALUES ('Dave Deleted')")
+        db.execute("DELETE FROM contacts WHERE name = 'Dave Deleted'")
+        db.commit()
+    finally:
+        db.close()
+    assert search(app, 'carol') == ['Carol Plain']
+    assert search(app, '888') == ['Carol Plain']
+    assert search(app, '1234') == []
+    assert search(app, 'dave') == []
+
+
+# A database whose triggers called the app's SQL functions is migrated to the plain SQL ones
+def test_function_triggers_are_migrated(tmp_path):
+    path = str(tmp_path / 'contacts.db')
+    db = sqlite3.connect(path)
+    db.create_function('phone_tokens', 1, lambda phone: phone)
+    db.create_function('sync_search_index', 0, lambda: 1)
+    db.executescript('''
+        CREATE TABLE contacts (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, phone TEXT, email TEXT);
+        CREATE VIRTUAL TABLE contacts_fts USING fts5(name, phone, email, tokenize = 'unicode61 remove_diacritics 2',
+                                                     prefix = '2 3');
+        CREATE TRIGGER contacts_fts_insert AFTER INSERT ON contacts WHEN sync_search_index() BEGIN
+            INSERT INTO contacts_fts (rowid, name, phone, email)
+            VALUES (new.id, new.name, phone_tokens(new.phone), new.email);
+        END;
+        CREATE TRIGGER contacts_fts_update AFTER UPDATE OF name, phone, email ON contacts BEGIN
+            UPDATE contacts_fts SET name = new.name, phone = phone_tokens(new.phone), email = new.email
+            WHERE rowid = old.id;
+        END;
+        INSERT INTO contacts (name, phone) VALUES ('Old Timer', '+1 555 246 8100');
+    ''')
+    db.commit()
+    db.close()
+
+    app = create_app({'DATABASE': path, 'TESTING': True})
+    db = sqlite3.connect(path)
+    try:
+        triggers = ' '.join(row[0] for row in db.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger'"))
+        assert 'phone_tokens(' not in triggers and 'sync_search_index(' not in triggers
+        assert db.execute('SELECT phone_search FROM contacts').fetchone()[0].split()[-1] == '100'
+        db.execute("UPDATE contacts SET name = 'New Timer'")
+        db.commit()
+    finally:
+        db.close()
+    assert search(app, 'new') == ['New Timer']
@@ -0,0 +1,238 @@
+import csv
+import io
+import re
+import time
+
+from db import phone_tokens
+
+# Rows inserted per executemany call, the whole import is still one transaction
+IMPORT_BATCH = 1000
+
+# Rows fetched from the database per chunk of an export
+EXPORT_BATCH = 1000
+
+# Errors kept for the report of an import, the rest are only counted
+MAX_REPORTED_ERRORS = 100
+
+MAX_FIELD_LENGTH = 255
+EMAIL_PATTERN = re.compile(r'[^@\s]+@[^@\s]+\.[^@\s]+')
+PHONE_PATTERN = re.compile(r'[0-9\s()+\-./]*(\s*(x|ext\.?)\s*[0-9]+)?', re.IGNORECASE)
+
+# Header names accepted for each field of a CSV file, compared case-insensitively
+CSV_COLUMNS = {
+    'name': ('name', 'full name', 'fn'),
+    'phone': ('phone', 'telephone', 'tel', 'mobile'),
+    'email': ('email', 'e-mail', 'mail'),
+}
+
+FORMATS = ('csv', 'vcard')
+
+
+# Outcome of an import: rows added, rows rejected and the first MAX_REPORTED_ERRORS of them as (line, message)
+class ImportReport:
+    def __init__(self):
+        self.imported = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, line, message):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+
+# Function to pick the format of an upload from its file name, CSV unless it looks like a vCard file
+def guess_format(filename):
+    if filename and filename.lower().endswith(('.vcf', '.vcard')):
+        return 'vcard'
+    return 'csv'
+
+
+# Function to read contacts from a CSV file with a header row, yields (line, {'name', 'phone', 'email'})
+def read_csv(stream):
+    reader = csv.reader(stream)
+    header = next(reader, None)
+    if header is None:
+        return
+    positions = {}
+    for index, title in enumerate(header):
+        for field, names in CSV_COLUMNS.items():
+            if title.strip().lower() in names and field not in positions:
+                positions[field] = index
+    if 'name' not in positions:
+        raise ValueError("The CSV header has no name column")
+
+    for row in reader:
+        if not any(cell.strip() for cell in row):
+            continue
+        yield reader.line_num, {field: row[index] if index < len(row) else ''
+                                for field, index in positions.items()}
+
+
+# Function to read contacts from a vCard file, yields (line of BEGIN:VCARD, {'name', 'phone', 'email'})
+# Only FN (or N when FN is missing), the first TEL and the first EMAIL of a card are kept
+def read_vcard(stream):
+    card, start = None, 0
+    for number, line in enumerate(unfold_lines(stream), 1):
+        if ':' not in line:
+            continue
+        key, raw = line.split(':', 1)
+        prop = key.split(';', 1)[0].split('.')[-1].upper()
+        value = unescape_vcard(raw.strip())
+        if prop == 'BEGIN' and value.upper() == 'VCARD':
+            card, start = {}, number
+        elif card is None:
+            continue
+        elif prop == 'END' and value.upper() == 'VCARD':
+            # N is family;given;additional;prefix;suffix
+            parts = [unescape_vcard(part).strip() for part in re.split(r'(?<!\\);', card.pop('n', ''))]
+            if 'name' not in card:
+                family, given, additional = (parts + ['', '', ''])[:3]
+                card['name'] = ' '.join(part for part in (given, additional, family) if part)
+            yield start, card
+            card = None
+        elif prop == 'FN':
+            card.setdefault('name', value)
+        elif prop == 'N':
+            card.setdefault('n', raw.strip())
+        elif prop == 'TEL':
+            card.setdefault('phone', value)
+        elif prop == 'EMAIL':
+            card.setdefault('email', value)
+    if card is not None:
+        raise ValueError(f"The card starting on line {start} has no END:VCARD")
+
+
+# Function to join the continuation lines of a vCard file (lines starting with a space or a tab)
+# The line numbers of read_vcard are those of the joined lines
+def unfold_lines(stream):
+    current = None
+    for line in stream:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+
+def unescape_vcard(value):
+    return re.sub(r'\\(.)', lambda m: '\n' if m.group(1) in 'nN' else m.group(1), value)
+
+
+def escape_vcard(value):
+    return value.replace('\\', '\\\\').replace(',', '\\,').replace(';', '\\;').replace('\n', '\\n')
+
+
+# Function to check one imported contact, returns (name, phone, email) or raises ValueError with the reason
+def validate(record):
+    name = (record.get('name') or '').strip()
+    phone = (record.get('phone') or '').strip()
+    email = (record.get('email') or '').strip()
+    if not name:
+        raise ValueError("Name is required")
+    for field, value in (('name', name), ('phone', phone), ('email', email)):
+        if len(value) > MAX_FIELD_LENGTH:
+            raise ValueError(f"The {field} is longer than {MAX_FIELD_LENGTH} characters")
+    if phone and not PHONE_PATTERN.fullmatch(phone):
+        raise ValueError(f"Invalid phone number: {phone}")
+    if email and not EMAIL_PATTERN.fullmatch(email):
+        raise ValueError(f"Invalid email address: {email}")
+    return name, phone, email
+
+
+# Function to add the contacts with an id above after_id to the search index
+def index_contacts(db, after_id=0):
+    db.execute('INSERT INTO contacts_fts (rowid, name, phone, email) '
+               'SELECT id, name, COALESCE(phone_search, phone), email FROM contacts WHERE id > ?', (after_id,))
+
+
+# Function to insert one batch of rows and index them with a single statement
+# import_contacts holds the write lock from its BEGIN IMMEDIATE on, so no other connection can insert between
+# the two statements and the rows above the largest id seen before the insert are this batch
+def insert_batch(db, batch):
+    last_id = db.execute('SELECT COALESCE(MAX(id), 0) FROM contacts').fetchone()[0]
+    now = time.time()
+    db.executemany('INSERT INTO contacts (name, phone, email, phone_search, updated_at) VALUES (?, ?, ?, ?, ?)',
+                   ((name, phone, email, phone_tokens(phone), now) for name, phone, email in batch))
+    index_contacts(db, last_id)
+
+
+# Function to add contacts in batches of IMPORT_BATCH rows, all of them in a single transaction
+# Invalid rows are skipped and reported, an unreadable file rolls the whole import back
+# The search index trigger is paused while the import runs, indexing a batch in one statement is
+# more than twice as fast as a trigger run per row; the pause is a flag set and cleared inside the import's
+# transaction, so no other connection ever sees it
+def import_contacts(db, records, batch_size=IMPORT_BATCH):
+    report = ImportReport()
+    batch = []
+    try:
+        # The write lock is taken before the first row is read, see insert_batch
+        db.execute('BEGIN IMMEDIATE')
+        db.execute('UPDATE contact_stats SET search_index_paused = 1 WHERE id = 1')
+        for line, record in records:
+            try:
+                batch.append(validate(record))
+            except ValueError as e:
+                report.reject(line, str(e))
+                continue
+            if len(batch) >= batch_size:
+                insert_batch(db, batch)
+                report.imported += len(batch)
+                batch = []
+        if batch:
+            insert_batch(db, batch)
+            report.imported += len(batch)
+        db.execute('UPDATE contact_stats SET search_index_paused = 0 WHERE id = 1')
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    return report
+
+
+# Function to read an import in the given format from a text stream
+def read_contacts(stream, fmt):
+    if fmt == 'vcard':
+        return read_vcard(stream)
+    return read_csv(stream)
+
+
+# Generator yielding the contacts as CSV text, EXPORT_BATCH rows per chunk
+# One query streams the table, so the export is a consistent snapshot and never holds it all in memory
+def export_csv(db, batch_size=EXPORT_BATCH):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(('name', 'phone', 'email'))
+    cursor = db.execute('SELECT name, phone, email FROM contacts ORDER BY id')
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        writer.writerows((row[0], row[1] or '', row[2] or '') for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+# Generator yielding the contacts as vCard 3.0 text, EXPORT_BATCH cards per chunk
+def export_vcard(db, batch_size=EXPORT_BATCH):
+    cursor = db.execute('SELECT name, phone, email FROM contacts ORDER BY id')
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        parts = []
+        for name, phone, email in rows:
+            parts.append(f'BEGIN:VCARD\r\nVERSION:3.0\r\nFN:{escape_vcard(name)}\r\nN:{escape_vcard(name)};;;;\r\n')
+            if phone:
+                parts.append(f'TEL:{escape_vcard(phone)}\r\n')
+            if email:
+                parts.append(f'EMAIL:{escape_vcard(email)}\r\n')
+            parts.append('END:VCARD\r\n')
+        yield ''.join(parts)
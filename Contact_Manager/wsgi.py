@@ -0,0 +1,16 @@
+import os
+
+from app import create_app
+
+# Production entry point, the schema is set up here once, when the server loads the app:
+#   gunicorn -c gunicorn.conf.py              (wsgi:app, workers and threads tuned in gunicorn.conf.py)
+#   waitress-serve --threads 8 wsgi:app
+#   python wsgi.py                            (waitress with the settings below)
+app = create_app()
+
+if __name__ == '__main__':
+    from waitress import serve
+
+    # waitress is one process; its threads share the pool, so there are as many of them as connections
+    serve(app, host=os.environ.get('CONTACTS_HOST', '127.0.0.1'), port=int(os.environ.get('CONTACTS_PORT', 8000)),
+          threads=app.config['POOL_SIZE'])
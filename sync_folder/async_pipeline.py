@@ -0,0 +1,80 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from planner import SyncPlan, merge_dir, plan_sync, scan_dir
+
+# Default number of blocking filesystem calls in flight at once
+DEFAULT_IO_CONCURRENCY = 32
+
+
+# Function to make the type and stat calls merge_dir() will make, so their results are cached in the entry
+# Errors are not cached, they come up again when the entry is planned
+def _prefetch(entry, follow_symlinks):
+    try:
+        if not entry.is_dir(follow_symlinks=follow_symlinks):
+            entry.stat()
+    except OSError:
+        pass
+
+
+async def _no_entries():
+    return []
+
+
+# Walks the source and its replica like plan_sync(), but with many listings and stat calls in flight at once
+# Every call still blocks, in an executor thread, so on a network filesystem their round trips overlap
+# instead of adding up; the sibling directories of a level are listed together, and so are their entries
+class AsyncPlanner:
+    def __init__(self, src_dir, dst_dir, manifest, delete=False, concurrency=DEFAULT_IO_CONCURRENCY):
+        self.src_dir = src_dir
+        self.dst_dir = dst_dir
+        self.manifest = manifest
+        self.delete = delete
+        self.concurrency = max(1, int(concurrency))
+        self.executor = None
+        self.slots = None
+
+    def plan(self):
+        return asyncio.run(self._plan())
+
+    async def _plan(self):
+        self.slots = asyncio.Semaphore(self.concurrency)
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="sync-io") as self.executor:
+            replica_exists = await self._call(os.path.isdir, self.dst_dir)
+            parts = await self._plan_dir('', replica_exists)
+        # The parts come in the order plan_sync() visits the directories, parents before their children
+        plan = SyncPlan()
+        for part in parts:
+            plan.extend(part)
+        return plan
+
+    # Run a blocking call in the executor as soon as one of the slots is free
+    async def _call(self, func, *args):
+        async with self.slots:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    # Plan one directory, then all of its subdirectories at once, returns the plans of the whole subtree
+    async def _plan_dir(self, rel_dir, replica_exists):
+        part = SyncPlan()
+        src_entries, dst_entries = await asyncio.gather(
+            self._call(scan_dir, part, os.path.join(self.src_dir, rel_dir)),
+            self._call(scan_dir, part, os.path.join(self.dst_dir, rel_dir)) if replica_exists else _no_entries())
+
+        # Only replicas with a source of the same name are compared, the others are deleted without a stat
+        src_names = {entry.name for entry in src_entries}
+        await asyncio.gather(*(self._call(_prefetch, entry, True) for entry in src_entries),
+                             *(self._call(_prefetch, entry, False) for entry in dst_entries if entry.name in src_names))
+
+        subdirs = []
+        merge_dir(part, subdirs, self.src_dir, self.manifest, self.delete, rel_dir, src_entries, dst_entries)
+        children = await asyncio.gather(*(self._plan_dir(rel_path, exists) for rel_path, exists in subdirs))
+        return [part] + [plan for child in children for plan in child]
+
+
+# Function to work out what a sync pass has to do, with up to concurrency filesystem calls in flight
+# The watcher reports a handful of paths at a time, those are planned by plan_sync() directly
+def plan_sync_async(src_dir, dst_dir, manifest, delete=False, changes=None, concurrency=DEFAULT_IO_CONCURRENCY):
+    if changes is not None and '' not in changes:
+        return plan_sync(src_dir, dst_dir, manifest, delete, changes)
+    return AsyncPlanner(src_dir, dst_dir, manifest, delete, concurrency).plan()
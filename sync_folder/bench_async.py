@@ -0,0 +1,191 @@
+import argparse
+import builtins
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from async_pipeline import plan_sync_async
+from manifest import Manifest
+from planner import plan_sync
+from sync_engine import SyncEngine
+
+
+# Directory entry that pays the round trip of a network filesystem the first time it is stat'ed
+# The type comes with the listing (like NFS READDIRPLUS), so is_dir() and is_symlink() are free
+class DelayedEntry:
+    def __init__(self, entry, fs):
+        self.entry = entry
+        self.fs = fs
+        self.statted = False
+
+    def __getattr__(self, name):
+        return getattr(self.entry, name)
+
+    def stat(self, follow_symlinks=True):
+        if not self.statted:
+            self.fs.wait()
+            self.statted = True
+        return self.entry.stat(follow_symlinks=follow_symlinks)
+
+
+class DelayedScandir:
+    def __init__(self, iterator, fs):
+        self.iterator = iterator
+        self.fs = fs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.iterator.close()
+
+    def __iter__(self):
+        return (DelayedEntry(entry, self.fs) for entry in self.iterator)
+
+
+# Stand-in for an NFS or SMB mount: every listing, stat and open below root first sleeps for the latency
+# The sleep releases the GIL like a real network wait, so calls from several threads overlap
+class DelayedFS:
+    def __init__(self, root, latency):
+        self.root = os.path.abspath(root)
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.originals = {}
+
+    def wait(self):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _below_root(self, path):
+        return isinstance(path, (str, bytes, os.PathLike)) and \
+            os.path.abspath(os.fsdecode(path)).startswith(self.root)
+
+    def __enter__(self):
+        self.originals = {'scandir': os.scandir, 'stat': os.stat, 'lstat': os.lstat, 'open': builtins.open}
+        scandir, stat, lstat, open_file = (self.originals[name] for name in ('scandir', 'stat', 'lstat', 'open'))
+
+        def delayed_scandir(path='.'):
+            if self._below_root(path):
+                self.wait()
+                return DelayedScandir(scandir(path), self)
+            return scandir(path)
+
+        def delayed(func):
+            def call(path, *args, **kwargs):
+                if self._below_root(path):
+                    self.wait()
+                return func(path, *args, **kwargs)
+            return call
+
+        os.scandir = delayed_scandir
+        os.stat = delayed(stat)
+        os.lstat = delayed(lstat)
+        builtins.open = delayed(open_file)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        os.scandir = self.originals['scandir']
+        os.stat = self.originals['stat']
+        os.lstat = self.originals['lstat']
+        builtins.open = self.originals['open']
+
+
+# Function to build a tree of small files spread over a few levels of directories
+def make_tree(root_dir, dirs, files_per_dir):
+    for d in range(dirs):
+        directory = os.path.join(root_dir, f"g{d % 8}", f"d{d:04d}")
+        os.makedirs(directory, exist_ok=True)
+        for i in range(files_per_dir):
+            with open(os.path.join(directory, f"f{i:04d}.txt"), 'w') as f:
+                f.write(f"file {d}/{i}\n" * 64)
+
+
+# Function to touch some files so the next pass has to compare and copy them
+def touch_files(root_dir, dirs, count):
+    for d in range(min(dirs, count)):
+        path = os.path.join(root_dir, f"g{d % 8}", f"d{d:04d}", "f0000.txt")
+        with open(path, 'a') as f:
+            f.write("changed\n")
+
+
+# Function to time planning one pass, returns (seconds, filesystem calls)
+def time_plan(src_dir, dst_dir, work_dir, latency, concurrency):
+    manifest = Manifest(dst_dir, read_only=True)
+    try:
+        with DelayedFS(work_dir, latency) as fs:
+            start = time.perf_counter()
+            if concurrency:
+                plan = plan_sync_async(src_dir, dst_dir, manifest, concurrency=concurrency)
+            else:
+                plan = plan_sync(src_dir, dst_dir, manifest)
+            elapsed = time.perf_counter() - start
+        if plan.copies:
+            raise RuntimeError("The replica was expected to be up to date")
+        return elapsed, fs.calls
+    finally:
+        manifest.close()
+
+
+# Function to time a whole pass that copies the changed files, returns (seconds, filesystem calls)
+def time_sync(src_dir, dst_dir, work_dir, latency, concurrency, workers):
+    engine = SyncEngine(src_dir, dst_dir, workers=workers, log=lambda message: None, log_file=None, progress=False,
+                        io_concurrency=concurrency)
+    with DelayedFS(work_dir, latency) as fs:
+        start = time.perf_counter()
+        engine.sync()
+        return time.perf_counter() - start, fs.calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare sequential and asyncio planning on a filesystem stand-in "
+                                                 "that delays every call like a network mount.")
+    parser.add_argument("--dirs", type=int, default=200, help="number of directories in the test tree")
+    parser.add_argument("--files-per-dir", type=int, default=20, help="number of files in every directory")
+    parser.add_argument("--changed", type=int, default=50, help="files touched before the copying pass")
+    parser.add_argument("--latency-ms", default="1,5", help="comma separated round trip times in milliseconds")
+    parser.add_argument("--concurrency", default="0,8,32,64",
+                        help="comma separated numbers of calls in flight, 0 for the sequential planner")
+    parser.add_argument("--workers", type=int, default=8, help="copy threads of the copying pass")
+    parser.add_argument("--workdir", default=None, help="directory for the temporary trees")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_async_", dir=args.workdir)
+    src_dir = os.path.join(work_dir, "src")
+    dst_dir = os.path.join(work_dir, "dst")
+    try:
+        make_tree(src_dir, args.dirs, args.files_per_dir)
+        engine = SyncEngine(src_dir, dst_dir, log=lambda message: None, log_file=None, progress=False)
+        engine.check_directories()
+        engine.sync()
+        print(f"{args.dirs * args.files_per_dir} files in {args.dirs} directories")
+
+        print(f"{'latency':>8} {'in flight':>9} {'plan s':>8} {'calls':>7} {'speedup':>8}  (nothing changed)")
+        for latency in (float(value) / 1000 for value in args.latency_ms.split(',')):
+            baseline = None
+            for concurrency in (int(value) for value in args.concurrency.split(',')):
+                elapsed, calls = time_plan(src_dir, dst_dir, work_dir, latency, concurrency)
+                baseline = baseline or elapsed
+                print(f"{latency * 1000:>6.0f}ms {concurrency or 'seq':>9} {elapsed:>8.2f} {calls:>7} "
+                      f"{baseline / elapsed:>7.1f}x")
+
+        print(f"{'latency':>8} {'in flight':>9} {'sync s':>8} {'calls':>7} {'speedup':>8}  "
+              f"({args.changed} files changed, {args.workers} copy threads)")
+        for latency in (float(value) / 1000 for value in args.latency_ms.split(',')):
+            baseline = None
+            for concurrency in (int(value) for value in args.concurrency.split(',')):
+                touch_files(src_dir, args.dirs, args.changed)
+                elapsed, calls = time_sync(src_dir, dst_dir, work_dir, latency, concurrency, args.workers)
+                baseline = baseline or elapsed
+                print(f"{latency * 1000:>6.0f}ms {concurrency or 'seq':>9} {elapsed:>8.2f} {calls:>7} "
+                      f"{baseline / elapsed:>7.1f}x")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
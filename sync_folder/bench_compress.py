@@ -0,0 +1,133 @@
+import argparse
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from protocol import Sender
+from receiver import SyncReceiver
+from stream_compression import CODECS, PREFERENCE
+
+# Data is forwarded through the proxy in pieces of this size
+PROXY_CHUNK = 64 * 1024
+
+
+# TCP proxy in front of the receiver that limits the sender to a fixed bandwidth, like a WAN link
+class ThrottledProxy:
+    def __init__(self, target_port, bytes_per_s):
+        self.target = ('127.0.0.1', target_port)
+        self.bytes_per_s = bytes_per_s
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            server = socket.create_connection(self.target)
+            threading.Thread(target=self._forward, args=(client, server, self.bytes_per_s), daemon=True).start()
+            threading.Thread(target=self._forward, args=(server, client, None), daemon=True).start()
+
+    # Copy one direction of a connection, pacing it so it never runs ahead of the bandwidth
+    @staticmethod
+    def _forward(src, dst, bytes_per_s):
+        started = time.perf_counter()
+        forwarded = 0
+        try:
+            while True:
+                data = src.recv(PROXY_CHUNK)
+                if not data:
+                    break
+                dst.sendall(data)
+                forwarded += len(data)
+                if bytes_per_s:
+                    delay = forwarded / bytes_per_s - (time.perf_counter() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+        except OSError:
+            pass
+        finally:
+            dst.close()
+            src.close()
+
+    def close(self):
+        self.listener.close()
+
+
+# Function to create a text file that compresses like application logs
+def make_text_file(path, size):
+    with open(path, 'w') as f:
+        written = 0
+        i = 0
+        while written < size:
+            line = (f"2024-05-{i % 28 + 1:02d} 12:{i % 60:02d}:{i * 7 % 60:02d},{i % 1000:03d} INFO "
+                    f"worker-{i % 16} processed request id={i * 2654435761 % 4294967296} in {i % 997} ms\n")
+            f.write(line)
+            written += len(line)
+            i += 1
+
+
+# Function to create a file of random bytes, which does not compress at all
+def make_random_file(path, size):
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            f.write(os.urandom(min(remaining, 1024 * 1024)))
+            remaining -= 1024 * 1024
+
+
+# Function to send one file through the proxy, returns (seconds, compression stats of the sender)
+def send_once(port, path, codec):
+    sender = Sender('127.0.0.1', port, compression=[codec] if codec else None)
+    try:
+        start = time.perf_counter()
+        sender.send_file(path, os.path.basename(path))
+        return time.perf_counter() - start, sender.compression_stats
+    finally:
+        sender.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure when compressing transfers pays off, over a loopback link "
+                                                 "throttled to different bandwidths.")
+    parser.add_argument("--size-mb", type=int, default=32, help="size of each test file in MB")
+    parser.add_argument("--bandwidths-mbit", default="10,100,1000,0",
+                        help="comma separated link speeds in Mbit/s, 0 for unthrottled loopback")
+    parser.add_argument("--workdir", default=None, help="directory for the test files and the received copies")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_compress_", dir=args.workdir)
+    server = SyncReceiver(os.path.join(work_dir, "received"), '127.0.0.1', 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    codecs = [None] + [name for name in PREFERENCE if name in CODECS]
+    files = {'text': os.path.join(work_dir, "logs.txt"), 'random': os.path.join(work_dir, "random.bin")}
+    make_text_file(files['text'], args.size_mb * 1024 * 1024)
+    make_random_file(files['random'], args.size_mb * 1024 * 1024)
+    try:
+        print(f"{'link':>10} {'data':>7} {'codec':>6} {'seconds':>9} {'MB/s':>9} {'ratio':>7} {'CPU s':>7}")
+        for mbit in (int(value) for value in args.bandwidths_mbit.split(',')):
+            proxy = ThrottledProxy(server.port, mbit * 1000 * 1000 // 8)
+            link = f"{mbit} Mbit" if mbit else "loopback"
+            for kind, path in files.items():
+                best = None
+                for codec in codecs:
+                    elapsed, stats = send_once(proxy.port, path, codec)
+                    print(f"{link:>10} {kind:>7} {codec or 'none':>6} {elapsed:>9.2f} "
+                          f"{args.size_mb / elapsed:>9.1f} {stats.ratio:>7.2f} {stats.cpu_seconds:>7.2f}")
+                    if best is None or elapsed < best[1]:
+                        best = (codec or 'none', elapsed)
+                print(f"{link:>10} {kind:>7} fastest: {best[0]}")
+            proxy.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from delta import DELTA_BLOCK_SIZE, delta_copy
+
+
+# Function to append new data at the end of the file
+def edit_append(path, edit_size):
+    with open(path, 'ab') as f:
+        f.write(os.urandom(edit_size))
+
+
+# Function to overwrite a few bytes in the middle of the file
+def edit_middle(path, edit_size):
+    with open(path, 'r+b') as f:
+        f.seek(os.path.getsize(path) // 2)
+        f.write(os.urandom(edit_size))
+
+
+# Function to insert data in the middle of the file, shifting everything after it
+def edit_insert(path, edit_size):
+    middle = os.path.getsize(path) // 2
+    tmp_path = path + ".tmp"
+    with open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+        dst.write(src.read(middle))
+        dst.write(os.urandom(edit_size))
+        shutil.copyfileobj(src, dst)
+    os.replace(tmp_path, path)
+
+
+SCENARIOS = {
+    "append-only": edit_append,
+    "middle-of-file edit": edit_middle,
+    "middle-of-file insert": edit_insert,
+}
+
+
+# Function to run one scenario and report the bytes moved by a full copy and by a delta
+def run_scenario(work_dir, name, edit, file_size, edit_size, block_size):
+    source_path = os.path.join(work_dir, "source.bin")
+    replica_path = os.path.join(work_dir, "replica.bin")
+    with open(source_path, 'wb') as f:
+        remaining = file_size
+        while remaining > 0:
+            chunk = os.urandom(min(remaining, 16 * 1024 * 1024))
+            f.write(chunk)
+            remaining -= len(chunk)
+    shutil.copy2(source_path, replica_path)
+    edit(source_path, edit_size)
+
+    start = time.perf_counter()
+    shutil.copy2(source_path, os.path.join(work_dir, "full_copy.bin"))
+    full_time = time.perf_counter() - start
+    full_bytes = os.path.getsize(source_path)
+
+    start = time.perf_counter()
+    delta_bytes = delta_copy(source_path, replica_path, block_size)
+    delta_time = time.perf_counter() - start
+
+    with open(source_path, 'rb') as a, open(replica_path, 'rb') as b:
+        while True:
+            chunk_a, chunk_b = a.read(1024 * 1024), b.read(1024 * 1024)
+            if chunk_a != chunk_b:
+                raise AssertionError(f"{name}: replica differs from source after delta")
+            if not chunk_a:
+                break
+
+    print(f"{name:<24} full copy {full_bytes / 1e6:10.1f} MB {full_time:6.2f} s   "
+          f"delta {delta_bytes / 1e6:10.3f} MB {delta_time:6.2f} s   "
+          f"({100 * delta_bytes / full_bytes:.3f}% of the bytes)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare bytes moved by delta transfer and a full copy.")
+    parser.add_argument("--size-mb", type=int, default=256, help="size of the test file in MB")
+    parser.add_argument("--edit-kb", type=int, default=4, help="size of the edit in KB")
+    parser.add_argument("--block-size", type=int, default=DELTA_BLOCK_SIZE, help="delta block size in bytes")
+    parser.add_argument("--workdir", default=None, help="directory for the temporary files")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_delta_", dir=args.workdir)
+    try:
+        for name, edit in SCENARIOS.items():
+            run_scenario(work_dir, name, edit, args.size_mb * 1024 * 1024, args.edit_kb * 1024, args.block_size)
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import argparse
+import filecmp
+import os
+import shutil
+import tempfile
+import time
+
+from manifest import Manifest
+
+
+# Function to build a synthetic tree with the given number of files
+def make_tree(root_dir, file_count, file_size, files_per_dir=100):
+    payload = os.urandom(file_size)
+    for i in range(file_count):
+        directory = os.path.join(root_dir, f"d{i // files_per_dir:05d}")
+        if i % files_per_dir == 0:
+            os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"f{i:07d}.bin"), 'wb') as f:
+            f.write(payload)
+
+
+# Function to list the files of a tree as (relative path, absolute path) pairs
+def list_files(src_dir):
+    for root, dirs, files in os.walk(src_dir):
+        for file in files:
+            source_path = os.path.join(root, file)
+            yield os.path.relpath(source_path, src_dir), source_path
+
+
+# Function to sync the way sync_directories did before the manifest existed
+def sync_full_compare(src_dir, dst_dir):
+    copied = 0
+    for rel_path, source_path in list_files(src_dir):
+        replica_path = os.path.join(dst_dir, rel_path)
+        if not os.path.exists(replica_path) or not filecmp.cmp(source_path, replica_path, shallow=False):
+            os.makedirs(os.path.dirname(replica_path), exist_ok=True)
+            shutil.copy2(source_path, replica_path)
+            copied += 1
+    return copied
+
+
+# Function to sync with the manifest deciding which files need to be opened
+def sync_with_manifest(src_dir, dst_dir):
+    copied = 0
+    manifest = Manifest(dst_dir)
+    for rel_path, source_path in list_files(src_dir):
+        replica_path = os.path.join(dst_dir, rel_path)
+        if manifest.needs_copy(rel_path, source_path, replica_path):
+            os.makedirs(os.path.dirname(replica_path), exist_ok=True)
+            shutil.copy2(source_path, replica_path)
+            manifest.record_copy(rel_path, source_path, replica_path)
+            copied += 1
+    manifest.commit()
+    manifest.close()
+    return copied
+
+
+# Function to time one sync pass
+def timed(label, func, src_dir, dst_dir):
+    start = time.perf_counter()
+    copied = func(src_dir, dst_dir)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<32} {elapsed:8.2f} s  {copied:>8} files copied")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare cold and warm sync with and without the manifest.")
+    parser.add_argument("--files", type=int, default=100000, help="number of files in the synthetic tree")
+    parser.add_argument("--size", type=int, default=4096, help="size of every file in bytes")
+    parser.add_argument("--workdir", default=None, help="directory for the temporary trees")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_manifest_", dir=args.workdir)
+    try:
+        src_dir = os.path.join(work_dir, "src")
+        print(f"Creating {args.files} files of {args.size} bytes in {src_dir} ...")
+        make_tree(src_dir, args.files, args.size)
+
+        full_dir = os.path.join(work_dir, "replica_full")
+        manifest_dir = os.path.join(work_dir, "replica_manifest")
+        os.makedirs(manifest_dir)
+
+        timed("cold, full compare", sync_full_compare, src_dir, full_dir)
+        warm_full = timed("warm, full compare", sync_full_compare, src_dir, full_dir)
+        timed("cold, manifest", sync_with_manifest, src_dir, manifest_dir)
+        warm_manifest = timed("warm, manifest", sync_with_manifest, src_dir, manifest_dir)
+        print(f"Warm sync speedup with manifest: {warm_full / warm_manifest:.1f}x")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
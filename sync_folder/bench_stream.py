@@ -0,0 +1,89 @@
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from protocol import MSG_FILE, Sender, file_header, new_digest, recv_ack, send_frame
+from receiver import SyncReceiver
+
+MODES = ("sendfile", "chunked", "whole-file")
+
+
+# Function to create a test file without holding it in memory
+def make_file(path, size):
+    block = os.urandom(1024 * 1024)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[:min(remaining, len(block))])
+            remaining -= len(block)
+
+
+# Function to send a file the way the sender did before streaming: the whole file in one read
+def send_whole_file(sender, path):
+    sock = sender.connect()
+    with open(path, 'rb') as f:
+        data = f.read()
+    send_frame(sock, MSG_FILE, file_header(os.path.basename(path), os.stat(path)))
+    sock.sendall(data)
+    digest = new_digest()
+    digest.update(data)
+    sock.sendall(digest.digest())
+    recv_ack(sock)
+
+
+# Function run in a fresh process, so its peak RSS only covers one transfer
+def run_child(mode, path, port):
+    sender = Sender('127.0.0.1', port, zero_copy=(mode == "sendfile"))
+    start = time.perf_counter()
+    if mode == "whole-file":
+        send_whole_file(sender, path)
+    else:
+        sender.send_file(path, os.path.basename(path))
+    elapsed = time.perf_counter() - start
+    sender.close()
+    # ru_maxrss is in kilobytes on Linux
+    print(json.dumps({'elapsed': elapsed, 'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure peak RSS and throughput of file transmission over loopback.")
+    parser.add_argument("--sizes-mb", default="1,100,2048", help="comma separated file sizes in MB")
+    parser.add_argument("--modes", default=",".join(MODES), help="comma separated modes: " + ", ".join(MODES))
+    parser.add_argument("--workdir", default=None, help="directory for the test files and the received copies")
+    parser.add_argument("--child", nargs=3, metavar=("MODE", "PATH", "PORT"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child[0], args.child[1], int(args.child[2]))
+        return
+
+    work_dir = tempfile.mkdtemp(prefix="bench_stream_", dir=args.workdir)
+    server = SyncReceiver(os.path.join(work_dir, "received"), '127.0.0.1', 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        print(f"{'size':>10} {'mode':>12} {'MB/s':>10} {'peak RSS':>12}")
+        for size_mb in (int(size) for size in args.sizes_mb.split(',')):
+            path = os.path.join(work_dir, f"file_{size_mb}mb.bin")
+            make_file(path, size_mb * 1024 * 1024)
+            for mode in args.modes.split(','):
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", mode, path,
+                                         str(server.port)], capture_output=True, text=True, check=True).stdout
+                result = json.loads(output)
+                print(f"{size_mb:>8} MB {mode:>12} {size_mb / result['elapsed']:>10.1f} "
+                      f"{result['peak_rss_kb'] / 1024:>9.1f} MB")
+            os.remove(path)
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+import argparse
+import cProfile
+import json
+import math
+import os
+import platform
+import pstats
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+
+import sync_engine
+from bench_async import DelayedFS
+from copy_engine import DEFAULT_WORKERS, CopyEngine
+from manifest import Manifest
+from sync_engine import SyncEngine
+
+# Scenarios in the order they run, each one starts from the state the previous one left
+# cold: first sync into an empty replica with the page cache emptied, warm: the same with the source cached
+# no-change: a sync of an up-to-date replica, change: a sync after a share of the files was modified
+SCENARIOS = ('cold', 'warm', 'no-change', 'change')
+
+# Random bytes the synthetic files are cut from, so building a large tree costs little CPU
+CONTENT_POOL_SIZE = 4 * 1024 * 1024
+
+# Number of functions listed per phase as hot spots
+HOT_SPOTS = 15
+
+
+# Function to draw file sizes: fixed, uniform between 0 and twice the size, or lognormal around the size
+def size_sampler(distribution, size, max_size, rng):
+    if distribution == 'fixed':
+        return lambda: min(size, max_size)
+    if distribution == 'uniform':
+        return lambda: min(rng.randint(0, 2 * size), max_size)
+    # Many small files and a few large ones, like most real trees
+    return lambda: min(int(rng.lognormvariate(math.log(max(size, 1)), 1.5)), max_size)
+
+
+# Function to list the leaf directories of a tree with the given depth and directories per level
+def leaf_dirs(root_dir, depth, branching):
+    dirs = ['']
+    for level in range(depth):
+        dirs = [os.path.join(parent, f"l{level}_{i:03d}") for parent in dirs for i in range(branching)]
+    return [os.path.join(root_dir, rel_dir) for rel_dir in dirs]
+
+
+# Function to build a synthetic tree, files are spread over the leaf directories
+# Returns (files, directories, bytes)
+def make_tree(root_dir, file_count, depth, branching, distribution, size, max_size, seed):
+    rng = random.Random(seed)
+    pool = os.urandom(CONTENT_POOL_SIZE)
+    next_size = size_sampler(distribution, size, max_size, rng)
+    dirs = leaf_dirs(root_dir, depth, branching)
+    for directory in dirs:
+        os.makedirs(directory, exist_ok=True)
+    total = 0
+    for i in range(file_count):
+        remaining = next_size()
+        total += remaining
+        with open(os.path.join(dirs[i % len(dirs)], f"f{i:07d}.bin"), 'wb') as f:
+            while remaining > 0:
+                n = min(remaining, CONTENT_POOL_SIZE)
+                start = rng.randrange(CONTENT_POOL_SIZE - n + 1)
+                f.write(pool[start:start + n])
+                remaining -= n
+    return file_count, len(dirs), total
+
+
+# Function to modify a share of the files in place, returns the number of files changed
+def change_files(root_dir, ratio, seed):
+    paths = sorted(os.path.join(root, name) for root, dirs, files in os.walk(root_dir) for name in files)
+    count = min(len(paths), math.ceil(len(paths) * ratio)) if ratio > 0 else 0
+    for path in random.Random(seed).sample(paths, count):
+        with open(path, 'r+b') as f:
+            f.write(os.urandom(16))
+        # The manifest compares modification times, which some filesystems only keep to the second
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    return count
+
+
+# Function to empty the page cache for a tree, returns how it was done
+# drop_caches needs root and empties the whole cache of the machine, fadvise only evicts the file contents
+def evict_cache(root_dirs, drop_caches=False):
+    os.sync()
+    if drop_caches:
+        try:
+            with open('/proc/sys/vm/drop_caches', 'w') as f:
+                f.write('3\n')
+            return 'drop_caches'
+        except OSError:
+            pass
+    if not hasattr(os, 'posix_fadvise'):
+        return 'none'
+    for root_dir in root_dirs:
+        for root, dirs, files in os.walk(root_dir):
+            for name in files:
+                try:
+                    fd = os.open(os.path.join(root, name), os.O_RDONLY)
+                except OSError:
+                    continue
+                try:
+                    os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                finally:
+                    os.close(fd)
+    return 'fadvise'
+
+
+# Function to read the I/O counters of this process (Linux), empty where the system has none
+def io_counters():
+    try:
+        with open('/proc/self/io') as f:
+            return {key: int(value) for key, value in (line.split(':') for line in f)}
+    except OSError:
+        return {}
+
+
+# Profiles the phases of a pass, with one profiler per thread so the copy threads are included
+# Only the outermost profiled call of a thread is recorded, a phase inside another one counts for the outer one
+class PhaseProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.profiles = {}  # phase -> profilers of every thread that ran it
+        self.local = threading.local()
+        self.skipped = 0
+
+    def wrap(self, phase, func):
+        def profiled(*args, **kwargs):
+            if getattr(self.local, 'active', False):
+                return func(*args, **kwargs)
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12 and later allow a single profiler at a time, this thread goes unprofiled
+                with self.lock:
+                    self.skipped += 1
+                return func(*args, **kwargs)
+            self.local.active = True
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                self.local.active = False
+                with self.lock:
+                    self.profiles.setdefault(phase, []).append(profile)
+        return profiled
+
+    # Write a .prof file per phase, returns the hot spots of every phase by cumulative time
+    def dump(self, profile_dir, prefix):
+        os.makedirs(profile_dir, exist_ok=True)
+        hot_spots = {}
+        for phase, profiles in self.profiles.items():
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(os.path.join(profile_dir, f"{prefix}-{phase}.prof"))
+            rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:HOT_SPOTS]
+            hot_spots[phase] = [{'function': f"{os.path.basename(file)}:{line}({name})", 'calls': calls,
+                                 'own_s': round(own, 4), 'cumulative_s': round(cumulative, 4)}
+                                for (file, line, name), (primitive, calls, own, cumulative, callers) in rows]
+        if self.skipped:
+            hot_spots['unprofiled_calls'] = self.skipped
+        return hot_spots
+
+
+# Function to run one sync pass and measure it, runs in a fresh process so the peak RSS is its own
+def measure(scenario, src_dir, dst_dir, work_dir, workers, io_concurrency, profile_dir):
+    profiler = None
+    if profile_dir:
+        profiler = PhaseProfiler()
+        sync_engine.plan_sync = profiler.wrap('plan', sync_engine.plan_sync)
+        sync_engine.plan_sync_async = profiler.wrap('plan', sync_engine.plan_sync_async)
+        CopyEngine.sync = profiler.wrap('copy', CopyEngine.sync)
+        CopyEngine._copy_one = profiler.wrap('copy', CopyEngine._copy_one)
+        Manifest.commit = profiler.wrap('commit', Manifest.commit)
+
+    engine = SyncEngine(src_dir, dst_dir, workers=workers, log=lambda message: None, log_file=None, progress=False,
+                        io_concurrency=io_concurrency)
+    engine.check_directories()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    io_before = io_counters()
+    # Calls are counted, not delayed: the stand-in for a network mount doubles as a syscall counter
+    with DelayedFS(work_dir, 0) as fs:
+        start = time.perf_counter()
+        ok = engine.sync()
+        elapsed = time.perf_counter() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    io_after = io_counters()
+
+    result = {
+        'ok': ok,
+        'wall_s': round(elapsed, 4),
+        'cpu_s': round(usage.ru_utime + usage.ru_stime - usage_before.ru_utime - usage_before.ru_stime, 4),
+        'fs_calls': fs.calls,
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        'peak_rss_mb': round(usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1),
+        'rss_before_mb': round(rss_before / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1),
+        'context_switches': (usage.ru_nvcsw + usage.ru_nivcsw) - (usage_before.ru_nvcsw + usage_before.ru_nivcsw),
+    }
+    # syscr/syscw count read and write system calls, rchar/wchar the bytes they moved (cache included),
+    # read_bytes/write_bytes what really went to or came from storage
+    for key, name in (('syscr', 'read_syscalls'), ('syscw', 'write_syscalls'), ('rchar', 'bytes_read'),
+                      ('wchar', 'bytes_written'), ('read_bytes', 'storage_bytes_read'),
+                      ('write_bytes', 'storage_bytes_written')):
+        if key in io_before and key in io_after:
+            result[name] = io_after[key] - io_before[key]
+    if profiler is not None:
+        result['hot_spots'] = profiler.dump(profile_dir, scenario)
+    return result
+
+
+# Function to run measure() in a new interpreter
+def measure_in_process(*args):
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as pool:
+        return pool.submit(measure, *args).result()
+
+
+# Function to identify the version of the code being measured
+def code_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Function to print how the wall time of every scenario compares with an earlier result file
+def compare(results, baseline_path):
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"Compared with {baseline_path} ({baseline.get('version')}, {baseline.get('time')}):")
+    for scenario, result in results['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(scenario)
+        if not before:
+            continue
+        ratio = result['wall_s'] / before['wall_s'] if before['wall_s'] else float('inf')
+        print(f"  {scenario:<10} {before['wall_s']:8.3f} s -> {result['wall_s']:8.3f} s  ({ratio:.2f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure sync passes over a synthetic tree: cold and warm cache, "
+                                                 "no change and a share of the files changed.")
+    parser.add_argument("--files", type=int, default=10000, help="number of files in the synthetic tree")
+    parser.add_argument("--depth", type=int, default=3, help="directory levels above the files")
+    parser.add_argument("--branching", type=int, default=4, help="directories per level")
+    parser.add_argument("--size-dist", choices=("fixed", "uniform", "lognormal"), default="lognormal",
+                        help="distribution of the file sizes")
+    parser.add_argument("--size", type=int, default=16 * 1024, help="typical file size in bytes")
+    parser.add_argument("--max-size", type=int, default=64 * 1024 * 1024, help="largest file size in bytes")
+    parser.add_argument("--change-ratio", type=float, default=0.01, help="share of the files the change scenario "
+                                                                         "modifies")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated scenarios to run")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="copy threads")
+    parser.add_argument("--io-concurrency", type=int, default=0, help="calls in flight while planning, 0 plans "
+                                                                      "sequentially")
+    parser.add_argument("--drop-caches", action="store_true",
+                        help="empty the whole page cache of the machine for the cold scenario (needs root), "
+                             "otherwise only the files of the tree are evicted")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the synthetic tree")
+    parser.add_argument("--output", default=None, help="JSON file for the results, to track them across versions")
+    parser.add_argument("--baseline", default=None, help="JSON file of an earlier run to compare the wall times with")
+    parser.add_argument("--profile", default=None, help="directory for cProfile dumps of every phase, which also "
+                                                        "adds the hot spots to the results")
+    parser.add_argument("--workdir", default=None, help="directory for the temporary trees")
+    args = parser.parse_args()
+    scenarios = [name for name in args.scenarios.split(',') if name]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    profile_dir = os.path.abspath(args.profile) if args.profile else None
+
+    work_dir = tempfile.mkdtemp(prefix="bench_sync_", dir=args.workdir)
+    src_dir = os.path.join(work_dir, "src")
+    dst_dir = os.path.join(work_dir, "dst")
+    try:
+        print(f"Creating {args.files} files ({args.size_dist} sizes around {args.size} bytes) ...")
+        files, dirs, total = make_tree(src_dir, args.files, args.depth, args.branching, args.size_dist, args.size,
+                                       args.max_size, args.seed)
+        print(f"{files} files in {dirs} directories, {total / (1024 * 1024):.1f} MB")
+        results = {'version': code_version(), 'time': datetime.now().isoformat(timespec='seconds'),
+                   'python': platform.python_version(), 'platform': platform.platform(), 'args': vars(args),
+                   'tree': {'files': files, 'directories': dirs, 'bytes': total}, 'scenarios': {}}
+
+        print(f"{'scenario':<10} {'wall s':>8} {'cpu s':>7} {'fs calls':>9} {'read MB':>8} {'written MB':>10} "
+              f"{'peak RSS MB':>11}")
+        for scenario in SCENARIOS:
+            if scenario not in scenarios:
+                continue
+            extra = {}
+            if scenario in ('cold', 'warm'):
+                # Both copy everything into an empty replica
+                shutil.rmtree(dst_dir, ignore_errors=True)
+            elif not os.path.exists(dst_dir):
+                # The others start from an up-to-date replica, made without measuring it
+                SyncEngine(src_dir, dst_dir, workers=args.workers, log=lambda message: None, log_file=None,
+                           progress=False).sync()
+            if scenario == 'cold':
+                extra['cache'] = evict_cache([src_dir, dst_dir], args.drop_caches)
+            if scenario == 'change':
+                extra['files_changed'] = change_files(src_dir, args.change_ratio, args.seed)
+            result = measure_in_process(scenario, src_dir, dst_dir, work_dir, args.workers, args.io_concurrency,
+                                        profile_dir)
+            result.update(extra)
+            results['scenarios'][scenario] = result
+            print(f"{scenario:<10} {result['wall_s']:>8.3f} {result['cpu_s']:>7.3f} {result['fs_calls']:>9} "
+                  f"{result.get('bytes_read', 0) / (1024 * 1024):>8.1f} "
+                  f"{result.get('bytes_written', 0) / (1024 * 1024):>10.1f} {result['peak_rss_mb']:>11.1f}")
+
+        if args.output:
+            with open(args.output, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
+            print(f"Results written to {args.output}")
+        if args.baseline:
+            compare(results, args.baseline)
+        if profile_dir:
+            print(f"Profiles written to {profile_dir}, e.g. python -m pstats {profile_dir}/change-copy.prof")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
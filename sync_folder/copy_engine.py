@@ -0,0 +1,192 @@
+import os
+import stat
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dedup import clone_file
+from delta import DELTA_MIN_SIZE, delta_copy
+from manifest import file_digest
+from resumable import copy_file
+
+# Default number of copy threads and of jobs allowed to wait in the queue
+DEFAULT_WORKERS = 4
+DEFAULT_QUEUE_SIZE = 256
+
+
+# Counters collected while a copy pass is running
+class CopyStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files_checked = 0
+        self.files_copied = 0
+        self.bytes_copied = 0
+        self.bytes_saved = 0
+        self.files_linked = 0
+        self.bytes_linked = 0
+        self.errors = []
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def add_copy(self, size, written=None):
+        with self.lock:
+            self.files_copied += 1
+            self.bytes_copied += size
+            if written is not None:
+                self.bytes_saved += size - written
+
+    def add_link(self, size):
+        with self.lock:
+            self.files_linked += 1
+            self.bytes_linked += size
+
+    def add_check(self):
+        with self.lock:
+            self.files_checked += 1
+
+    def add_error(self, path, error):
+        with self.lock:
+            self.errors.append((path, error))
+
+    @property
+    def elapsed(self):
+        end = self.finished if self.finished is not None else time.perf_counter()
+        return max(end - self.started, 1e-9)
+
+    @property
+    def mb_per_s(self):
+        return self.bytes_copied / (1024 * 1024) / self.elapsed
+
+    @property
+    def files_per_s(self):
+        return self.files_copied / self.elapsed
+
+    def summary(self):
+        text = (f"{self.files_copied} of {self.files_checked} files copied, "
+                f"{self.bytes_copied / (1024 * 1024):.1f} MB in {self.elapsed:.2f} s "
+                f"({self.mb_per_s:.1f} MB/s, {self.files_per_s:.1f} files/s)")
+        if self.bytes_saved:
+            text += f", {self.bytes_saved / (1024 * 1024):.1f} MB saved by delta transfer"
+        if self.files_linked:
+            text += (f", {self.files_linked} files ({self.bytes_linked / (1024 * 1024):.1f} MB) "
+                     f"linked to identical replicas")
+        return text
+
+
+# Carries out the directories and copies of a SyncPlan on a thread pool fed through a bounded queue
+# With dedup, content that already exists in the replica is reflinked or hardlinked instead of copied,
+# which needs a manifest that records hashes
+# A throttle (see throttle.py) is charged one operation per directory and file, and the bytes written
+class CopyEngine:
+    def __init__(self, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE, delta=False,
+                 delta_min_size=DELTA_MIN_SIZE, dedup=False, throttle=None):
+        self.workers = max(1, int(workers))
+        self.queue_size = max(self.workers, int(queue_size))
+        self.delta = delta
+        self.delta_min_size = delta_min_size
+        self.dedup = dedup
+        self.throttle = throttle
+
+    # on_progress is called with the source path and its size once a directory or file was handled
+    # cancelled is an optional threading.Event, once it is set no further files are started
+    def sync(self, src_dir, dst_dir, plan, manifest, on_progress=None, on_copied=None, cancelled=None):
+        stats = CopyStats()
+
+        # The plan lists parents before their children, so the skeleton exists before any file is copied
+        for rel_path in plan.mkdirs:
+            source_path = os.path.join(src_dir, rel_path)
+            try:
+                if self.throttle is not None:
+                    self.throttle.operation()
+                os.makedirs(os.path.join(dst_dir, rel_path), exist_ok=True)
+            except OSError as e:
+                stats.add_error(source_path, e)
+            if on_progress:
+                on_progress(source_path, 0)
+
+        # Files come directory by directory from the walk, which keeps each directory's metadata hot
+        slots = threading.BoundedSemaphore(self.queue_size)
+
+        # _copy_one handles OSError itself, anything else it raises (a manifest error, a bug) still counts
+        # the file as failed instead of being lost with the future
+        def finished(future, source_path):
+            slots.release()
+            error = future.exception()
+            if error is not None:
+                stats.add_error(source_path, error)
+                stats.add_check()
+
+        # Duplicates found while planning wait for the copies they are linked to, so they go in a second round
+        copies = [copy for copy in plan.copies if copy[0] not in plan.duplicates]
+        duplicates = [copy for copy in plan.copies if copy[0] in plan.duplicates]
+        for batch in (copies, duplicates):
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="sync-copy") as pool:
+                for rel_path, src_st, dst_st in batch:
+                    if cancelled is not None and cancelled.is_set():
+                        break
+                    slots.acquire()
+                    future = pool.submit(self._copy_one, src_dir, dst_dir, rel_path, src_st, dst_st, manifest,
+                                         stats, on_progress, on_copied, plan.digests.get(rel_path))
+                    future.add_done_callback(lambda f, path=os.path.join(src_dir, rel_path): finished(f, path))
+
+        stats.finished = time.perf_counter()
+        return stats
+
+    # The stat results come from the plan, a replica stat of None means there is no replica yet
+    # digest is the hash of the source if the plan already worked it out
+    def _copy_one(self, src_dir, dst_dir, rel_path, src_st, dst_st, manifest, stats, on_progress, on_copied,
+                  digest=None):
+        source_path = os.path.join(src_dir, rel_path)
+        replica_path = os.path.join(dst_dir, rel_path)
+        try:
+            if self.throttle is not None:
+                self.throttle.operation()
+            if dst_st is None or manifest.needs_copy(rel_path, source_path, replica_path, src_st, dst_st):
+                if dst_st is not None and dst_st.st_nlink > 1:
+                    # The replica shares its inode with other files, writing into it would change them all
+                    os.remove(replica_path)
+                    dst_st = None
+
+                if self.dedup and self._link_duplicate(dst_dir, rel_path, source_path, replica_path, src_st, manifest,
+                                                       digest):
+                    stats.add_link(src_st.st_size)
+                else:
+                    # Large files that already have a replica only get their changed blocks rewritten
+                    if self.delta and src_st.st_size >= self.delta_min_size and dst_st is not None \
+                            and stat.S_ISREG(dst_st.st_mode):
+                        written = delta_copy(source_path, replica_path,
+                                             on_patch=lambda: manifest.record_patching(rel_path, src_st))
+                        manifest.forget_partial(rel_path)
+                        digest = None
+                        if self.throttle is not None:
+                            # Charged afterwards, the next files wait until the rate has caught up
+                            self.throttle.consume(written)
+                    else:
+                        # With dedup the hash of what was written is recorded, so later copies can link to it
+                        digest = copy_file(source_path, replica_path, rel_path, src_st, manifest,
+                                           with_digest=self.dedup, throttle=self.throttle)
+                        written = None
+                    manifest.record_copy(rel_path, source_path, replica_path, src_st, digest)
+                    stats.add_copy(src_st.st_size, written)
+                if on_copied:
+                    on_copied(source_path)
+            manifest.checkpoint()
+        except OSError as e:
+            stats.add_error(source_path, e)
+        stats.add_check()
+        if on_progress:
+            on_progress(source_path, src_st.st_size)
+
+    # Give the replica the content of an identical replica without copying it, returns False if there is none
+    def _link_duplicate(self, dst_dir, rel_path, source_path, replica_path, src_st, manifest, digest=None):
+        if not manifest.has_content_of_size(src_st.st_size):
+            return False
+        if digest is None:
+            digest = file_digest(source_path)
+        existing = manifest.find_replica(src_st.st_size, digest)
+        if existing is None or existing == rel_path:
+            return False
+        if not clone_file(os.path.join(dst_dir, existing), replica_path, source_path):
+            return False
+        manifest.record(rel_path, src_st, os.stat(replica_path), digest)
+        return True
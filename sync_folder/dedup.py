@@ -0,0 +1,55 @@
+import errno
+import os
+import shutil
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl that makes a file share the extents of another (btrfs, xfs, and other copy-on-write filesystems)
+FICLONE = 0x40049409
+
+# Errors meaning the filesystem cannot clone or link these files, so the data has to be copied
+_UNSUPPORTED = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOSYS}
+
+
+# Function to pick an unused name next to a file, for writing it before it is renamed into place
+def temp_name(path):
+    return os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.sync-{uuid.uuid4().hex[:8]}")
+
+
+# Function to make dst a copy-on-write clone of src, raises OSError where cloning is not supported
+def reflink(src, dst):
+    if fcntl is None:
+        raise OSError(errno.ENOSYS, "Reflinks are not supported on this system")
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+# Function to put the content of an existing replica at target without copying the data
+# Tries a reflink first (the replica keeps its own metadata), then a hardlink (which shares it)
+# Returns 'reflink', 'hardlink', or None when the data has to be copied after all
+def clone_file(existing, target, source_path):
+    tmp_path = temp_name(target)
+    try:
+        reflink(existing, tmp_path)
+        shutil.copystat(source_path, tmp_path)
+        os.replace(tmp_path, target)
+        return 'reflink'
+    except OSError as e:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        if e.errno not in _UNSUPPORTED:
+            raise
+    try:
+        os.link(existing, tmp_path)
+        os.replace(tmp_path, target)
+        return 'hardlink'
+    except OSError as e:
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        if e.errno not in _UNSUPPORTED:
+            raise
+    return None
@@ -0,0 +1,276 @@
+import hashlib
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+
+# Size of the blocks the replica is split into
+DELTA_BLOCK_SIZE = 64 * 1024
+
+# Files smaller than this are copied in full, the checksums would cost more than they save
+DELTA_MIN_SIZE = 8 * 1024 * 1024
+
+# Size of the reads used while scanning the source file
+READ_SIZE = 4 * 1024 * 1024
+
+# Longest run of blocks stepped over without rolling when the source has no matches
+MAX_STEP_BLOCKS = 1024
+
+# Binary layout of one signature entry: the two weak sums, the strong hash and the block length
+BLOCK_ENTRY = struct.Struct('!HH16sI')
+
+# Delta operations: copy a block that already exists in the replica, or send literal source bytes
+COPY = 'copy'
+DATA = 'data'
+
+
+# Modulus of the Adler-32 sums used as the weak rolling checksum
+ADLER_MOD = 65521
+
+
+# Function to compute the weak checksum of a block, split into its two Adler-32 sums
+def weak_checksum(block):
+    value = zlib.adler32(block)
+    return value & 0xffff, value >> 16
+
+
+# Function to slide a weak checksum one byte forward
+def roll_checksum(a, b, out_byte, in_byte, block_size):
+    a = (a - out_byte + in_byte) % ADLER_MOD
+    b = (b - block_size * out_byte + a - 1) % ADLER_MOD
+    return a, b
+
+
+# Function to compute the strong hash that confirms a weak checksum match
+def strong_hash(block):
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+# Signature of a replica: weak and strong checksums of every fixed-size block
+class Signature:
+    def __init__(self, block_size=DELTA_BLOCK_SIZE):
+        self.block_size = block_size
+        self.blocks = []
+        self.weak_index = {}
+        self.strong_index = {}
+
+    def add_block(self, block):
+        index = len(self.blocks)
+        weak = weak_checksum(block)
+        strong = strong_hash(block)
+        self.blocks.append((weak, strong, len(block)))
+        if len(block) == self.block_size:
+            self.weak_index.setdefault(weak, {}).setdefault(strong, index)
+            self.strong_index.setdefault(strong, index)
+
+    # The last block is usually shorter and can only match the end of the source
+    @property
+    def tail(self):
+        if self.blocks and self.blocks[-1][2] < self.block_size:
+            return len(self.blocks) - 1, self.blocks[-1]
+        return None
+
+    def block_length(self, index):
+        return self.blocks[index][2]
+
+    # Compact form used to send a signature over the network
+    def to_bytes(self):
+        return b''.join(BLOCK_ENTRY.pack(weak[0], weak[1], strong, length)
+                        for weak, strong, length in self.blocks)
+
+    @classmethod
+    def from_bytes(cls, data, block_size):
+        signature = cls(block_size)
+        for a, b, strong, length in BLOCK_ENTRY.iter_unpack(data):
+            index = len(signature.blocks)
+            signature.blocks.append(((a, b), strong, length))
+            if length == block_size:
+                signature.weak_index.setdefault((a, b), {}).setdefault(strong, index)
+                signature.strong_index.setdefault(strong, index)
+        return signature
+
+
+# Function to build the signature of a replica file
+def file_signature(path, block_size=DELTA_BLOCK_SIZE):
+    signature = Signature(block_size)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            signature.add_block(block)
+    return signature
+
+
+# Function to compute the operations that rebuild the source from the replica blocks
+# Returns (COPY, source_offset, length, first_block_index) and (DATA, source_offset, length, None),
+# an optional hash object is fed the whole source on the way
+def compute_delta(source_path, signature, digest=None):
+    block_size = signature.block_size
+    ops = []
+
+    def emit_copy(start, length, index):
+        last = ops[-1] if ops else None
+        if last and last[0] == COPY and last[1] + last[2] == start and \
+                last[3] * block_size + last[2] == index * block_size:
+            ops[-1] = (COPY, last[1], last[2] + length, last[3])
+        else:
+            ops.append((COPY, start, length, index))
+
+    def emit_data(start, end):
+        if end <= start:
+            return
+        if ops and ops[-1][0] == DATA and ops[-1][1] + ops[-1][2] == start:
+            ops[-1] = (DATA, ops[-1][1], ops[-1][2] + end - start, None)
+        else:
+            ops.append((DATA, start, end - start, None))
+
+    with open(source_path, 'rb') as f:
+        buf = f.read(READ_SIZE)
+        if digest is not None:
+            digest.update(buf)
+        buf_offset = 0  # Absolute offset of buf[0] in the source
+        eof = len(buf) < READ_SIZE
+        pos = 0
+        literal_start = 0
+        # Rolling byte by byte is slow in Python, so it is limited to a couple of blocks after
+        # every mismatch; then aligned blocks are stepped over, probing again with backoff
+        roll_budget = 2 * block_size
+        step_blocks = 1
+        steps_left = 0
+        a = b = None
+
+        while True:
+            if len(buf) - pos <= block_size and not eof:
+                chunk = f.read(READ_SIZE)
+                if digest is not None:
+                    digest.update(chunk)
+                eof = len(chunk) < READ_SIZE
+                buf_offset += pos
+                buf = buf[pos:] + chunk
+                pos = 0
+            if len(buf) - pos < block_size:
+                break
+
+            if a is None:
+                window = buf[pos:pos + block_size]
+                index = signature.strong_index.get(strong_hash(window))
+                if index is None and roll_budget == 0:
+                    pos += block_size
+                    steps_left -= 1
+                    if steps_left <= 0:
+                        roll_budget = 2 * block_size
+                    continue
+                if index is None:
+                    a, b = weak_checksum(window)
+            else:
+                candidates = signature.weak_index.get((a, b))
+                index = candidates.get(strong_hash(buf[pos:pos + block_size])) if candidates else None
+
+            if index is not None:
+                emit_data(literal_start, buf_offset + pos)
+                emit_copy(buf_offset + pos, block_size, index)
+                pos += block_size
+                literal_start = buf_offset + pos
+                roll_budget = 2 * block_size
+                step_blocks = 1
+                a = b = None
+                continue
+
+            # Roll the window forward by one byte
+            roll_budget -= 1
+            if roll_budget == 0:
+                steps_left = step_blocks
+                step_blocks = min(step_blocks * 2, MAX_STEP_BLOCKS)
+                a = b = None
+            elif pos + block_size >= len(buf):
+                a = b = None
+            else:
+                a, b = roll_checksum(a, b, buf[pos], buf[pos + block_size], block_size)
+            pos += 1
+
+        end = buf_offset + len(buf)
+        tail = signature.tail
+        if tail is not None:
+            index, (weak, strong, length) = tail
+            if end - length >= literal_start and strong_hash(buf[len(buf) - length:]) == strong:
+                emit_data(literal_start, end - length)
+                emit_copy(end - length, length, index)
+                literal_start = end
+        emit_data(literal_start, end)
+
+    return ops
+
+
+# Function to count the literal bytes a delta has to move
+def literal_bytes(ops):
+    return sum(length for kind, offset, length, index in ops if kind == DATA)
+
+
+# Function to check if every copied block stays at the same offset, so the replica can be patched in place
+def is_in_place(ops, block_size):
+    return all(kind == DATA or offset == index * block_size for kind, offset, length, index in ops)
+
+
+# Function to bring a replica up to date with its source by moving only the changed blocks
+# Returns the number of literal bytes written
+# Patching in place is not atomic, on_patch is called right before it so the caller can note that the replica
+# may be left half old, half new
+def delta_copy(source_path, replica_path, block_size=DELTA_BLOCK_SIZE, on_patch=None):
+    signature = file_signature(replica_path, block_size)
+    ops = compute_delta(source_path, signature)
+    source_size = os.path.getsize(source_path)
+
+    with open(source_path, 'rb') as src:
+        if is_in_place(ops, block_size):
+            if on_patch is not None:
+                on_patch()
+            with open(replica_path, 'r+b') as dst:
+                for kind, offset, length, index in ops:
+                    if kind == DATA:
+                        src.seek(offset)
+                        dst.seek(offset)
+                        _copy_range(src, dst, length)
+                dst.truncate(source_size)
+        else:
+            # Blocks moved around, so the new replica is assembled next to the old one
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(replica_path), prefix='.delta-')
+            try:
+                with os.fdopen(fd, 'wb') as dst, open(replica_path, 'rb') as old:
+                    apply_delta(old, ops, block_size, lambda offset, length: os.pread(src.fileno(), length, offset),
+                                dst)
+                os.replace(tmp_path, replica_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+    shutil.copystat(source_path, replica_path)
+    return literal_bytes(ops)
+
+
+# Function to write the new file described by a delta, taking literal bytes from a callback
+def apply_delta(old, ops, block_size, read_literal, dst, digest=None):
+    for kind, offset, length, index in ops:
+        if kind == COPY:
+            old.seek(index * block_size)
+            _copy_range(old, dst, length, digest)
+        else:
+            while length > 0:
+                chunk = read_literal(offset, min(length, READ_SIZE))
+                if not chunk:
+                    raise OSError("Unexpected end of literal data while applying delta")
+                dst.write(chunk)
+                if digest is not None:
+                    digest.update(chunk)
+                offset += len(chunk)
+                length -= len(chunk)
+
+
+# Function to copy a number of bytes between two open files
+def _copy_range(src, dst, length, digest=None):
+    while length > 0:
+        chunk = src.read(min(length, READ_SIZE))
+        if not chunk:
+            raise OSError("Unexpected end of file while applying delta")
+        dst.write(chunk)
+        if digest is not None:
+            digest.update(chunk)
+        length -= len(chunk)
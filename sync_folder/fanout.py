@@ -0,0 +1,471 @@
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+from copy_engine import DEFAULT_QUEUE_SIZE, DEFAULT_WORKERS, CopyStats
+from manifest import Manifest
+from planner import plan_fanout, plan_source
+from progress import COPYING, DONE, SyncProgress
+from protocol import FileRejected, ProtocolError, Sender, new_digest
+from resumable import COPY_CHUNK_SIZE, partial_path
+from sender_pool import SendJob, SendStats
+from stream_compression import worth_compressing
+from sync_engine import LOG_FILE, SyncEngine, remove_replica
+from throttle import Throttle
+
+# A receiver that fails this many files in a row because of its connection is left out for the rest of the pass
+MAX_CONNECTION_FAILURES = 3
+
+
+# A local replica of a fan-out job, with its own manifest, plan, counters and progress
+class LocalTarget:
+    def __init__(self, dst_dir):
+        self.dst_dir = dst_dir
+        self.name = dst_dir
+        self.manifest = None
+        self.plan = None
+        self.stats = CopyStats()
+        self.progress = SyncProgress()
+
+    def record(self, metrics):
+        metrics['targets'].append({'target': os.path.abspath(self.dst_dir), 'files_copied': self.stats.files_copied,
+                                   'bytes_copied': self.stats.bytes_copied, 'errors': len(self.stats.errors)})
+
+
+# A receiver of a fan-out job, every copy thread has its own connection to it
+class ReceiverTarget:
+    def __init__(self, host, port, compression=None, throttle=None):
+        self.host = host
+        self.port = port
+        self.name = f"{host}:{port}"
+        self.compression = compression
+        self.throttle = throttle
+        self.local = threading.local()
+        self.senders = []
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.down = False
+        self.stats = SendStats()
+        self.progress = SyncProgress()
+
+    # The connection of the calling thread
+    def sender(self):
+        sender = getattr(self.local, 'sender', None)
+        if sender is None:
+            sender = self.local.sender = Sender(self.host, self.port, compression=self.compression,
+                                                compression_stats=self.stats.compression, throttle=self.throttle)
+            with self.lock:
+                self.senders.append(sender)
+        return sender
+
+    # Count a failed file, returns True if that took the receiver out of the pass
+    # A file the receiver refused says nothing about the connection
+    def add_failure(self, path, error):
+        self.stats.add_error(path, error)
+        if isinstance(error, FileRejected):
+            return False
+        with self.lock:
+            self.failures += 1
+            if self.failures >= MAX_CONNECTION_FAILURES and not self.down:
+                self.down = True
+                return True
+        return False
+
+    def add_sent(self, job):
+        self.stats.add_sent(job)
+        with self.lock:
+            self.failures = 0
+
+    # Close the connections of the pass, the next pass starts with fresh ones
+    def close(self):
+        with self.lock:
+            senders, self.senders = self.senders, []
+        for sender in senders:
+            sender.close()
+        self.local = threading.local()
+        self.stats.finished = time.perf_counter()
+
+    def record(self, metrics):
+        metrics['targets'].append({'target': self.name, 'files_sent': self.stats.files_sent,
+                                   'bytes_sent': self.stats.bytes_sent, 'errors': len(self.stats.errors)})
+
+
+# Synchronizes one source into several local replicas and receivers at once
+# The source is walked once for all replicas and every changed file is read once, each chunk read is written
+# to every replica and sent to every receiver that needs the file
+# Every target has its own counters and progress, and a target that fails (a full disk, a receiver that is down)
+# only loses its own files while the others carry on
+# Receivers get the files copied to the replicas, like the single receiver of a SyncEngine
+# A job may also have receivers only: with no local replica to compare against, every pass sends the whole source
+# (with the watcher, only the changed paths)
+# Delta transfer, deduplication and resuming large copies need a single destination (see SyncEngine)
+class FanoutEngine(SyncEngine):
+    def __init__(self, src_dir, dst_dirs, receivers=(), delete=False, workers=DEFAULT_WORKERS, use_hash=False,
+                 dry_run=False, compression=None, log=None, log_file=LOG_FILE, progress=True, on_progress=None,
+                 bytes_per_s=None, ops_per_s=None, schedule=None):
+        if not dst_dirs and not receivers:
+            raise ValueError("A fan-out job needs a local destination or a receiver")
+        super().__init__(src_dir, dst_dirs[0] if dst_dirs else None, delete=delete, workers=workers,
+                         use_hash=use_hash, dry_run=dry_run, compression=compression, log=log, log_file=log_file,
+                         progress=progress, on_progress=on_progress, bytes_per_s=bytes_per_s, ops_per_s=ops_per_s,
+                         schedule=schedule)
+        if receivers:
+            # One limit for everything that is sent, so the receivers share the uplink
+            self.net_throttle = Throttle(bytes_per_s, ops_per_s, schedule)
+        self.local_targets = [LocalTarget(dst_dir) for dst_dir in dst_dirs]
+        self.receiver_targets = [ReceiverTarget(host, port, self.compression, self.net_throttle)
+                                 for host, port in receivers]
+
+    @property
+    def targets(self):
+        return self.local_targets + self.receiver_targets
+
+    # Check if the source directory exists and create the destinations if needed
+    def check_directories(self):
+        if not os.path.exists(self.src_dir):
+            self.log(f"Source directory '{self.src_dir}' does not exist.")
+            return False
+        for target in self.local_targets:
+            if os.path.exists(target.dst_dir):
+                continue
+            if self.dry_run:
+                self.log(f"Destination directory '{target.dst_dir}' would be created.")
+                continue
+            try:
+                os.makedirs(target.dst_dir)
+                self.log(f"Destination directory '{target.dst_dir}' created.")
+            except OSError as e:
+                # The other destinations are still synchronized, this one is skipped by the pass
+                self.log(f"Cannot create destination directory '{target.dst_dir}': {e}")
+        return True
+
+    # Synchronize every target, or with changes (relative paths reported by the watcher) only those paths
+    # Returns True if every file reached every target without errors
+    def sync(self, changes=None):
+        self.log_event("Dry run started." if self.dry_run else "Synchronization started.")
+        progress = SyncProgress()
+        self.publish_progress(progress)
+        started = time.monotonic()
+        ok = True
+        metrics = {'files_scanned': 0, 'files_copied': 0, 'files_deleted': 0, 'bytes_copied': 0, 'bytes_sent': 0,
+                   'errors': 0, 'throttled_seconds': 0.0, 'targets': []}
+
+        targets = []
+        for target in self.local_targets:
+            target.stats = CopyStats()
+            target.progress = SyncProgress()
+            try:
+                target.manifest = Manifest(target.dst_dir, use_hash=self.use_hash, read_only=self.dry_run)
+                targets.append(target)
+            except (OSError, sqlite3.Error) as e:
+                self.log(f"Skipping '{target.dst_dir}', its manifest cannot be opened: {e}")
+                metrics['errors'] += 1
+                ok = False
+        for target in self.receiver_targets:
+            target.stats = SendStats()
+            target.progress = SyncProgress()
+            target.failures = 0
+            target.down = False
+
+        try:
+            # One walk of the source for every replica, nothing is written before all plans are complete
+            plans = plan_fanout(self.src_dir, [target.dst_dir for target in targets],
+                                [target.manifest for target in targets], self.delete, changes)
+            for target, plan in zip(targets, plans):
+                target.plan = plan
+                for path, error in plan.errors:
+                    self.log(f"Error reading '{path}': {error}")
+                if self.dry_run:
+                    for line in plan.report():
+                        self.log(f"{target.name}: {line}")
+                self.log(f"{target.name}: {plan.summary()}")
+                metrics['errors'] += len(plan.errors)
+                ok = ok and not plan.errors
+            source_plan = None
+            if not self.local_targets:
+                source_plan = plan_source(self.src_dir, changes)
+                for path, error in source_plan.errors:
+                    self.log(f"Error reading '{path}': {error}")
+                if self.dry_run:
+                    for line in source_plan.report():
+                        self.log(f"Receivers: {line}")
+                self.log(f"Receivers: {source_plan.summary()}")
+                metrics['errors'] += len(source_plan.errors)
+                ok = ok and not source_plan.errors
+                plans = [source_plan]
+            if plans:
+                metrics['files_scanned'] = plans[0].unchanged + len(plans[0].copies)
+            if not self.dry_run and (targets or source_plan is not None):
+                ok = self._run_targets(targets, progress, metrics, source_plan) and ok
+            for target in targets:
+                try:
+                    target.manifest.commit()
+                except sqlite3.Error as e:
+                    self.log(f"Cannot save the manifest of '{target.dst_dir}': {e}")
+                    metrics['errors'] += 1
+                    ok = False
+        except Exception as e:
+            for target in targets:
+                target.manifest.rollback()
+            metrics['failure'] = str(e)
+            ok = False
+            raise
+        finally:
+            for target in targets:
+                target.manifest.close()
+                target.manifest = None
+                target.plan = None
+            for target in self.receiver_targets:
+                target.close()
+            progress.stage = DONE
+            self.publish_progress(progress)
+            if self.run_log is not None:
+                self.run_log.write('run', src=os.path.abspath(self.src_dir),
+                                   dst=[os.path.abspath(target.dst_dir) for target in self.local_targets] +
+                                   [target.name for target in self.receiver_targets],
+                                   dry_run=self.dry_run, changed_paths=None if changes is None else len(changes), ok=ok,
+                                   duration=round(time.monotonic() - started, 3), **metrics)
+
+        self.log_event("Dry run completed." if self.dry_run else "Synchronization completed.")
+        return ok
+
+    # Remove and create what each replica needs, then copy every changed file once to all targets that need it
+    # Without local replicas the files of source_plan are only sent to the receivers
+    def _run_targets(self, targets, progress, metrics, source_plan=None):
+        throttled_before = self.throttle.throttled_seconds
+        net_throttled_before = self.net_throttle.throttled_seconds if self.net_throttle is not None else 0.0
+
+        for target in targets:
+            for rel_path, is_dir in target.plan.deletes:
+                if self.stopped.is_set():
+                    break
+                self.throttle.operation()
+                try:
+                    remove_replica(target.dst_dir, rel_path, is_dir, target.manifest)
+                    metrics['files_deleted'] += 1
+                except OSError as e:
+                    target.stats.add_error(os.path.join(target.dst_dir, rel_path), e)
+            for rel_path in target.plan.mkdirs:
+                self.throttle.operation()
+                try:
+                    os.makedirs(os.path.join(target.dst_dir, rel_path), exist_ok=True)
+                except OSError as e:
+                    target.stats.add_error(os.path.join(self.src_dir, rel_path), e)
+
+        # Every changed file once, with the replicas that need it and their stat (None when there is no replica)
+        copies = {}
+        if source_plan is not None:
+            for rel_path, src_st, dst_st in source_plan.copies:
+                copies[rel_path] = (src_st, [])
+        for target in targets:
+            for rel_path, src_st, dst_st in target.plan.copies:
+                copies.setdefault(rel_path, (src_st, []))[1].append((target, dst_st))
+        total_bytes = sum(src_st.st_size for src_st, replicas in copies.values())
+
+        progress.stage = COPYING
+        progress.total_files = len(copies)
+        progress.total_bytes = total_bytes
+        progress.started = time.monotonic()
+        for target in targets:
+            target.progress = SyncProgress(COPYING, len(target.plan.copies), target.plan.bytes_to_copy)
+        for target in self.receiver_targets:
+            target.progress = SyncProgress(COPYING, len(copies), total_bytes)
+
+        # One bar per target, so a slow or failing one stands out
+        bars = [tqdm(total=target.progress.total_files, desc=target.name, unit="file", position=i,
+                     disable=not self.progress) for i, target in enumerate(targets + self.receiver_targets)]
+        bar_of = dict(zip(targets + self.receiver_targets, bars))
+
+        # Function to count a file handled for one target, called from the copy threads
+        def on_target_progress(target, source_path, size):
+            bar_of[target].update(1)
+            target.progress.advance(source_path, size)
+
+        slots = threading.BoundedSemaphore(DEFAULT_QUEUE_SIZE)
+
+        # _copy_to_targets handles OSError and ProtocolError itself, anything else it raises fails the file
+        # for every target that should have got it, so no replica falls behind unnoticed
+        def finished(future, rel_path, replicas):
+            slots.release()
+            error = future.exception()
+            if error is None:
+                return
+            source_path = os.path.join(self.src_dir, rel_path)
+            for target, _ in replicas:
+                target.stats.add_error(source_path, error)
+                target.stats.add_check()
+            for target in self.receiver_targets:
+                if not target.down:
+                    target.stats.add_error(source_path, error)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="sync-fanout") as pool:
+                for rel_path, (src_st, replicas) in copies.items():
+                    if self.stopped.is_set():
+                        break
+                    slots.acquire()
+                    future = pool.submit(self._copy_to_targets, rel_path, src_st, replicas, progress,
+                                         on_target_progress)
+                    future.add_done_callback(lambda f, rel_path=rel_path, replicas=replicas:
+                                             finished(f, rel_path, replicas))
+        finally:
+            for bar in bars:
+                bar.close()
+
+        ok = True
+        for target in targets:
+            target.stats.finished = time.perf_counter()
+            for source_path, error in target.stats.errors:
+                self.log(f"Error copying '{source_path}' to '{target.dst_dir}': {error}")
+            self.log(f"{target.name}: {target.stats.summary()}")
+            metrics['files_copied'] += target.stats.files_copied
+            metrics['bytes_copied'] += target.stats.bytes_copied
+            metrics['errors'] += len(target.stats.errors)
+            ok = ok and not target.stats.errors
+            target.record(metrics)
+        for target in self.receiver_targets:
+            target.close()
+            for file_path, error in target.stats.errors:
+                self.log(f"Error sending '{file_path}' to {target.name}: {error}")
+            self.log(f"{target.stats.summary()} to {target.name}.")
+            metrics['bytes_sent'] += target.stats.bytes_sent
+            metrics['errors'] += len(target.stats.errors)
+            ok = ok and not target.stats.errors
+            target.record(metrics)
+
+        throttled = self.throttle.throttled_seconds - throttled_before
+        net_throttled = 0.0
+        if self.net_throttle is not None:
+            net_throttled = self.net_throttle.throttled_seconds - net_throttled_before
+        if throttled or net_throttled:
+            self.log(f"Throttled for {throttled:.1f} s copying and {net_throttled:.1f} s sending.")
+        metrics['throttled_seconds'] += round(throttled + net_throttled, 3)
+        return ok
+
+    # Read one source file once and write every chunk to the replicas and receivers that need it
+    # An error writing to one target drops only that target from this file
+    def _copy_to_targets(self, rel_path, src_st, replicas, progress, on_target_progress):
+        source_path = os.path.join(self.src_dir, rel_path)
+        size = src_st.st_size
+        writers = []  # (target, partial file, replica path)
+        streams = []  # (target, FileStream)
+        done = []  # Targets that are finished with this file, whatever the outcome
+
+        try:
+            for target, dst_st in replicas:
+                self.throttle.operation()
+                replica_path = os.path.join(target.dst_dir, rel_path)
+                try:
+                    if dst_st is not None and not target.manifest.needs_copy(rel_path, source_path, replica_path,
+                                                                             src_st, dst_st):
+                        target.stats.add_check()
+                        done.append(target)
+                        continue
+                    if dst_st is not None and dst_st.st_nlink > 1:
+                        # The replica shares its inode with other files, it is replaced instead of rewritten
+                        os.remove(replica_path)
+                    writers.append((target, open(partial_path(replica_path), 'wb'), replica_path))
+                except OSError as e:
+                    target.stats.add_error(source_path, e)
+                    target.stats.add_check()
+                    done.append(target)
+
+            with open(source_path, 'rb', buffering=0) as f:
+                # Receivers only get what the replicas really needed, like with a single destination
+                if writers or not self.local_targets:
+                    compress = bool(self.compression) and worth_compressing(source_path, f, size)
+                    f.seek(0)
+                    for target in self.receiver_targets:
+                        if target.down:
+                            continue
+                        try:
+                            stream = target.sender().stream_file(rel_path, os.fstat(f.fileno()), compress)
+                            streams.append((target, stream))
+                        except (OSError, ProtocolError) as e:
+                            self._receiver_failed(target, source_path, e)
+
+                digest = new_digest()
+                view = memoryview(bytearray(COPY_CHUNK_SIZE))
+                position = 0
+                while writers or streams:
+                    n = f.readinto(view)
+                    if not n:
+                        break
+                    chunk = view[:n]
+                    self.throttle.consume(n)
+                    digest.update(chunk)
+                    position += n
+                    for writer in list(writers):
+                        try:
+                            writer[1].write(chunk)
+                        except OSError as e:
+                            writers.remove(writer)
+                            self._drop_writer(writer, source_path, e, done)
+                    for stream in list(streams):
+                        try:
+                            stream[1].write(chunk)
+                        except (OSError, ProtocolError) as e:
+                            streams.remove(stream)
+                            stream[1].abort()
+                            self._receiver_failed(stream[0], source_path, e)
+                if position != size and (writers or streams):
+                    raise OSError(f"'{source_path}' changed size while it was being copied")
+        except OSError as e:
+            # The source could not be read, no target gets the file
+            for writer in writers:
+                self._drop_writer(writer, source_path, e, done)
+            for target, stream in streams:
+                stream.abort()
+                target.stats.add_error(source_path, e)
+            writers, streams = [], []
+
+        for writer in writers:
+            target, out, replica_path = writer
+            try:
+                out.close()
+                shutil.copystat(source_path, partial_path(replica_path))
+                os.replace(partial_path(replica_path), replica_path)
+                target.manifest.record_copy(rel_path, source_path, replica_path, src_st,
+                                            digest.hexdigest() if self.use_hash else None)
+                target.manifest.checkpoint()
+                target.stats.add_copy(size)
+                target.stats.add_check()
+                done.append(target)
+            except OSError as e:
+                self._drop_writer(writer, source_path, e, done)
+        for target, stream in streams:
+            try:
+                job = SendJob(source_path, rel_path, size)
+                job.sent = stream.finish(digest.digest())
+                target.add_sent(job)
+            except (OSError, ProtocolError) as e:
+                self._receiver_failed(target, source_path, e)
+
+        for target in done + self.receiver_targets:
+            on_target_progress(target, source_path, size)
+        progress.advance(source_path, size)
+        self.publish_progress(progress)
+
+    # Give up on the partial replica of one target, the target is done with this file
+    def _drop_writer(self, writer, source_path, error, done):
+        target, out, replica_path = writer
+        try:
+            out.close()
+        except OSError:
+            pass
+        try:
+            os.unlink(partial_path(replica_path))
+        except OSError:
+            pass
+        target.stats.add_error(source_path, error)
+        target.stats.add_check()
+        done.append(target)
+
+    def _receiver_failed(self, target, source_path, error):
+        if target.add_failure(source_path, error):
+            self.log(f"Receiver {target.name} keeps failing, leaving it out for the rest of the pass: {error}")
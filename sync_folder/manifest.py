@@ -0,0 +1,256 @@
+import filecmp
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+# Name of the manifest file kept in the root of the replica
+MANIFEST_NAME = ".sync_manifest.db"
+
+# Size of the chunks read when hashing file contents
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# While a pass is running the recorded state is committed at least this often, so a crash loses little of it
+CHECKPOINT_INTERVAL = 5.0
+
+
+# Function to compute a streaming content hash of a file
+def file_digest(path):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Function to build the stat tuple used to detect changes
+def stat_key(st):
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+# Function to check if a replica path belongs to the manifest itself
+def is_manifest_path(dst_dir, path):
+    return os.path.dirname(os.path.abspath(path)) == os.path.abspath(dst_dir) and \
+        os.path.basename(path).startswith(MANIFEST_NAME)
+
+
+# Persistent record of the file state seen at the last successful sync
+# A read-only manifest (used for dry runs) never writes, and is empty if the replica has none yet
+class Manifest:
+    def __init__(self, dst_dir, use_hash=False, read_only=False):
+        self.dst_dir = dst_dir
+        self.path = os.path.join(dst_dir, MANIFEST_NAME)
+        self.use_hash = use_hash
+        self.read_only = read_only
+        self.lock = threading.Lock()
+        if not read_only:
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        elif os.path.exists(self.path):
+            uri = f"file:{urllib.parse.quote(os.path.abspath(self.path))}?mode=ro"
+            self.conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            self.conn = sqlite3.connect(':memory:', check_same_thread=False)
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                src_size INTEGER,
+                src_mtime_ns INTEGER,
+                src_inode INTEGER,
+                dst_size INTEGER,
+                dst_mtime_ns INTEGER,
+                dst_inode INTEGER,
+                digest TEXT
+            )
+        ''')
+        if not read_only:
+            # Copies that were interrupted: how far the partial replica of this version of the source got
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS partial (
+                    path TEXT PRIMARY KEY,
+                    src_size INTEGER,
+                    src_mtime_ns INTEGER,
+                    src_inode INTEGER,
+                    offset INTEGER
+                )
+            ''')
+            # Lets identical content be found by its size and hash
+            self.conn.execute('CREATE INDEX IF NOT EXISTS files_content ON files (dst_size, digest)')
+        self.conn.commit()
+        self.last_commit = time.monotonic()
+
+    def lookup(self, rel_path):
+        with self.lock:
+            return self.conn.execute('SELECT * FROM files WHERE path = ?', (rel_path,)).fetchone()
+
+    # Check if both stat tuples still match what was recorded, which proves the replica is up to date
+    def is_unchanged(self, rel_path, src_st, dst_st):
+        row = self.lookup(rel_path)
+        return row is not None and tuple(row[1:4]) == stat_key(src_st) and tuple(row[4:7]) == stat_key(dst_st)
+
+    # Decide whether the replica has to be rewritten, opening files only when the stat tuples changed
+    def needs_copy(self, rel_path, source_path, replica_path, src_st=None, dst_st=None):
+        if src_st is None:
+            src_st = os.stat(source_path)
+        if dst_st is None:
+            try:
+                dst_st = os.stat(replica_path)
+            except FileNotFoundError:
+                return True
+
+        row = self.lookup(rel_path)
+        replica_known = row is not None and tuple(row[4:7]) == stat_key(dst_st)
+        if replica_known and tuple(row[1:4]) == stat_key(src_st):
+            return False
+        if src_st.st_size != dst_st.st_size:
+            return True
+
+        # Only the source was touched: its hash tells if the content really changed
+        if self.use_hash and replica_known and row[7]:
+            digest = file_digest(source_path)
+            if digest != row[7]:
+                return True
+            self.record(rel_path, src_st, dst_st, digest)
+            return False
+
+        if not filecmp.cmp(source_path, replica_path, shallow=False):
+            return True
+        self.record(rel_path, src_st, dst_st)
+        return False
+
+    def record(self, rel_path, src_st, dst_st, digest=None):
+        if self.read_only:
+            return
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              (rel_path, *stat_key(src_st), *stat_key(dst_st), digest))
+
+    # Record a freshly copied file, digest is the hash of what was written if the copy already computed it
+    def record_copy(self, rel_path, source_path, replica_path, src_st=None, digest=None):
+        if src_st is None:
+            src_st = os.stat(source_path)
+        if digest is None and self.use_hash:
+            digest = file_digest(replica_path)
+        self.record(rel_path, src_st, os.stat(replica_path), digest)
+
+    # Record the hash of every replica recorded without one, returns how many were hashed
+    # Used when content-addressed mode is turned on for an existing replica: unchanged files are never read again,
+    # so without this they could not be linked to or recognized as renamed
+    def backfill_digests(self):
+        if self.read_only:
+            return 0
+        with self.lock:
+            rows = self.conn.execute('SELECT path, dst_size, dst_mtime_ns, dst_inode FROM files '
+                                     'WHERE digest IS NULL').fetchall()
+        hashed = 0
+        for rel_path, *recorded in rows:
+            replica_path = os.path.join(self.dst_dir, rel_path)
+            try:
+                if stat_key(os.stat(replica_path)) != tuple(recorded):
+                    continue  # Changed since it was recorded, the pass compares it anyway
+                digest = file_digest(replica_path)
+            except OSError:
+                continue
+            with self.lock:
+                self.conn.execute('UPDATE files SET digest = ? WHERE path = ? AND digest IS NULL',
+                                  (digest, rel_path))
+            hashed += 1
+        return hashed
+
+    # Check if any replica of this size has a recorded hash, only then is hashing a file for a match worth it
+    def has_content_of_size(self, size):
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM files WHERE dst_size = ? AND digest IS NOT NULL LIMIT 1',
+                                     (size,)).fetchone() is not None
+
+    # Find a replica that still holds the content with this size and hash, returns its relative path or None
+    def find_replica(self, size, digest):
+        with self.lock:
+            rows = self.conn.execute('SELECT path, dst_size, dst_mtime_ns, dst_inode FROM files '
+                                     'WHERE dst_size = ? AND digest = ?', (size, digest)).fetchall()
+        for rel_path, *recorded in rows:
+            try:
+                # A replica changed since it was recorded may not hold that content any more
+                if stat_key(os.stat(os.path.join(self.dst_dir, rel_path))) == tuple(recorded):
+                    return rel_path
+            except OSError:
+                pass
+        return None
+
+    # Return (path, dst_size, dst_mtime_ns, dst_inode, digest) of a path and everything recorded below it
+    def entries(self, rel_path):
+        with self.lock:
+            return self.conn.execute('SELECT path, dst_size, dst_mtime_ns, dst_inode, digest FROM files '
+                                     'WHERE path = ? OR (path >= ? AND path < ?)',
+                                     (rel_path, rel_path + os.sep, rel_path + chr(ord(os.sep) + 1))).fetchall()
+
+    def forget(self, rel_path):
+        if self.read_only:
+            return
+        # Entries below a deleted directory sort between "dir/" and "dir0"
+        with self.lock:
+            for table in ('files', 'partial'):
+                self.conn.execute(f'DELETE FROM {table} WHERE path = ? OR (path >= ? AND path < ?)',
+                                  (rel_path, rel_path + os.sep, rel_path + chr(ord(os.sep) + 1)))
+
+    # Return how many bytes of this version of the source an interrupted copy already wrote, 0 if none
+    def partial_offset(self, rel_path, src_st):
+        if self.read_only:
+            return 0
+        with self.lock:
+            row = self.conn.execute('SELECT src_size, src_mtime_ns, src_inode, offset FROM partial WHERE path = ?',
+                                    (rel_path,)).fetchone()
+        if row is None or tuple(row[:3]) != stat_key(src_st):
+            return 0
+        return row[3]
+
+    # Record the progress of a large copy, committed at once so it survives a crash
+    def record_partial(self, rel_path, src_st, offset):
+        if self.read_only:
+            return
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO partial VALUES (?, ?, ?, ?, ?)',
+                              (rel_path, *stat_key(src_st), offset))
+            self.conn.commit()
+            self.last_commit = time.monotonic()
+
+    # Record that a replica is about to be patched in place, committed at once so it survives a crash
+    # Its entry is dropped, so if the patch is interrupted the next pass compares the replica with the source
+    # instead of trusting its stat, and the partial entry (with nothing to resume) is left until the patch is done
+    def record_patching(self, rel_path, src_st):
+        if self.read_only:
+            return
+        with self.lock:
+            self.conn.execute('DELETE FROM files WHERE path = ?', (rel_path,))
+            self.conn.execute('INSERT OR REPLACE INTO partial VALUES (?, ?, ?, ?, ?)',
+                              (rel_path, *stat_key(src_st), 0))
+            self.conn.commit()
+            self.last_commit = time.monotonic()
+
+    def forget_partial(self, rel_path):
+        if self.read_only:
+            return
+        with self.lock:
+            self.conn.execute('DELETE FROM partial WHERE path = ?', (rel_path,))
+
+    # Make the recorded state durable, called once a sync pass has finished
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.last_commit = time.monotonic()
+
+    # Commit if the last commit is older than CHECKPOINT_INTERVAL, called after every finished file
+    # Everything recorded is true of the replica, so a pass that dies later does not have to redo it
+    def checkpoint(self):
+        if self.read_only or time.monotonic() - self.last_commit < CHECKPOINT_INTERVAL:
+            return
+        self.commit()
+
+    def rollback(self):
+        with self.lock:
+            self.conn.rollback()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,300 @@
+import os
+import stat
+
+from manifest import MANIFEST_NAME, file_digest, stat_key
+from resumable import is_partial_name, partial_target
+from watcher import coalesce
+
+
+# Everything a sync pass has to do, worked out before anything is written
+# mkdirs: relative directories to create, parents first
+# copies: (relative path, source stat, replica stat or None when there is no replica) of files to compare or copy
+# deletes: (relative path, is directory) of replicas to remove, a directory covers everything below it
+# moves: (old relative path, new relative path, source stat, digest) of renamed files, see detect_moves()
+# digests: source hashes worked out while planning, duplicates: copies with the same content as an earlier
+# copy of the plan, see group_duplicates()
+class SyncPlan:
+    def __init__(self):
+        self.mkdirs = []
+        self.copies = []
+        self.deletes = []
+        self.moves = []
+        self.digests = {}
+        self.duplicates = set()
+        self.unchanged = 0
+        self.errors = []
+
+    # Append the actions of a plan made for another part of the tree
+    def extend(self, other):
+        self.mkdirs.extend(other.mkdirs)
+        self.copies.extend(other.copies)
+        self.deletes.extend(other.deletes)
+        self.moves.extend(other.moves)
+        self.digests.update(other.digests)
+        self.duplicates.update(other.duplicates)
+        self.unchanged += other.unchanged
+        self.errors.extend(other.errors)
+
+    @property
+    def bytes_to_copy(self):
+        return sum(src_st.st_size for rel_path, src_st, dst_st in self.copies)
+
+    # Lines describing every planned action, used as the dry-run report
+    def report(self):
+        for old_path, rel_path, src_st, digest in self.moves:
+            yield f"move   {old_path} -> {rel_path}"
+        for rel_path, is_dir in self.deletes:
+            yield f"delete {rel_path}{os.sep if is_dir else ''}"
+        for rel_path in self.mkdirs:
+            yield f"mkdir  {rel_path}{os.sep}"
+        for rel_path, src_st, dst_st in self.copies:
+            yield f"copy   {rel_path} ({'new' if dst_st is None else 'changed'}, {src_st.st_size} bytes)"
+
+    def summary(self):
+        return (f"Plan: {len(self.mkdirs)} directories to create, {len(self.copies)} files to copy "
+                f"({self.bytes_to_copy / (1024 * 1024):.1f} MB), {len(self.moves)} to move, "
+                f"{len(self.deletes)} to delete, {self.unchanged} unchanged")
+
+
+# Function to list a directory sorted by name, the listing is empty if the directory does not exist
+def scan_dir(plan, path):
+    try:
+        with os.scandir(path) as entries:
+            return sorted(entries, key=lambda entry: entry.name)
+    except FileNotFoundError:
+        return []
+    except OSError as e:
+        plan.errors.append((path, e))
+        return []
+
+
+# Function to plan one path that exists in the source
+# dst_is_dir is None when there is no replica, subdirs collects the directories to descend into
+def _plan_source(plan, subdirs, manifest, rel_path, src_is_dir, src_st, dst_is_dir, dst_st, descend=True):
+    if dst_is_dir is not None and src_is_dir != dst_is_dir:
+        # A file became a directory or the other way round: the replica has to make room
+        plan.deletes.append((rel_path, dst_is_dir))
+        dst_is_dir = dst_st = None
+    if src_is_dir:
+        if dst_is_dir is None:
+            plan.mkdirs.append(rel_path)
+        if descend:
+            subdirs.append((rel_path, dst_is_dir is not None))
+    elif dst_st is not None and manifest.is_unchanged(rel_path, src_st, dst_st):
+        plan.unchanged += 1
+    else:
+        plan.copies.append((rel_path, src_st, dst_st))
+
+
+# Function to plan one directory from the sorted listings of the source and of its replica, merged in step
+# Every entry is stat'ed once, subdirs collects (relative path, replica exists) of the directories to descend into
+def merge_dir(plan, subdirs, src_dir, manifest, delete, rel_dir, src_entries, dst_entries):
+    i = j = 0
+    while i < len(src_entries) or j < len(dst_entries):
+        src = src_entries[i] if i < len(src_entries) else None
+        dst = dst_entries[j] if j < len(dst_entries) else None
+        if dst is None or (src is not None and src.name < dst.name):
+            dst = None
+            i += 1
+        elif src is None or dst.name < src.name:
+            src = None
+            j += 1
+        else:
+            i += 1
+            j += 1
+
+        name = src.name if src is not None else dst.name
+        if not rel_dir and name.startswith(MANIFEST_NAME):
+            continue
+        rel_path = os.path.join(rel_dir, name)
+        if src is None and is_partial_name(name):
+            # An unfinished copy is kept for the next pass to resume, unless its source is gone
+            if delete and not any(entry.name == partial_target(name) for entry in src_entries):
+                plan.deletes.append((rel_path, False))
+            continue
+        try:
+            dst_is_dir = dst.is_dir(follow_symlinks=False) if dst is not None else None
+            if src is None:
+                if delete:
+                    plan.deletes.append((rel_path, dst_is_dir))
+                continue
+            src_is_dir = src.is_dir()
+            # Like os.walk, linked directories are created but not followed
+            _plan_source(plan, subdirs, manifest, rel_path, src_is_dir,
+                         None if src_is_dir else src.stat(),
+                         dst_is_dir, None if dst is None or dst_is_dir else dst.stat(),
+                         descend=not src.is_symlink())
+        except OSError as e:
+            plan.errors.append((os.path.join(src_dir, rel_path), e))
+
+
+# Function to walk a source directory and its replica together, one directory at a time
+# Nothing below a replica directory that goes away is visited
+def _merge_tree(plan, src_dir, dst_dir, manifest, delete, rel_root, replica_exists):
+    pending = [(rel_root, replica_exists)]
+    while pending:
+        rel_dir, replica_exists = pending.pop()
+        src_entries = scan_dir(plan, os.path.join(src_dir, rel_dir))
+        dst_entries = scan_dir(plan, os.path.join(dst_dir, rel_dir)) if replica_exists else []
+        subdirs = []
+        merge_dir(plan, subdirs, src_dir, manifest, delete, rel_dir, src_entries, dst_entries)
+        # Popped in reverse, so directories are visited in name order and their parents always come first
+        pending.extend(reversed(subdirs))
+
+
+# Function to plan a single changed path reported by the watcher
+def _plan_change(plan, src_dir, dst_dir, manifest, delete, rel_path):
+    source_path = os.path.join(src_dir, rel_path)
+    replica_path = os.path.join(dst_dir, rel_path)
+    try:
+        src_st = os.stat(source_path)
+    except FileNotFoundError:
+        if delete and os.path.lexists(replica_path):
+            plan.deletes.append((rel_path, os.path.isdir(replica_path) and not os.path.islink(replica_path)))
+        return
+
+    try:
+        dst_st = os.lstat(replica_path)
+        dst_is_dir = stat.S_ISDIR(dst_st.st_mode)
+        dst_st = None if dst_is_dir else os.stat(replica_path)
+    except FileNotFoundError:
+        dst_is_dir = dst_st = None
+        parent = os.path.dirname(rel_path)
+        if parent and not os.path.isdir(os.path.join(dst_dir, parent)):
+            plan.mkdirs.append(parent)
+
+    src_is_dir = stat.S_ISDIR(src_st.st_mode)
+    subdirs = []
+    _plan_source(plan, subdirs, manifest, rel_path, src_is_dir, None if src_is_dir else src_st, dst_is_dir, dst_st,
+                 descend=not os.path.islink(source_path))
+    for rel_dir, replica_exists in subdirs:
+        _merge_tree(plan, src_dir, dst_dir, manifest, delete, rel_dir, replica_exists)
+
+
+# Function to work out what a sync pass has to do
+# With changes (relative paths reported by the watcher) only those paths and what is below them are planned
+def plan_sync(src_dir, dst_dir, manifest, delete=False, changes=None):
+    plan = SyncPlan()
+    if changes is None or '' in changes:
+        _merge_tree(plan, src_dir, dst_dir, manifest, delete, '', os.path.isdir(dst_dir))
+        return plan
+    for rel_path in coalesce(changes):
+        if rel_path.startswith(MANIFEST_NAME):
+            continue
+        try:
+            _plan_change(plan, src_dir, dst_dir, manifest, delete, rel_path)
+        except OSError as e:
+            plan.errors.append((os.path.join(src_dir, rel_path), e))
+    return plan
+
+
+# Function to plan sending a source that has no local replica: every file, or every changed one, is a copy
+# Used by fan-out jobs with receivers only, nothing locally tells what the receivers already have
+def plan_source(src_dir, changes=None):
+    plan = SyncPlan()
+    for rel_path in [''] if changes is None or '' in changes else coalesce(changes):
+        if rel_path.startswith(MANIFEST_NAME):
+            continue
+        source_path = os.path.join(src_dir, rel_path)
+        try:
+            src_st = os.stat(source_path)
+            if not stat.S_ISDIR(src_st.st_mode):
+                plan.copies.append((rel_path, src_st, None))
+            elif not rel_path or not os.path.islink(source_path):
+                _merge_tree(plan, src_dir, None, None, False, rel_path, False)
+        except FileNotFoundError:
+            # Receivers are never asked to delete, a path that went away is simply not sent
+            continue
+        except OSError as e:
+            plan.errors.append((source_path, e))
+    return plan
+
+
+# Function to plan several replicas of one source with a single walk of the source, returns a SyncPlan per replica
+# Every source directory is listed and every source entry stat'ed once however many replicas there are,
+# the listings are merged with the replica listings one after the other
+def plan_fanout(src_dir, dst_dirs, manifests, delete=False, changes=None):
+    if changes is not None and '' not in changes:
+        # The watcher reported a few paths, those are cheap enough to plan for each replica on its own
+        return [plan_sync(src_dir, dst_dir, manifest, delete, changes)
+                for dst_dir, manifest in zip(dst_dirs, manifests)]
+
+    plans = [SyncPlan() for _ in dst_dirs]
+    # Relative directory and, for each replica, if it exists there (None where the replica does not descend)
+    pending = [('', [os.path.isdir(dst_dir) for dst_dir in dst_dirs])]
+    while pending:
+        rel_dir, replicas_exist = pending.pop()
+        source = SyncPlan()
+        src_entries = scan_dir(source, os.path.join(src_dir, rel_dir))
+        children = {}
+        for i, (plan, dst_dir, manifest) in enumerate(zip(plans, dst_dirs, manifests)):
+            if replicas_exist[i] is None:
+                continue
+            plan.errors.extend(source.errors)
+            dst_entries = scan_dir(plan, os.path.join(dst_dir, rel_dir)) if replicas_exist[i] else []
+            subdirs = []
+            merge_dir(plan, subdirs, src_dir, manifest, delete, rel_dir, src_entries, dst_entries)
+            for rel_path, replica_exists in subdirs:
+                children.setdefault(rel_path, [None] * len(dst_dirs))[i] = replica_exists
+        pending.extend(reversed(list(children.items())))
+    return plans
+
+
+# Function to turn a new file and a deleted replica with the same content into a move
+# Only new files with the size of a deleted replica that has a recorded hash are hashed
+def detect_moves(plan, manifest, src_dir):
+    deleted = {}  # (size, digest) -> recorded rows of replicas that are about to be deleted
+    for rel_path, is_dir in plan.deletes:
+        for path, size, mtime_ns, inode, digest in manifest.entries(rel_path):
+            if digest:
+                deleted.setdefault((size, digest), []).append((path, (size, mtime_ns, inode)))
+    if not deleted:
+        return
+    sizes = {size for size, digest in deleted}
+
+    copies = []
+    for rel_path, src_st, dst_st in plan.copies:
+        if dst_st is None and src_st.st_size in sizes:
+            try:
+                digest = file_digest(os.path.join(src_dir, rel_path))
+            except OSError:
+                digest = None
+            candidates = deleted.get((src_st.st_size, digest))
+            while candidates:
+                old_path, recorded = candidates.pop()
+                try:
+                    unchanged = stat_key(os.stat(os.path.join(manifest.dst_dir, old_path))) == recorded
+                except OSError:
+                    unchanged = False
+                if unchanged:
+                    plan.moves.append((old_path, rel_path, src_st, digest))
+                    break
+            else:
+                copies.append((rel_path, src_st, dst_st))
+            continue
+        copies.append((rel_path, src_st, dst_st))
+    plan.copies = copies
+
+
+# Function to find the copies of a plan that have the same content, so only one of each group is copied
+# Only files sharing their size with another copy are hashed; the first file of a group is copied as usual and
+# the others become duplicates, which the copy engine links to it once it is done (see CopyEngine.sync)
+def group_duplicates(plan, src_dir):
+    by_size = {}
+    for rel_path, src_st, dst_st in plan.copies:
+        if src_st.st_size:
+            by_size.setdefault(src_st.st_size, []).append(rel_path)
+    first_copies = set()
+    for size, rel_paths in by_size.items():
+        if len(rel_paths) < 2:
+            continue
+        for rel_path in rel_paths:
+            try:
+                digest = file_digest(os.path.join(src_dir, rel_path))
+            except OSError:
+                continue
+            plan.digests[rel_path] = digest
+            if (size, digest) in first_copies:
+                plan.duplicates.add(rel_path)
+            else:
+                first_copies.add((size, digest))
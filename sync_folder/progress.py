@@ -0,0 +1,111 @@
+import queue
+import threading
+import time
+from datetime import datetime
+
+# The GUI reads the channel this many times per second, progress is not published more often than that
+FRAME_RATE = 25
+
+# Stages of a sync pass
+PLANNING = 'planning'
+COPYING = 'copying'
+DONE = 'done'
+
+
+# Function to format a number of seconds as h:mm:ss
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+# Progress of the running sync pass, advanced by the copy threads
+class SyncProgress:
+    def __init__(self, stage=PLANNING, total_files=0, total_bytes=0):
+        self.lock = threading.Lock()
+        self.stage = stage
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.files_done = 0
+        self.bytes_done = 0
+        self.current_path = None
+        self.started = time.monotonic()
+
+    def advance(self, path, size):
+        with self.lock:
+            self.files_done += 1
+            self.bytes_done += size
+            self.current_path = path
+
+    # Fraction of the pass that is done, by bytes if there are any and by files otherwise
+    @property
+    def fraction(self):
+        if self.stage == DONE:
+            return 1.0
+        if self.total_bytes:
+            return min(self.bytes_done / self.total_bytes, 1.0)
+        return min(self.files_done / self.total_files, 1.0) if self.total_files else 0.0
+
+    # Estimated seconds left, None until there is something to go by
+    @property
+    def eta(self):
+        fraction = self.fraction
+        if self.stage != COPYING or not fraction:
+            return None
+        return (time.monotonic() - self.started) * (1 - fraction) / fraction
+
+    # A copy that stays consistent while the copy threads keep going
+    def snapshot(self):
+        with self.lock:
+            copy = SyncProgress(self.stage, self.total_files, self.total_bytes)
+            copy.files_done = self.files_done
+            copy.bytes_done = self.bytes_done
+            copy.current_path = self.current_path
+            copy.started = self.started
+        return copy
+
+    def describe(self):
+        if self.stage == PLANNING:
+            return "Comparing the directories..."
+        text = (f"{self.files_done} of {self.total_files} files, {self.bytes_done / (1024 * 1024):.1f} of "
+                f"{self.total_bytes / (1024 * 1024):.1f} MB")
+        if self.stage == DONE:
+            return f"{text}, done in {format_duration(time.monotonic() - self.started)}"
+        if self.eta is not None:
+            text += f", {format_duration(self.eta)} left"
+        return f"{text}: {self.current_path}" if self.current_path else text
+
+
+# Thread-safe channel from the sync thread to the GUI, which drains it once per frame
+# Log lines are all delivered, progress only as often as the GUI can show it
+class ProgressChannel:
+    def __init__(self, frame_rate=FRAME_RATE):
+        self.events = queue.Queue()
+        self.interval = 1.0 / frame_rate
+        self.last_published = 0.0
+
+    # Used as the log callback of the engine, may be called from any thread
+    def log(self, message):
+        self.events.put(('log', f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {message}\n"))
+
+    # Used as the progress callback of the engine, may be called from any thread
+    def publish(self, progress):
+        now = time.monotonic()
+        if progress.stage == COPYING and now - self.last_published < self.interval:
+            return
+        self.last_published = now
+        self.events.put(('progress', progress.snapshot()))
+
+    # Take up to max_lines log lines and the latest progress (None if there is none) without blocking
+    def drain(self, max_lines):
+        lines = []
+        progress = None
+        while len(lines) < max_lines:
+            try:
+                kind, payload = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == 'log':
+                lines.append(payload)
+            else:
+                progress = payload
+        return lines, progress
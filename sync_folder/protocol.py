@@ -0,0 +1,471 @@
+import hashlib
+import json
+import os
+import socket
+import stat
+import struct
+import time
+
+from delta import BLOCK_ENTRY, COPY, DATA, DELTA_BLOCK_SIZE, DELTA_MIN_SIZE, Signature, compute_delta, literal_bytes
+from resumable import RESUME_MIN_SIZE
+from stream_compression import CODECS, CompressionStats, worth_compressing
+
+# Default port of the receiver (non-privileged ports are > 1023)
+DEFAULT_PORT = 65432
+
+# Every frame starts with the message type and the length of its JSON header
+FRAME_HEADER = struct.Struct('!BI')
+
+# Files are streamed in chunks of this size and followed by a blake2b digest of their content
+CHUNK_SIZE = 1024 * 1024
+DIGEST_SIZE = 20
+
+# socket.sendfile only avoids copying through user space where the OS has sendfile
+HAS_SENDFILE = hasattr(os, 'sendfile')
+
+# With sendfile the range is hashed and sent in windows of this size, so the page cache is still hot
+SENDFILE_WINDOW = 8 * 1024 * 1024
+
+# A compressed payload is a series of pieces, each prefixed with its length, ended by an empty piece
+PIECE_HEADER = struct.Struct('!I')
+
+# Message types
+# header: path, size, mode, mtime_ns, codec (if compressed), resumable and offset (for large files);
+# payload: file content from offset on; trailer: digest of the whole file
+MSG_FILE = 1
+MSG_ACK = 2  # header: ok, error
+MSG_SIGNATURE_REQUEST = 3  # header: path, block_size
+MSG_SIGNATURE = 4  # header: count; payload: packed block entries
+MSG_DELTA = 5  # header: path, size, mode, mtime_ns, block_size, ops; payload: literal bytes; trailer: digest
+MSG_HELLO = 6  # header: compression (codecs offered by the sender, or the one chosen by the receiver)
+MSG_RESUME_REQUEST = 7  # header: path, size, mtime_ns
+MSG_RESUME = 8  # header: offset (bytes of this version of the file the receiver already has)
+
+# Upper limit for a JSON header, large enough for the op list of a delta
+MAX_HEADER_SIZE = 64 * 1024 * 1024
+
+OP_CODES = {COPY: 0, DATA: 1}
+OP_KINDS = {code: kind for kind, code in OP_CODES.items()}
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# A single file could not be sent or was refused by the receiver, but the connection is still usable
+class FileRejected(ProtocolError):
+    pass
+
+
+# Function to create the hash object used for the trailing digest
+def new_digest():
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+# Function to read exactly size bytes from a socket
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), CHUNK_SIZE))
+        if not chunk:
+            raise ProtocolError("Connection closed in the middle of a frame")
+        data += chunk
+    return bytes(data)
+
+
+# Function to send a frame header followed by an optional small payload
+def send_frame(sock, msg_type, header, payload=b''):
+    encoded = json.dumps(header, separators=(',', ':')).encode('utf-8')
+    sock.sendall(FRAME_HEADER.pack(msg_type, len(encoded)) + encoded + payload)
+
+
+# Function to read the next frame header, returns None when the peer closed the connection cleanly
+def recv_frame(sock):
+    first = sock.recv(FRAME_HEADER.size)
+    if not first:
+        return None
+    prefix = first + recv_exact(sock, FRAME_HEADER.size - len(first))
+    msg_type, header_size = FRAME_HEADER.unpack(prefix)
+    if header_size > MAX_HEADER_SIZE:
+        raise ProtocolError(f"Frame header of {header_size} bytes is too large")
+    return msg_type, json.loads(recv_exact(sock, header_size))
+
+
+# Function to wait for the receiver's answer to a file or delta frame
+def recv_ack(sock):
+    frame = recv_frame(sock)
+    if frame is None:
+        raise ProtocolError("Connection closed while waiting for an acknowledgement")
+    msg_type, header = frame
+    if msg_type != MSG_ACK:
+        raise ProtocolError(f"Expected an acknowledgement, got message type {msg_type}")
+    if not header.get('ok'):
+        raise FileRejected(header.get('error', "Receiver rejected the file"))
+
+
+# Function to stream a byte range of an open file to a socket with constant memory use
+# buf is a reusable bytearray, the digest (if any) is fed every byte that is sent
+# A throttle (see throttle.py) is charged for every window or chunk before it is sent
+def send_range(sock, f, offset, count, buf, digest=None, zero_copy=HAS_SENDFILE, throttle=None):
+    view = memoryview(buf)
+    end = offset + count
+    while offset < end:
+        if zero_copy:
+            # The kernel moves the data; it is only read into user space when a digest is needed
+            # Throttled windows are kept small, so the rate stays even
+            window = min(end - offset, SENDFILE_WINDOW if throttle is None else len(view))
+            if throttle is not None:
+                throttle.consume(window)
+            if digest is not None:
+                hash_range(f, offset, window, buf, digest)
+            if sock.sendfile(f, offset, window) != window:
+                raise ProtocolError("File shrank while it was being sent")
+            offset += window
+        else:
+            n = read_at(f, offset, view[:min(end - offset, len(view))])
+            if throttle is not None:
+                throttle.consume(n)
+            sock.sendall(view[:n])
+            if digest is not None:
+                digest.update(view[:n])
+            offset += n
+
+
+# Function to feed a byte range of an open file to a digest
+def hash_range(f, offset, count, buf, digest):
+    view = memoryview(buf)
+    end = offset + count
+    while offset < end:
+        n = read_at(f, offset, view[:min(end - offset, len(view))])
+        digest.update(view[:n])
+        offset += n
+
+
+# Function to send one piece of a compressed payload, returns the number of bytes that went on the wire
+def send_piece(sock, piece, throttle=None):
+    if not piece:
+        return 0
+    if throttle is not None:
+        throttle.consume(PIECE_HEADER.size + len(piece))
+    sock.sendall(PIECE_HEADER.pack(len(piece)))
+    sock.sendall(piece)
+    return PIECE_HEADER.size + len(piece)
+
+
+# Function to stream a file from offset to its end through a compressor
+# The digest is fed the uncompressed content, so the receiver checks what it wrote, not what it received
+# Returns (bytes on the wire, CPU seconds spent compressing)
+def send_compressed(sock, f, size, buf, digest, compressor, offset=0, throttle=None):
+    view = memoryview(buf)
+    wire_bytes = 0
+    cpu_seconds = 0.0
+    while offset < size:
+        n = read_at(f, offset, view[:min(size - offset, len(view))])
+        digest.update(view[:n])
+        started = time.thread_time()
+        piece = compressor.compress(view[:n])
+        cpu_seconds += time.thread_time() - started
+        wire_bytes += send_piece(sock, piece, throttle)
+        offset += n
+    started = time.thread_time()
+    piece = compressor.flush()
+    cpu_seconds += time.thread_time() - started
+    wire_bytes += send_piece(sock, piece, throttle)
+    sock.sendall(PIECE_HEADER.pack(0))
+    return wire_bytes + PIECE_HEADER.size, cpu_seconds
+
+
+# Function to fill a buffer from a file offset without moving the file position
+def read_at(f, offset, view):
+    if hasattr(os, 'preadv'):
+        n = os.preadv(f.fileno(), [view], offset)
+    else:
+        f.seek(offset)
+        n = f.readinto(view)
+    if not n:
+        raise ProtocolError("File shrank while it was being sent")
+    return n
+
+
+# Function to convert a local relative path to the form used on the wire
+def to_wire_path(rel_path):
+    return rel_path.replace(os.sep, '/')
+
+
+# Function to resolve a wire path inside the receiver root, refusing anything that escapes it
+def safe_join(root, wire_path):
+    parts = [part for part in wire_path.split('/') if part not in ('', '.')]
+    if not parts or '..' in parts or os.path.isabs(wire_path):
+        raise ProtocolError(f"Unsafe path '{wire_path}'")
+    return os.path.join(root, *parts)
+
+
+# Function to parse a receiver address given as HOST or HOST:PORT (an IPv6 address only as HOST)
+def parse_address(text, default_port=DEFAULT_PORT):
+    host, _, port = text.rpartition(':') if text.count(':') == 1 else (text, '', '')
+    if not port:
+        return text, default_port
+    if not port.isdigit() or not host:
+        raise ValueError(f"Invalid receiver '{text}', expected HOST or HOST:PORT")
+    return host, int(port)
+
+
+# Function to build the metadata header sent with a file
+def file_header(rel_path, st):
+    return {
+        'path': to_wire_path(rel_path),
+        'size': st.st_size,
+        'mode': stat.S_IMODE(st.st_mode),
+        'mtime_ns': st.st_mtime_ns,
+    }
+
+
+# A persistent connection to a receiver, reused for every file of a sync
+# compression lists the codecs to offer, best first; the receiver picks one when the connection is opened
+# A throttle (see throttle.py) is charged one operation per file and every byte that goes on the wire
+class Sender:
+    def __init__(self, host, port=DEFAULT_PORT, timeout=30.0, delta=False, delta_min_size=DELTA_MIN_SIZE,
+                 zero_copy=HAS_SENDFILE, compression=None, compression_stats=None, resume_min_size=RESUME_MIN_SIZE,
+                 throttle=None):
+        self.address = (host, port)
+        self.timeout = timeout
+        self.delta = delta
+        self.delta_min_size = delta_min_size
+        self.resume_min_size = resume_min_size
+        self.throttle = throttle
+        self.zero_copy = zero_copy
+        self.compression = list(compression or [])
+        self.compression_stats = compression_stats if compression_stats is not None else CompressionStats()
+        self.codec = None
+        # One buffer per connection is reused for every read, whatever the file size
+        self.buffer = bytearray(CHUNK_SIZE)
+        self.sock = None
+
+    def connect(self):
+        if self.sock is None:
+            self.sock = socket.create_connection(self.address, timeout=self.timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if self.compression:
+                try:
+                    self._negotiate()
+                except (OSError, ProtocolError):
+                    self.close()
+                    raise
+        return self.sock
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            self.codec = None
+
+    # Offer the codecs, the receiver answers with the one to use or None
+    def _negotiate(self):
+        send_frame(self.sock, MSG_HELLO, {'compression': self.compression})
+        frame = recv_frame(self.sock)
+        if frame is None or frame[0] != MSG_HELLO:
+            raise ProtocolError("Expected a hello from the receiver")
+        self.codec = CODECS.get(frame[1].get('compression'))
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def connected(self):
+        return self.sock is not None
+
+    # Check if a file of this size goes through the signature exchange instead of a plain file frame
+    def uses_delta(self, size):
+        return self.delta and size >= self.delta_min_size
+
+    # Check if a file of this size can continue a transfer that was interrupted
+    def resumes(self, size):
+        return size >= self.resume_min_size
+
+    # Check if sending a file of this size starts with a question to the receiver, a delta's signature request
+    # or a resume request, so it must only be started when no acknowledgement is pending
+    def needs_round_trip(self, size):
+        return self.uses_delta(size) or self.resumes(size)
+
+    # Send one file and wait for the receiver to confirm it, returns the number of payload bytes sent
+    def send_file(self, source_path, rel_path):
+        sent = self.start_file(source_path, rel_path)
+        self.read_ack()
+        return sent
+
+    # Send the frames of one file without waiting for its acknowledgement, so several files can be in flight
+    # See needs_round_trip() for the files that must only be started when no acknowledgement is pending
+    def start_file(self, source_path, rel_path):
+        # Opening the file first means a vanished file does not break the connection
+        try:
+            f = open(source_path, 'rb')
+        except OSError as e:
+            raise FileRejected(f"Cannot read '{source_path}': {e}")
+        with f:
+            st = os.fstat(f.fileno())
+            if self.throttle is not None:
+                self.throttle.operation()
+            sock = self.connect()
+            try:
+                if self.uses_delta(st.st_size):
+                    sent = self._send_delta(sock, source_path, rel_path, st)
+                    if sent is not None:
+                        return sent
+
+                header = file_header(rel_path, st)
+                digest = new_digest()
+                offset = 0
+                if self.resumes(st.st_size):
+                    offset = self._resume_offset(sock, rel_path, st)
+                    header['resumable'] = True
+                    header['offset'] = offset
+                    # The trailer covers the whole file, so the part the receiver already has is hashed too
+                    hash_range(f, 0, offset, self.buffer, digest)
+                if self.codec is not None and worth_compressing(source_path, f, st.st_size):
+                    header['codec'] = self.codec.name
+                    send_frame(sock, MSG_FILE, header)
+                    sent, cpu_seconds = send_compressed(sock, f, st.st_size, self.buffer, digest,
+                                                        self.codec.compressor(), offset, self.throttle)
+                    self.compression_stats.add_compressed(st.st_size - offset, sent, cpu_seconds)
+                else:
+                    if self.codec is not None:
+                        self.compression_stats.add_skipped()
+                    send_frame(sock, MSG_FILE, header)
+                    send_range(sock, f, offset, st.st_size - offset, self.buffer, digest, self.zero_copy,
+                               self.throttle)
+                    sent = st.st_size - offset
+                sock.sendall(digest.digest())
+                return sent
+            except (OSError, ProtocolError):
+                # The stream may be out of step now, the next file starts on a fresh connection
+                self.close()
+                raise
+
+    # Start a file whose content the caller pushes chunk by chunk, see FileStream
+    # Used when one read of the source feeds several targets; compress says if the content is worth compressing
+    def stream_file(self, rel_path, st, compress=True):
+        if self.throttle is not None:
+            self.throttle.operation()
+        sock = self.connect()
+        header = file_header(rel_path, st)
+        compressor = None
+        if self.codec is not None and compress:
+            header['codec'] = self.codec.name
+            compressor = self.codec.compressor()
+        elif self.codec is not None:
+            self.compression_stats.add_skipped()
+        try:
+            send_frame(sock, MSG_FILE, header)
+        except OSError:
+            self.close()
+            raise
+        return FileStream(self, sock, st.st_size, compressor)
+
+    # Wait for the acknowledgement of the oldest file in flight
+    def read_ack(self):
+        if self.sock is None:
+            raise ProtocolError("Not connected")
+        try:
+            recv_ack(self.sock)
+        except FileRejected:
+            raise
+        except (OSError, ProtocolError):
+            self.close()
+            raise
+
+    # Ask how much of this version of the file an interrupted transfer left at the receiver
+    def _resume_offset(self, sock, rel_path, st):
+        send_frame(sock, MSG_RESUME_REQUEST, {'path': to_wire_path(rel_path), 'size': st.st_size,
+                                              'mtime_ns': st.st_mtime_ns})
+        frame = recv_frame(sock)
+        if frame is None or frame[0] != MSG_RESUME:
+            raise ProtocolError("Expected a resume offset from the receiver")
+        offset = frame[1]['offset']
+        if not isinstance(offset, int) or not 0 <= offset <= st.st_size:
+            raise ProtocolError(f"Invalid resume offset {offset!r}")
+        return offset
+
+    # Send only the blocks the receiver does not have yet, returns None if it has no copy of the file
+    def _send_delta(self, sock, source_path, rel_path, st):
+        send_frame(sock, MSG_SIGNATURE_REQUEST, {'path': to_wire_path(rel_path), 'block_size': DELTA_BLOCK_SIZE})
+        frame = recv_frame(sock)
+        if frame is None or frame[0] != MSG_SIGNATURE:
+            raise ProtocolError("Expected a signature from the receiver")
+        count = frame[1]['count']
+        if count < 0:
+            return None
+        signature = Signature.from_bytes(recv_exact(sock, count * BLOCK_ENTRY.size), DELTA_BLOCK_SIZE)
+
+        digest = new_digest()
+        ops = compute_delta(source_path, signature, digest)
+        header = file_header(rel_path, st)
+        header['block_size'] = DELTA_BLOCK_SIZE
+        header['ops'] = [[OP_CODES[kind], offset, length, index] for kind, offset, length, index in ops]
+        send_frame(sock, MSG_DELTA, header)
+        with open(source_path, 'rb') as f:
+            for kind, offset, length, index in ops:
+                if kind == DATA:
+                    send_range(sock, f, offset, length, self.buffer, zero_copy=self.zero_copy, throttle=self.throttle)
+        sock.sendall(digest.digest())
+        return literal_bytes(ops)
+
+
+# The payload of one file frame, written by the caller instead of read from the file by the sender
+# The caller hashes the content once for all of its targets and hands the digest to finish()
+class FileStream:
+    def __init__(self, sender, sock, size, compressor=None):
+        self.sender = sender
+        self.sock = sock
+        self.size = size
+        self.compressor = compressor
+        self.written = 0
+        self.sent = 0
+        self.cpu_seconds = 0.0
+
+    def write(self, data):
+        if self.written + len(data) > self.size:
+            raise ProtocolError("File grew while it was being sent")
+        try:
+            if self.compressor is None:
+                if self.sender.throttle is not None:
+                    self.sender.throttle.consume(len(data))
+                self.sock.sendall(data)
+                self.sent += len(data)
+            else:
+                started = time.thread_time()
+                piece = self.compressor.compress(data)
+                self.cpu_seconds += time.thread_time() - started
+                self.sent += send_piece(self.sock, piece, self.sender.throttle)
+        except OSError:
+            self.sender.close()
+            raise
+        self.written += len(data)
+
+    # End the payload with the digest of the content, then wait for the receiver to confirm the file
+    # Returns the number of payload bytes that went on the wire
+    def finish(self, digest):
+        if self.written != self.size:
+            self.abort()
+            raise ProtocolError("File shrank while it was being sent")
+        try:
+            if self.compressor is not None:
+                started = time.thread_time()
+                piece = self.compressor.flush()
+                self.cpu_seconds += time.thread_time() - started
+                self.sent += send_piece(self.sock, piece, self.sender.throttle) + PIECE_HEADER.size
+                self.sock.sendall(PIECE_HEADER.pack(0))
+                self.sender.compression_stats.add_compressed(self.size, self.sent, self.cpu_seconds)
+            self.sock.sendall(digest)
+        except OSError:
+            self.sender.close()
+            raise
+        self.sender.read_ack()
+        return self.sent
+
+    # Give up on the file, the stream is out of step so the next file starts on a fresh connection
+    def abort(self):
+        self.sender.close()
@@ -0,0 +1,314 @@
+import argparse
+import logging
+import os
+import re
+import socket
+import socketserver
+import tempfile
+
+from delta import DATA, apply_delta, file_signature
+from protocol import (CHUNK_SIZE, DEFAULT_PORT, DIGEST_SIZE, MSG_ACK, MSG_DELTA, MSG_FILE, MSG_HELLO, MSG_RESUME,
+                      MSG_RESUME_REQUEST, MSG_SIGNATURE, MSG_SIGNATURE_REQUEST, OP_KINDS, PIECE_HEADER, ProtocolError,
+                      new_digest, recv_exact, recv_frame, safe_join, send_frame)
+from resumable import PARTIAL_SUFFIX
+from stream_compression import CODECS, choose_codec
+
+# Largest block size a sender may ask a signature for
+MAX_BLOCK_SIZE = 16 * 1024 * 1024
+
+# Compressed data is read in chunks of this size, which bounds what a single decompress call produces
+COMPRESSED_READ_SIZE = 64 * 1024
+
+logger = logging.getLogger("sync_receiver")
+
+
+# Function to read up to size bytes into a reusable buffer, returns a view of what arrived
+def recv_chunk(sock, view, size):
+    n = sock.recv_into(view[:min(size, len(view))])
+    if not n:
+        raise ProtocolError("Connection closed in the middle of a frame")
+    return view[:n]
+
+
+# Function to read and throw away bytes that belong to a rejected frame
+def drain(sock, view, size):
+    while size > 0:
+        size -= len(recv_chunk(sock, view, size))
+
+
+# Function to give a received temp file its metadata and move it over the target
+def finish_file(tmp_path, target, header):
+    os.chmod(tmp_path, header['mode'])
+    os.utime(tmp_path, ns=(header['mtime_ns'], header['mtime_ns']))
+    os.replace(tmp_path, target)
+
+
+# Function to open a temp file next to the target so the replacement is atomic
+def open_temp(target):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.recv-')
+    return os.fdopen(fd, 'wb'), tmp_path
+
+
+# Function to build the name a resumable file is received under
+# The name carries the size and mtime, so a partial file is only ever continued with the same version of the source
+def resume_path(target, header):
+    return os.path.join(os.path.dirname(target),
+                        f".{os.path.basename(target)}.{int(header['size'])}-{int(header['mtime_ns'])}{PARTIAL_SUFFIX}")
+
+
+# Function to remove partial files left by transfers of older versions of the target
+def remove_stale_partials(target, keep):
+    pattern = re.compile(rf"\.{re.escape(os.path.basename(target))}\.\d+--?\d+{re.escape(PARTIAL_SUFFIX)}")
+    try:
+        names = os.listdir(os.path.dirname(target))
+    except FileNotFoundError:
+        return
+    for name in names:
+        path = os.path.join(os.path.dirname(target), name)
+        if pattern.fullmatch(name) and path != keep:
+            os.unlink(path)
+
+
+# Function to open the partial file of a resumable transfer, keeping the first offset bytes it already holds
+# Those bytes are fed to the digest, which covers the whole file
+def open_partial(target, header, offset, digest):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    part_path = resume_path(target, header)
+    out = open(part_path, 'r+b' if offset else 'wb')
+    try:
+        out.truncate(offset)
+        out.seek(0)
+        remaining = offset
+        while remaining > 0:
+            chunk = out.read(min(remaining, CHUNK_SIZE))
+            if not chunk:
+                raise ProtocolError("Partial file is shorter than the resume offset")
+            digest.update(chunk)
+            remaining -= len(chunk)
+        out.seek(offset)
+    except BaseException:
+        out.close()
+        raise
+    return out, part_path
+
+
+# Handles one sender connection, which may carry any number of frames
+class ReceiverHandler(socketserver.BaseRequestHandler):
+    def setup(self):
+        # Payloads pass through this one buffer, so memory use does not depend on file sizes
+        self.view = memoryview(bytearray(CHUNK_SIZE))
+
+    def handle(self):
+        sock = self.request
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                frame = recv_frame(sock)
+                if frame is None:
+                    return
+                msg_type, header = frame
+                if msg_type == MSG_HELLO:
+                    send_frame(sock, MSG_HELLO, {'compression': choose_codec(header.get('compression') or [])})
+                elif msg_type == MSG_FILE:
+                    self.receive_file(sock, header)
+                elif msg_type == MSG_SIGNATURE_REQUEST:
+                    self.send_signature(sock, header)
+                elif msg_type == MSG_DELTA:
+                    self.receive_delta(sock, header)
+                elif msg_type == MSG_RESUME_REQUEST:
+                    self.send_resume(sock, header)
+                else:
+                    raise ProtocolError(f"Unknown message type {msg_type}")
+        except (OSError, ProtocolError, ValueError, KeyError) as e:
+            logger.warning("Connection from %s dropped: %s", self.client_address, e)
+
+    def reply(self, sock, path, error):
+        if error is None:
+            send_frame(sock, MSG_ACK, {'ok': True})
+        else:
+            logger.warning("Rejected '%s': %s", path, error)
+            send_frame(sock, MSG_ACK, {'ok': False, 'error': str(error)})
+
+    # Tell the sender how much of this version of a large file an interrupted transfer left here
+    def send_resume(self, sock, header):
+        offset = 0
+        try:
+            target = safe_join(self.server.root, header['path'])
+            part_path = resume_path(target, header)
+            remove_stale_partials(target, part_path)
+            if os.path.isfile(part_path):
+                # A partial file larger than the file is damaged and received again
+                offset = os.path.getsize(part_path)
+                if offset > int(header['size']):
+                    offset = 0
+        except (OSError, ProtocolError):
+            offset = 0
+        send_frame(sock, MSG_RESUME, {'offset': offset})
+
+    def receive_file(self, sock, header):
+        # A resumable file is written to a partial file that outlives a broken connection
+        resumable = bool(header.get('resumable'))
+        offset = int(header.get('offset', 0)) if resumable else 0
+        if not 0 <= offset <= header['size']:
+            raise ProtocolError(f"Invalid resume offset {offset}")
+
+        error = None
+        out = tmp_path = None
+        digest = new_digest()
+        try:
+            target = safe_join(self.server.root, header['path'])
+            if resumable:
+                out, tmp_path = open_partial(target, header, offset, digest)
+            else:
+                out, tmp_path = open_temp(target)
+        except (OSError, ProtocolError) as e:
+            error = e
+
+        # The payload is always consumed, so the stream stays in step even when the file is rejected
+        try:
+            for chunk in self.payload(sock, header, header['size'] - offset):
+                digest.update(chunk)
+                if out is not None:
+                    try:
+                        out.write(chunk)
+                    except OSError as e:
+                        error = e
+                        out.close()
+                        out = None
+        except Exception:
+            # What arrived of a resumable file is kept, the next attempt continues after it
+            self.complete(out, tmp_path, header, ProtocolError("Transfer aborted"), None, digest,
+                          keep=resumable and error is None)
+            raise
+        trailer = recv_exact(sock, DIGEST_SIZE)
+
+        self.reply(sock, header['path'], self.complete(out, tmp_path, header, error, trailer, digest))
+
+    # Yield the size bytes of content of a file frame, decompressing them if the sender compressed them
+    def payload(self, sock, header, size):
+        codec_name = header.get('codec')
+        if codec_name is None:
+            remaining = size
+            while remaining > 0:
+                chunk = recv_chunk(sock, self.view, remaining)
+                remaining -= len(chunk)
+                yield chunk
+            return
+
+        codec = CODECS.get(codec_name)
+        if codec is None:
+            raise ProtocolError(f"Unknown codec '{codec_name}'")
+        decompressor = codec.decompressor()
+        produced = 0
+        while True:
+            (length,) = PIECE_HEADER.unpack(recv_exact(sock, PIECE_HEADER.size))
+            if length == 0:
+                return
+            while length > 0:
+                chunk = recv_chunk(sock, self.view[:COMPRESSED_READ_SIZE], length)
+                length -= len(chunk)
+                try:
+                    data = decompressor.decompress(chunk)
+                except Exception as e:  # zlib.error, zstd and lz4 errors have no common base class
+                    raise ProtocolError(f"Corrupt {codec_name} data: {e}")
+                produced += len(data)
+                if produced > size:
+                    raise ProtocolError("Decompressed data is larger than announced")
+                yield data
+
+    def send_signature(self, sock, header):
+        block_size = int(header['block_size'])
+        try:
+            target = safe_join(self.server.root, header['path'])
+            if not 0 < block_size <= MAX_BLOCK_SIZE or not os.path.isfile(target):
+                raise FileNotFoundError(target)
+            signature = file_signature(target, block_size)
+        except (OSError, ProtocolError):
+            send_frame(sock, MSG_SIGNATURE, {'count': -1})
+            return
+        send_frame(sock, MSG_SIGNATURE, {'count': len(signature.blocks)}, signature.to_bytes())
+
+    def receive_delta(self, sock, header):
+        ops = [(OP_KINDS[code], offset, length, index) for code, offset, length, index in header['ops']]
+        literal_total = sum(length for kind, offset, length, index in ops if kind == DATA)
+        consumed = 0
+
+        def read_literal(offset, length):
+            nonlocal consumed
+            chunk = recv_chunk(sock, self.view, length)
+            consumed += len(chunk)
+            return chunk
+
+        error = None
+        out = tmp_path = None
+        digest = new_digest()
+        try:
+            target = safe_join(self.server.root, header['path'])
+            with open(target, 'rb') as old:
+                out, tmp_path = open_temp(target)
+                apply_delta(old, ops, int(header['block_size']), read_literal, out, digest)
+        except OSError as e:
+            error = e
+        except ProtocolError as e:
+            if consumed == 0:
+                error = e
+            else:
+                raise
+        drain(sock, self.view, literal_total - consumed)
+        trailer = recv_exact(sock, DIGEST_SIZE)
+
+        self.reply(sock, header['path'], self.complete(out, tmp_path, header, error, trailer, digest))
+
+    # Verify the digest, then either move the temp file into place or throw it away, unless keep is set
+    # Returns the error to report to the sender, or None
+    def complete(self, out, tmp_path, header, error, trailer, digest, keep=False):
+        if out is not None:
+            out.close()
+        if error is None and trailer != digest.digest():
+            error = ProtocolError("Checksum mismatch")
+        if error is None:
+            try:
+                finish_file(tmp_path, safe_join(self.server.root, header['path']), header)
+                logger.info("Received '%s' (%d bytes)", header['path'], header['size'])
+                return None
+            except OSError as e:
+                error = e
+        if tmp_path is not None and not keep and os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        return error
+
+
+# Threaded TCP server that writes every received file below its root directory
+class SyncReceiver(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, root, host='0.0.0.0', port=DEFAULT_PORT):
+        self.root = os.path.abspath(root)
+        os.makedirs(self.root, exist_ok=True)
+        super().__init__((host, port), ReceiverHandler)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Receive files sent by sync_app_net and write them below a directory.")
+    parser.add_argument("--root", required=True, help="directory the received tree is written to")
+    parser.add_argument("--host", default='0.0.0.0', help="address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s", datefmt='%Y-%m-%d %H:%M:%S')
+    with SyncReceiver(args.root, args.host, args.port) as server:
+        logger.info("Receiving into '%s' on %s:%d", server.root, args.host, server.port)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Receiver stopped.")
+
+
+if __name__ == '__main__':
+    main()
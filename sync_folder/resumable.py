@@ -0,0 +1,134 @@
+import errno
+import hashlib
+import os
+import shutil
+
+# Replicas are written under this suffix and renamed into place once complete
+PARTIAL_SUFFIX = '.sync-partial'
+
+# Files at least this large record their progress, so an interrupted copy continues where it stopped
+RESUME_MIN_SIZE = 64 * 1024 * 1024
+
+# Bytes copied between two checkpoints of a resumable copy
+CHECKPOINT_BYTES = 32 * 1024 * 1024
+
+# Size of the chunks read while copying and hashing
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# Errors meaning copy_file_range cannot be used for these two files
+_NO_COPY_RANGE = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP}
+
+
+# Function to build the name a replica is written under until it is complete
+def partial_path(replica_path):
+    return os.path.join(os.path.dirname(replica_path), f".{os.path.basename(replica_path)}{PARTIAL_SUFFIX}")
+
+
+# Function to check if a name belongs to an unfinished replica
+def is_partial_name(name):
+    return name.startswith('.') and name.endswith(PARTIAL_SUFFIX) and len(name) > len(PARTIAL_SUFFIX) + 1
+
+
+# Function to get the name of the file an unfinished replica belongs to
+def partial_target(name):
+    return name[1:-len(PARTIAL_SUFFIX)]
+
+
+# Function to fill a buffer from a file offset, returns the number of bytes read
+def _read_at(f, offset, view):
+    if hasattr(os, 'preadv'):
+        return os.preadv(f.fileno(), [view], offset)
+    f.seek(offset)
+    return f.readinto(view)
+
+
+# Function to write a whole buffer at a file offset
+def _write_at(f, offset, view):
+    while len(view):
+        if hasattr(os, 'pwrite'):
+            n = os.pwrite(f.fileno(), view, offset)
+        else:
+            f.seek(offset)
+            n = f.write(view)
+        view = view[n:]
+        offset += n
+
+
+# Function to copy up to count bytes at offset, returns the number of bytes copied
+# Without a digest the data is copied inside the kernel where the OS allows it
+def _copy_chunk(src, dst, offset, count, view, digest):
+    if digest is None and hasattr(os, 'copy_file_range'):
+        try:
+            n = os.copy_file_range(src.fileno(), dst.fileno(), count, offset, offset)
+            if n:
+                return n
+        except OSError as e:
+            if e.errno not in _NO_COPY_RANGE:
+                raise
+    n = _read_at(src, offset, view[:count])
+    if n:
+        if digest is not None:
+            digest.update(view[:n])
+        _write_at(dst, offset, view[:n])
+    return n
+
+
+# Function to copy a file to its replica atomically: the data goes to a partial file that is renamed into place
+# Large files record their progress in the manifest, and a copy that was interrupted continues from there
+# Returns the hex digest of the written content when with_digest is set, otherwise None
+# A throttle (see throttle.py) is charged for every chunk before it is copied
+def copy_file(source_path, replica_path, rel_path, src_st, manifest, with_digest=False, throttle=None):
+    part_path = partial_path(replica_path)
+    resumable = src_st.st_size >= RESUME_MIN_SIZE
+    offset = manifest.partial_offset(rel_path, src_st) if resumable else 0
+    try:
+        if offset and os.path.getsize(part_path) < offset:
+            offset = 0
+    except OSError:
+        offset = 0
+
+    try:
+        digest = _copy_from(source_path, part_path, rel_path, src_st, manifest, offset, resumable, with_digest,
+                            throttle)
+    except BaseException:
+        # Only a resumable copy keeps what it wrote, anything smaller simply starts over next time
+        if not resumable and os.path.exists(part_path):
+            os.unlink(part_path)
+        raise
+    shutil.copystat(source_path, part_path)
+    os.replace(part_path, replica_path)
+    if resumable:
+        manifest.forget_partial(rel_path)
+    return digest
+
+
+# Function to write the source into the partial file from offset on, returns the hex digest or None
+def _copy_from(source_path, part_path, rel_path, src_st, manifest, offset, resumable, with_digest, throttle):
+    size = src_st.st_size
+    digest = hashlib.blake2b(digest_size=20) if with_digest else None
+    view = memoryview(bytearray(COPY_CHUNK_SIZE))
+    with open(source_path, 'rb', buffering=0) as src, open(part_path, 'r+b' if offset else 'wb', buffering=0) as dst:
+        dst.truncate(offset)
+        if digest is not None:
+            # The part written before the interruption is hashed again, but not copied again
+            position = 0
+            while position < offset:
+                n = _read_at(dst, position, view[:min(len(view), offset - position)])
+                digest.update(view[:n])
+                position += n
+
+        checkpoint = offset + CHECKPOINT_BYTES
+        while offset < size:
+            count = min(len(view), size - offset)
+            if throttle is not None:
+                throttle.consume(count)
+            n = _copy_chunk(src, dst, offset, count, view, digest)
+            if not n:
+                raise OSError(errno.EIO, f"'{source_path}' shrank while it was being copied")
+            offset += n
+            if resumable and offset >= checkpoint and offset < size:
+                # The data has to be on disk before the journal says it is
+                os.fsync(dst.fileno())
+                manifest.record_partial(rel_path, src_st, offset)
+                checkpoint = offset + CHECKPOINT_BYTES
+    return digest.hexdigest() if digest is not None else None
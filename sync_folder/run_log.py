@@ -0,0 +1,134 @@
+import atexit
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+# Buffered records are written out this often by the flush thread
+FLUSH_INTERVAL = 1.0
+
+# A full buffer is written out right away instead of waiting for the next flush
+MAX_BUFFERED = 1000
+
+# The log is rotated once it is this large or this old, and this many rotated files are kept
+MAX_BYTES = 10 * 1024 * 1024
+MAX_AGE = 24 * 60 * 60
+BACKUP_COUNT = 5
+
+# Every log file is shared by all engines of the process, see open_run_log()
+_run_logs = {}
+_run_logs_lock = threading.Lock()
+
+
+# Function to get the run log writing to a path, creating it on first use
+# Engines come and go (the GUIs create one per start), the sink for a file stays open until the process exits
+def open_run_log(path):
+    key = os.path.abspath(path)
+    with _run_logs_lock:
+        run_log = _run_logs.get(key)
+        if run_log is None:
+            run_log = _run_logs[key] = RunLog(key)
+        return run_log
+
+
+# Append-only log of JSON lines, one record per line with its time and event name
+# Records are only buffered by write(), the file is kept open and written by a background thread,
+# so the sync loop never waits for the disk; the file is rotated by size and by age
+class RunLog:
+    def __init__(self, path, max_bytes=MAX_BYTES, max_age=MAX_AGE, backup_count=BACKUP_COUNT,
+                 flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.closed = threading.Event()
+        self.file = None
+        self.opened = 0.0
+        self.thread = threading.Thread(target=self._run, name="sync-log-flush", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    # Buffer one record, may be called from any thread
+    def write(self, event, **fields):
+        record = {'time': datetime.now().isoformat(timespec='milliseconds'), 'event': event, **fields}
+        with self.lock:
+            self.buffer.append(json.dumps(record, default=str))
+            full = len(self.buffer) >= MAX_BUFFERED
+        if full:
+            self.wakeup.set()
+
+    def _run(self):
+        while not self.closed.is_set():
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    # Write out everything buffered, called by the flush thread and on close
+    def flush(self):
+        with self.lock:
+            lines, self.buffer = self.buffer, []
+        if not lines:
+            return
+        try:
+            if self.file is None or self._should_rotate():
+                self._open()
+            self.file.write('\n'.join(lines) + '\n')
+            self.file.flush()
+        except OSError:
+            # The log must never stop a synchronization, the records are dropped
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def _should_rotate(self):
+        return self.file.tell() >= self.max_bytes or time.time() - self.opened >= self.max_age
+
+    # Open the log for appending, rotating it first if it is too large or too old
+    # The age of an existing file is taken from its creation by the first record in it
+    def _open(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self._rotate()
+        elif os.path.exists(self.path):
+            self.opened = self._first_record_time()
+            if os.path.getsize(self.path) >= self.max_bytes or time.time() - self.opened >= self.max_age:
+                self._rotate()
+        if not os.path.exists(self.path):
+            self.opened = time.time()
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    # Rename sync_log.jsonl to sync_log.jsonl.1, .1 to .2 and so on, the oldest is removed
+    def _rotate(self):
+        if self.backup_count <= 0:
+            os.remove(self.path)
+            return
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        os.replace(self.path, f"{self.path}.1")
+
+    def _first_record_time(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                return datetime.fromisoformat(json.loads(f.readline())['time']).timestamp()
+        except (OSError, ValueError, KeyError, TypeError):
+            return os.path.getmtime(self.path)
+
+    # Stop the flush thread and write out what is left
+    def close(self):
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        atexit.unregister(self.close)
@@ -0,0 +1,223 @@
+import collections
+import os
+import queue
+import random
+import threading
+import time
+
+from protocol import DEFAULT_PORT, FileRejected, ProtocolError, Sender
+from stream_compression import CompressionStats
+
+# Default number of connections, queued files and pipelined files per connection
+DEFAULT_CONNECTIONS = 4
+DEFAULT_QUEUE_SIZE = 256
+DEFAULT_PIPELINE_DEPTH = 8
+
+# Files already being sent may not add up to more than this, larger files go alone
+DEFAULT_MAX_IN_FLIGHT_BYTES = 64 * 1024 * 1024
+
+# Retry policy for broken connections
+DEFAULT_RETRIES = 5
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 30.0
+
+
+# A file waiting to be sent, with the number of failed attempts so far
+class SendJob:
+    def __init__(self, source_path, rel_path, size):
+        self.source_path = source_path
+        self.rel_path = rel_path
+        self.size = size
+        self.attempts = 0
+        self.sent = 0
+
+
+# Counters collected while the pool is running
+class SendStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files_sent = 0
+        self.bytes_sent = 0
+        self.retries = 0
+        self.errors = []
+        self.compression = CompressionStats()
+        self.started = time.perf_counter()
+        self.finished = None
+
+    def add_sent(self, job):
+        with self.lock:
+            self.files_sent += 1
+            self.bytes_sent += job.sent
+
+    def add_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def add_error(self, path, error):
+        with self.lock:
+            self.errors.append((path, error))
+
+    @property
+    def elapsed(self):
+        end = self.finished if self.finished is not None else time.perf_counter()
+        return max(end - self.started, 1e-9)
+
+    def summary(self):
+        text = (f"{self.files_sent} files sent, {self.bytes_sent / (1024 * 1024):.1f} MB in {self.elapsed:.2f} s "
+                f"({self.bytes_sent / (1024 * 1024) / self.elapsed:.1f} MB/s), "
+                f"{self.retries} retries, {len(self.errors)} errors")
+        if self.compression.files_compressed or self.compression.files_skipped:
+            text += f"; {self.compression.summary()}"
+        return text
+
+
+# Fixed set of sender threads, each with one persistent and pipelined connection
+# compression lists the codecs offered to the receiver, best first (see stream_compression.offered_codecs)
+# throttle (see throttle.py) is shared by all connections, so its limits apply to the pool as a whole
+class SenderPool:
+    def __init__(self, host, port=DEFAULT_PORT, connections=DEFAULT_CONNECTIONS, queue_size=DEFAULT_QUEUE_SIZE,
+                 pipeline_depth=DEFAULT_PIPELINE_DEPTH, max_in_flight_bytes=DEFAULT_MAX_IN_FLIGHT_BYTES,
+                 retries=DEFAULT_RETRIES, delta=False, compression=None, throttle=None):
+        self.host = host
+        self.port = port
+        self.connections = max(1, int(connections))
+        self.pipeline_depth = max(1, int(pipeline_depth))
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.retries = retries
+        self.delta = delta
+        self.compression = compression
+        self.throttle = throttle
+        self.jobs = queue.Queue(maxsize=max(1, int(queue_size)))
+        self.in_flight_bytes = 0
+        self.budget = threading.Condition()
+        self.stats = SendStats()
+        self.threads = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def start(self):
+        for i in range(self.connections):
+            thread = threading.Thread(target=self._worker, name=f"sync-send-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # Queue a file, blocking while the queue is full or too many bytes are in flight
+    def submit(self, source_path, rel_path):
+        try:
+            size = os.path.getsize(source_path)
+        except OSError as e:
+            self.stats.add_error(source_path, e)
+            return
+        with self.budget:
+            while self.in_flight_bytes > 0 and self.in_flight_bytes + size > self.max_in_flight_bytes:
+                self.budget.wait()
+            self.in_flight_bytes += size
+        self.jobs.put(SendJob(source_path, rel_path, size))
+
+    # Wait until every queued file was sent or given up on, then stop the workers
+    def close(self):
+        for _ in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self.stats.finished = time.perf_counter()
+        return self.stats
+
+    def _release(self, job):
+        with self.budget:
+            self.in_flight_bytes -= job.size
+            self.budget.notify_all()
+
+    def _worker(self):
+        sender = Sender(self.host, self.port, delta=self.delta, compression=self.compression,
+                        compression_stats=self.stats.compression, throttle=self.throttle)
+        pending = collections.deque()  # Files sent on this connection and not acknowledged yet
+        retry = collections.deque()  # Files to send again after the connection broke
+        failures = 0  # Consecutive connection failures, drives the backoff
+        stopping = False
+        try:
+            while True:
+                job = None
+                if retry:
+                    job = retry.popleft()
+                elif not stopping:
+                    try:
+                        # Only block for new work when nothing is waiting for an acknowledgement
+                        job = self.jobs.get(block=not pending)
+                        stopping = job is None
+                    except queue.Empty:
+                        pass
+
+                if job is None:
+                    if pending:
+                        if not self._collect_ack(sender, pending, retry):
+                            failures += 1
+                    elif stopping:
+                        return
+                    continue
+
+                # Collect acknowledgements while the pipeline is full, or before a signature or resume round trip
+                while pending and (len(pending) >= self.pipeline_depth or sender.needs_round_trip(job.size)):
+                    if not self._collect_ack(sender, pending, retry):
+                        failures += 1
+                        break
+
+                if not sender.connected and failures:
+                    time.sleep(min(BACKOFF_BASE * 2 ** (failures - 1), BACKOFF_MAX) * random.uniform(0.5, 1.0))
+                try:
+                    job.sent = sender.start_file(job.source_path, job.rel_path)
+                    pending.append(job)
+                    failures = 0
+                except FileRejected as e:
+                    self._fail(job, e)
+                except Exception as e:
+                    # Anything else than a rejected file (a broken connection, a garbled frame, a bug) leaves the
+                    # stream in an unknown state: the files on it go again on a fresh connection
+                    sender.close()
+                    failures += 1
+                    self._requeue(pending, retry, job, e)
+        finally:
+            sender.close()
+            for job in list(pending) + list(retry):
+                self._fail(job, ProtocolError("Sender stopped"))
+
+    # Read one acknowledgement, returns False when the connection broke
+    def _collect_ack(self, sender, pending, retry):
+        job = pending[0]
+        try:
+            sender.read_ack()
+        except FileRejected as e:
+            pending.popleft()
+            self._fail(job, e)
+        except Exception as e:
+            # A malformed acknowledgement is handled like a broken connection, see _worker
+            sender.close()
+            self._requeue(pending, retry, None, e)
+            return False
+        else:
+            pending.popleft()
+            self.stats.add_sent(job)
+            self._release(job)
+        return True
+
+    # The connection broke: everything not acknowledged on it is sent again, unless it ran out of attempts
+    def _requeue(self, pending, retry, job, error):
+        jobs = list(pending) + ([job] if job is not None else [])
+        pending.clear()
+        for job in jobs:
+            job.attempts += 1
+            if job.attempts > self.retries:
+                self._fail(job, error)
+            else:
+                self.stats.add_retry()
+                retry.append(job)
+
+    def _fail(self, job, error):
+        self.stats.add_error(job.source_path, error)
+        self._release(job)
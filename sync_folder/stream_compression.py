@@ -0,0 +1,149 @@
+import collections
+import math
+import os
+import threading
+import zlib
+
+# zstd and lz4 are optional, zlib from the standard library is always there
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Compression level used by each codec, picked for throughput rather than the smallest output
+ZLIB_LEVEL = 3
+ZSTD_LEVEL = 3
+
+# Codecs in order of preference when the sender asks for the best available one
+PREFERENCE = ("zstd", "lz4", "zlib")
+
+# Files with these extensions are already compressed, compressing them again only costs CPU
+COMPRESSED_EXTENSIONS = frozenset((
+    '.7z', '.avif', '.br', '.bz2', '.docx', '.flac', '.gif', '.gz', '.heic', '.jar', '.jpeg', '.jpg', '.lz4',
+    '.m4a', '.mkv', '.mov', '.mp3', '.mp4', '.ogg', '.png', '.pptx', '.rar', '.tgz', '.webm', '.webp', '.whl',
+    '.xlsx', '.xz', '.zip', '.zst',
+))
+
+# Files smaller than this are sent as they are, the frame overhead would eat the gain
+MIN_COMPRESS_SIZE = 512
+
+# Other files are sampled in a few places, data above this many bits of entropy per byte is left alone
+SAMPLE_SIZE = 16 * 1024
+SAMPLE_COUNT = 3
+MAX_ENTROPY = 7.5
+
+
+# lz4.frame needs the frame header from begin() in front of the first block
+class _Lz4Compressor:
+    def __init__(self):
+        self.compressor = lz4.frame.LZ4FrameCompressor()
+        self.started = False
+
+    def compress(self, data):
+        if self.started:
+            return self.compressor.compress(data)
+        self.started = True
+        return self.compressor.begin() + self.compressor.compress(data)
+
+    def flush(self):
+        prefix = b'' if self.started else self.compressor.begin()
+        self.started = True
+        return prefix + self.compressor.flush()
+
+
+# A streaming codec: compressor() objects have compress() and flush(), decompressor() objects have decompress()
+class Codec:
+    def __init__(self, name, compressor, decompressor):
+        self.name = name
+        self.compressor = compressor
+        self.decompressor = decompressor
+
+
+CODECS = {'zlib': Codec('zlib', lambda: zlib.compressobj(ZLIB_LEVEL), zlib.decompressobj)}
+if zstandard is not None:
+    CODECS['zstd'] = Codec('zstd', lambda: zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj(),
+                           lambda: zstandard.ZstdDecompressor().decompressobj())
+if lz4 is not None:
+    CODECS['lz4'] = Codec('lz4', _Lz4Compressor, lz4.frame.LZ4FrameDecompressor)
+
+
+# Function to list the codecs to offer, best first
+# setting is 'auto' for every available codec, or the name of one codec
+def offered_codecs(setting):
+    if setting == 'auto':
+        return [name for name in PREFERENCE if name in CODECS]
+    if setting not in CODECS:
+        raise ValueError(f"Compression '{setting}' is not available, install it or use one of: "
+                         f"{', '.join(sorted(CODECS))}")
+    return [setting]
+
+
+# Function used by the receiver to pick the first offered codec it supports, None if there is none
+def choose_codec(offered):
+    for name in offered:
+        if name in CODECS:
+            return name
+    return None
+
+
+# Function to estimate the entropy in bits per byte of a few samples spread over an open file
+def sample_entropy(f, size):
+    counts = collections.Counter()
+    total = 0
+    step = max((size - SAMPLE_SIZE) // max(SAMPLE_COUNT - 1, 1), 1)
+    for i in range(SAMPLE_COUNT):
+        offset = min(i * step, max(size - SAMPLE_SIZE, 0))
+        f.seek(offset)
+        sample = f.read(SAMPLE_SIZE)
+        counts.update(sample)
+        total += len(sample)
+        if offset + SAMPLE_SIZE >= size:
+            break
+    if not total:
+        return 0.0
+    return -sum(count / total * math.log2(count / total) for count in counts.values())
+
+
+# Function to decide if compressing a file is worth it, by extension first and then by sampling its content
+def worth_compressing(path, f, size):
+    if size < MIN_COMPRESS_SIZE:
+        return False
+    if os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return False
+    return sample_entropy(f, size) <= MAX_ENTROPY
+
+
+# Counters for one sync, shared by every connection of a sender pool
+class CompressionStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files_compressed = 0
+        self.files_skipped = 0
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.cpu_seconds = 0.0
+
+    def add_compressed(self, raw_bytes, wire_bytes, cpu_seconds):
+        with self.lock:
+            self.files_compressed += 1
+            self.raw_bytes += raw_bytes
+            self.wire_bytes += wire_bytes
+            self.cpu_seconds += cpu_seconds
+
+    def add_skipped(self):
+        with self.lock:
+            self.files_skipped += 1
+
+    @property
+    def ratio(self):
+        return self.raw_bytes / self.wire_bytes if self.wire_bytes else 1.0
+
+    def summary(self):
+        return (f"{self.files_compressed} files compressed {self.ratio:.2f}:1 "
+                f"({self.raw_bytes / (1024 * 1024):.1f} MB to {self.wire_bytes / (1024 * 1024):.1f} MB, "
+                f"{self.cpu_seconds:.2f} s CPU), {self.files_skipped} sent uncompressed")
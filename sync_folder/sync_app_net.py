@@ -1,112 +1,66 @@
-import os
-import shutil
-import filecmp
-import socket
 import threading
 import tkinter as tk
-from tkinter import filedialog
-from tqdm import tqdm
-from datetime import datetime
+from tkinter import filedialog, ttk
+
+from copy_engine import DEFAULT_WORKERS
+from progress import FRAME_RATE, ProgressChannel
+from protocol import DEFAULT_PORT
+from sync_engine import SyncEngine
 
 # Network settings
 HOST = '127.0.0.1'  # Server IP address (change to the target machine's IP)
-PORT = 65432  # Port to listen on (non-privileged ports are > 1023)
+PORT = DEFAULT_PORT  # Port the receiver listens on (see receiver.py)
+SEND_CONNECTIONS = 4  # Persistent connections used to send files in parallel
+MAX_IN_FLIGHT_BYTES = 64 * 1024 * 1024  # Copying pauses while this much data waits to be sent
+
+# The log area and the progress bar are updated this often, and with at most this many new lines at a time
+FRAME_MS = 1000 // FRAME_RATE
+MAX_LINES_PER_FRAME = 500
+
+# Only the most recent lines are kept in the log area
+MAX_LOG_LINES = 5000
+
+# The sync thread reports its log and progress through this channel, the Tk thread drains it every frame
+channel = ProgressChannel()
 
 
-# Function to check if the source and destination directories exist
-def check_directories(src_dir, dst_dir):
-    if not os.path.exists(src_dir):
-        log_message(f"Source directory '{src_dir}' does not exist.")
-        return False
-    if not os.path.exists(dst_dir):
-        os.makedirs(dst_dir)
-        log_message(f"Destination directory '{dst_dir}' created.")
-    return True
+# Function to build the synchronization engine from the settings in the GUI
+def create_engine():
+    return SyncEngine(src_entry.get(), dst_entry.get(), delete=delete_var.get(), workers=read_workers(),
+                      use_hash=hash_var.get(), delta=delta_transfer_var.get(), dedup=dedup_var.get(),
+                      host=HOST, port=PORT, connections=SEND_CONNECTIONS,
+                      max_in_flight_bytes=MAX_IN_FLIGHT_BYTES, compression='auto' if compress_var.get() else None,
+                      log=log_message, progress=False, on_progress=channel.publish)
 
 
-# Function to send a file over the network
-def send_file(file_path, dest_ip, dest_port):
+# Function to read the number of copy threads from the GUI
+def read_workers():
     try:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((dest_ip, dest_port))
-            with open(file_path, 'rb') as f:
-                s.sendall(f.read())
-        log_message(f"Sent '{file_path}' to {dest_ip}:{dest_port}.")
-    except Exception as e:
-        log_message(f"Error sending '{file_path}': {e}")
-
-
-# Function to synchronize files between two directories
-def sync_directories(src_dir, dst_dir, delete=False):
-    log_message("Synchronization started.")
-    log_to_file("Synchronization started.")
-
-    files_to_sync = []
-    for root, dirs, files in os.walk(src_dir):
-        for directory in dirs:
-            files_to_sync.append(os.path.join(root, directory))
-        for file in files:
-            files_to_sync.append(os.path.join(root, file))
-
-    # Create a list of threads for sending files
-    threads = []
-
-    with tqdm(total=len(files_to_sync), desc="Syncing files", unit="file") as pbar:
-        for source_path in files_to_sync:
-            replica_path = os.path.join(dst_dir, os.path.relpath(source_path, src_dir))
-
-            if os.path.isdir(source_path):
-                if not os.path.exists(replica_path):
-                    os.makedirs(replica_path)
-            else:
-                if not os.path.exists(replica_path) or not filecmp.cmp(source_path, replica_path, shallow=False):
-                    pbar.set_description(f"Processing '{source_path}'")
-                    shutil.copy2(source_path, replica_path)  # Local copy
-
-                    # Start a new thread for sending the file
-                    thread = threading.Thread(target=send_file, args=(source_path, HOST, PORT))
-                    thread.start()
-                    threads.append(thread)  # Keep track of the thread
-
-            pbar.update(1)
-
-    # Wait for all threads to finish
-    for thread in threads:
-        thread.join()
-
-    if delete:
-        files_to_delete = []
-        for root, dirs, files in os.walk(dst_dir):
-            for directory in dirs:
-                files_to_delete.append(os.path.join(root, directory))
-            for file in files:
-                files_to_delete.append(os.path.join(root, file))
-
-        with tqdm(total=len(files_to_delete), desc="Deleting files", unit="file") as pbar:
-            for replica_path in files_to_delete:
-                source_path = os.path.join(src_dir, os.path.relpath(replica_path, dst_dir))
-                if not os.path.exists(source_path):
-                    pbar.set_description(f"Processing '{replica_path}'")
-                    if os.path.isdir(replica_path):
-                        shutil.rmtree(replica_path)
-                    else:
-                        os.remove(replica_path)
-                pbar.update(1)
-
-    log_message("Synchronization completed.")
-    log_to_file("Synchronization completed.")
-
-
-# Function to start the synchronization process
-def start_sync():
-    src_dir = src_entry.get()
-    dst_dir = dst_entry.get()
-    delete = delete_var.get()
-
-    if not check_directories(src_dir, dst_dir):
-        return
+        workers = int(workers_entry.get())
+        if workers < 1 or workers > 64:
+            raise ValueError
+    except ValueError:
+        log_message(f"Invalid number of workers, using {DEFAULT_WORKERS}.")
+        return DEFAULT_WORKERS
+    return workers
 
-    sync_directories(src_dir, dst_dir, delete)
+
+# Function to read the bandwidth limit from the GUI in bytes per second, None for no limit
+def read_limit():
+    try:
+        limit = float(limit_entry.get() or 0)
+        if limit < 0:
+            raise ValueError
+    except ValueError:
+        log_message("Invalid bandwidth limit, not limiting.")
+        return None
+    return limit * 1024 * 1024 or None
+
+
+# Function to apply the bandwidth limit to a running synchronization right away, 0 lifts it
+def apply_limit():
+    if engine is not None:
+        engine.set_limits(read_limit())
 
 
 # Function to select the source directory
@@ -123,58 +77,89 @@ def select_dst_dir():
     dst_entry.insert(0, dir_name)
 
 
-# Flag to control the synchronization process
-running = False
-
-
-# Function to run synchronization periodically
-def periodic_sync():
-    global running
-
-    if not running:
-        return  # Stop synchronization if running is False
-
-    interval = interval_entry.get()
-
+# Function to read the synchronization interval from the GUI, returns None if it is invalid
+def read_interval():
     try:
-        interval_ms = int(float(interval) * 1000)
-        if interval_ms < 1000 or interval_ms > 60000:
+        interval = float(interval_entry.get())
+        if interval < 1 or interval > 60:
             raise ValueError
     except ValueError:
         log_message("Invalid synchronization interval.")
-        return
+        return None
+    return interval
 
-    start_sync()
 
-    # Schedule the next synchronization after the given interval
-    root.after(interval_ms, periodic_sync)
+# Engine of the running synchronization, None while stopped
+engine = None
 
+# Thread the engine runs on, it keeps running after a stop until the files in progress are finished
+worker = None
 
-# Function to start periodic synchronization
+# (engine, interval, watch) of a synchronization waiting for the previous one to wind down
+pending = None
+
+
+# Function to start synchronizing in the background, periodically or whenever the source changes
 def start_periodic_sync():
-    global running
-    running = True
-    periodic_sync()
+    global engine, pending
+    interval = read_interval()
+    if interval is None:
+        return
+    if engine is not None:
+        engine.stop()
+    # The Tk thread never waits for the sync thread: poll_channel() starts the new one once the old one is gone
+    engine = create_engine()
+    if read_limit() is not None:
+        apply_limit()
+    pending = (engine, interval, watch_var.get())
 
 
 # Function to stop synchronization
 def stop_sync():
-    global running
-    running = False
-    log_message("Synchronization stopped.")
-    log_to_file("Synchronization stopped.")
-
-
-# Function to log messages to the text area and the log file
+    global engine, pending
+    pending = None
+    if engine is not None:
+        engine.stop()
+        engine = None
+    else:
+        log_message("Synchronization stopped.")
+
+
+# Function to show what the sync thread reported since the last frame, called on the Tk thread
+def poll_channel():
+    global worker, pending
+    lines, progress = channel.drain(MAX_LINES_PER_FRAME)
+    if lines:
+        # One insert per frame, however many messages arrived
+        log_area.insert(tk.END, ''.join(lines))
+        excess = int(log_area.index('end-1c').split('.')[0]) - MAX_LOG_LINES
+        if excess > 0:
+            log_area.delete('1.0', f'{excess + 1}.0')
+        log_area.see(tk.END)  # Scroll to the end of the log
+    if progress is not None:
+        progress_bar['value'] = progress.fraction * 100
+        progress_label.config(text=progress.describe())
+
+    if pending is not None and (worker is None or not worker.is_alive()):
+        next_engine, interval, watch = pending
+        pending = None
+        # The first pass synchronizes everything, with watch only the changed paths after that
+        worker = threading.Thread(target=next_engine.run, args=(interval, watch), name="sync-worker", daemon=True)
+        worker.start()
+
+    root.after(FRAME_MS, poll_channel)
+
+
+# Function to stop synchronization when the window is closed, copies in progress are written atomically
+def close_window():
+    if engine is not None:
+        engine.stop()
+    root.destroy()
+
+
+# Function to log messages to the text area, may be called from any thread
 def log_message(message):
-    log_area.insert(tk.END, f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {message}\n")
-    log_area.see(tk.END)  # Scroll to the end of the log
-
-
-# Function to log messages to a file
-def log_to_file(message):
-    with open("sync_log.txt", "a") as log_file:
-        log_file.write(f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')} - {message}\n")
+    channel.log(message)
 
 
 # Create the main window
@@ -201,23 +186,77 @@ delete_var = tk.BooleanVar()
 delete_check = tk.Checkbutton(root, text="Delete extraneous files in destination", variable=delete_var)
 delete_check.grid(row=2, columnspan=3, padx=10, pady=10)
 
+# Create checkbox for content hashing in the manifest
+hash_var = tk.BooleanVar()
+hash_check = tk.Checkbutton(root, text="Track content hashes (ignore touched but unchanged files)", variable=hash_var)
+hash_check.grid(row=3, columnspan=3, padx=10, pady=10)
+
+# Create checkbox for block-level delta transfer of large files
+delta_transfer_var = tk.BooleanVar()
+delta_transfer_check = tk.Checkbutton(root, text="Transfer only changed blocks of large files",
+                                      variable=delta_transfer_var)
+delta_transfer_check.grid(row=4, columnspan=3, padx=10, pady=10)
+
+# Create checkbox for content-addressed deduplication in the destination
+dedup_var = tk.BooleanVar()
+dedup_check = tk.Checkbutton(root, text="Link identical files and move renamed ones instead of copying",
+                             variable=dedup_var)
+dedup_check.grid(row=5, columnspan=3, padx=10, pady=10)
+
+# Create checkbox for event-based synchronization
+watch_var = tk.BooleanVar()
+watch_check = tk.Checkbutton(root, text="Watch for changes instead of polling (Linux inotify)", variable=watch_var)
+watch_check.grid(row=6, columnspan=3, padx=10, pady=10)
+
+# Create checkbox for compressing what is sent to the receiver
+compress_var = tk.BooleanVar()
+compress_check = tk.Checkbutton(root, text="Compress transfers (zlib, or zstd/lz4 when installed)",
+                                variable=compress_var)
+compress_check.grid(row=7, columnspan=3, padx=10, pady=10)
+
 # Create an entry for synchronization interval
 interval_label = tk.Label(root, text="Synchronization Interval (seconds, 1-60):")
-interval_label.grid(row=3, column=0, padx=10, pady=10)
+interval_label.grid(row=8, column=0, padx=10, pady=10)
 interval_entry = tk.Entry(root, width=10)
-interval_entry.grid(row=3, column=1, padx=10, pady=10)
+interval_entry.grid(row=8, column=1, padx=10, pady=10)
 interval_entry.insert(0, "10")  # Default value: 10 seconds
 
+# Create an entry for the number of copy threads
+workers_label = tk.Label(root, text="Copy Threads (1-64):")
+workers_label.grid(row=9, column=0, padx=10, pady=10)
+workers_entry = tk.Entry(root, width=10)
+workers_entry.grid(row=9, column=1, padx=10, pady=10)
+workers_entry.insert(0, str(DEFAULT_WORKERS))
+
+# Create an entry for the bandwidth limit, which can be changed while synchronizing
+limit_label = tk.Label(root, text="Bandwidth Limit (MB/s, 0 for none):")
+limit_label.grid(row=10, column=0, padx=10, pady=10)
+limit_entry = tk.Entry(root, width=10)
+limit_entry.grid(row=10, column=1, padx=10, pady=10)
+limit_entry.insert(0, "0")
+limit_button = tk.Button(root, text="Apply", command=apply_limit)
+limit_button.grid(row=10, column=2, padx=10, pady=10)
+
 # Create the start and stop buttons
 sync_button = tk.Button(root, text="Start Periodic Synchronization", command=start_periodic_sync)
-sync_button.grid(row=4, columnspan=3, padx=10, pady=10)
+sync_button.grid(row=11, columnspan=3, padx=10, pady=10)
 
 stop_button = tk.Button(root, text="Stop Synchronization", command=stop_sync)
-stop_button.grid(row=5, columnspan=3, padx=10, pady=10)
+stop_button.grid(row=12, columnspan=3, padx=10, pady=10)
+
+# Create a progress bar and a line with the files, bytes, time left and current path of the running pass
+progress_bar = ttk.Progressbar(root, length=560, maximum=100)
+progress_bar.grid(row=13, columnspan=3, padx=10, pady=(10, 0))
+progress_label = tk.Label(root, text="Not synchronizing.", width=80, anchor='w')
+progress_label.grid(row=14, columnspan=3, padx=10)
 
 # Create a text area to display log messages
 log_area = tk.Text(root, height=10, width=80)
-log_area.grid(row=6, columnspan=3, padx=10, pady=10)
+log_area.grid(row=15, columnspan=3, padx=10, pady=10)
+
+# Show the reports of the sync thread, and stop it when the window is closed
+root.protocol("WM_DELETE_WINDOW", close_window)
+root.after(FRAME_MS, poll_channel)
 
 # Start the Tkinter main loop
 root.mainloop()
@@ -0,0 +1,479 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import signal
+import sys
+import threading
+import time
+
+from tqdm import tqdm
+
+from async_pipeline import plan_sync_async
+from copy_engine import CopyEngine, DEFAULT_WORKERS
+from manifest import Manifest
+from planner import detect_moves, group_duplicates, plan_sync
+from progress import COPYING, DONE, SyncProgress
+from protocol import DEFAULT_PORT, parse_address
+from resumable import partial_path
+from run_log import open_run_log
+from sender_pool import DEFAULT_CONNECTIONS, DEFAULT_MAX_IN_FLIGHT_BYTES, SenderPool
+from stream_compression import CODECS, offered_codecs
+from throttle import ScheduleWindow, Throttle, parse_rate
+from watcher import FULL_SYNC, ChangeWatcher, watch_available
+
+# Seconds between synchronizations when polling
+DEFAULT_INTERVAL = 10
+
+# Seconds between checks for settled changes, seconds between safety-net full synchronizations in watch mode
+WATCH_POLL = 0.2
+RECONCILE_INTERVAL = 600
+
+# JSON lines file that gets the start and end of every synchronization and a record with its metrics
+LOG_FILE = "sync_log.jsonl"
+
+logger = logging.getLogger("sync_engine")
+
+
+# Synchronizes a source directory into a replica, and optionally sends every copied file to a receiver
+# compression is None, 'auto' or a codec name, and only applies to what is sent to the receiver
+# dedup links identical content inside the replica and turns renames into moves (content-addressed mode)
+# io_concurrency overlaps up to that many listings and stat calls while planning, for network filesystems
+# bytes_per_s, ops_per_s and the schedule (a list of ScheduleWindow) limit the local copies and, separately,
+# what is sent to the receiver; set_limits() changes both while the engine runs
+# Messages go to the log callback and on_progress gets the SyncProgress of the running pass whenever it moves on,
+# so the same engine serves the GUI apps and the command line; both callbacks are called from the sync threads
+class SyncEngine:
+    def __init__(self, src_dir, dst_dir, delete=False, workers=DEFAULT_WORKERS, use_hash=False, delta=False,
+                 dedup=False, dry_run=False, host=None, port=DEFAULT_PORT, connections=DEFAULT_CONNECTIONS,
+                 max_in_flight_bytes=DEFAULT_MAX_IN_FLIGHT_BYTES, compression=None, log=None, log_file=LOG_FILE,
+                 progress=True, io_concurrency=None, on_progress=None, bytes_per_s=None, ops_per_s=None,
+                 schedule=None):
+        self.src_dir = src_dir
+        self.dst_dir = dst_dir
+        self.delete = delete
+        self.workers = workers
+        self.io_concurrency = io_concurrency
+        self.use_hash = use_hash
+        self.delta = delta
+        self.dedup = dedup
+        self.dry_run = dry_run
+        self.host = host
+        self.port = port
+        self.connections = connections
+        self.max_in_flight_bytes = max_in_flight_bytes
+        self.compression = offered_codecs(compression) if compression else None
+        self.log = log or logger.info
+        self.run_log = open_run_log(log_file) if log_file else None
+        self.progress = progress
+        self.on_progress = on_progress
+        self.throttle = Throttle(bytes_per_s, ops_per_s, schedule)
+        self.net_throttle = Throttle(bytes_per_s, ops_per_s, schedule) if host else None
+        self.watcher = None
+        self.last_full_sync = 0.0
+        self.stopped = threading.Event()
+
+    def publish_progress(self, progress):
+        if self.on_progress:
+            self.on_progress(progress)
+
+    # Replace the configured limits of the local copies and the transfers, None for both restores them
+    # Takes effect within a fraction of a second, also in the middle of a pass
+    def set_limits(self, bytes_per_s=None, ops_per_s=None):
+        for throttle in (self.throttle, self.net_throttle):
+            if throttle is not None:
+                throttle.set_override(bytes_per_s, ops_per_s)
+        if bytes_per_s is None and ops_per_s is None:
+            self.log_event("Limits reset to the configuration.")
+        else:
+            self.log_event(f"Limits set to {describe_limits(bytes_per_s, ops_per_s)}.")
+
+    # Log a message and append it to the run log
+    def log_event(self, message):
+        self.log(message)
+        if self.run_log is not None:
+            self.run_log.write('message', message=message)
+
+    # Check if the source directory exists and create the destination if needed
+    def check_directories(self):
+        if not os.path.exists(self.src_dir):
+            self.log(f"Source directory '{self.src_dir}' does not exist.")
+            return False
+        if not os.path.exists(self.dst_dir):
+            if self.dry_run:
+                self.log(f"Destination directory '{self.dst_dir}' would be created.")
+            else:
+                os.makedirs(self.dst_dir)
+                self.log(f"Destination directory '{self.dst_dir}' created.")
+        return True
+
+    # Synchronize the whole tree, or with changes (relative paths reported by the watcher) only those paths
+    # Returns True if every file was handled without errors
+    def sync(self, changes=None):
+        self.log_event("Dry run started." if self.dry_run else "Synchronization started.")
+        progress = SyncProgress()
+        self.publish_progress(progress)
+        started = time.monotonic()
+        ok = False
+        metrics = {'files_scanned': 0, 'files_copied': 0, 'files_linked': 0, 'files_moved': 0, 'files_deleted': 0,
+                   'bytes_copied': 0, 'bytes_sent': 0, 'errors': 0, 'throttled_seconds': 0.0}
+
+        # The manifest lets unchanged files be skipped without reading them
+        # Content-addressed mode needs the hash of every replica
+        manifest = Manifest(self.dst_dir, use_hash=self.use_hash or self.dedup, read_only=self.dry_run)
+        try:
+            # One walk of both trees decides everything, nothing is written before the plan is complete
+            if self.io_concurrency:
+                plan = plan_sync_async(self.src_dir, self.dst_dir, manifest, self.delete, changes, self.io_concurrency)
+            else:
+                plan = plan_sync(self.src_dir, self.dst_dir, manifest, self.delete, changes)
+            if self.dedup:
+                hashed = manifest.backfill_digests()
+                if hashed:
+                    self.log(f"Hashed {hashed} replicas recorded before deduplication was turned on.")
+                if plan.deletes:
+                    detect_moves(plan, manifest, self.src_dir)
+                group_duplicates(plan, self.src_dir)
+            metrics['files_scanned'] = plan.unchanged + len(plan.copies) + len(plan.moves)
+            metrics['errors'] = len(plan.errors)
+            for path, error in plan.errors:
+                self.log(f"Error reading '{path}': {error}")
+            if self.dry_run:
+                for line in plan.report():
+                    self.log(line)
+            self.log(plan.summary())
+            ok = not plan.errors
+            if not self.dry_run:
+                ok = self._run_plan(plan, manifest, progress, metrics) and ok
+            manifest.commit()
+        except Exception as e:
+            manifest.rollback()
+            metrics['failure'] = str(e)
+            raise
+        finally:
+            manifest.close()
+            progress.stage = DONE
+            self.publish_progress(progress)
+            if self.run_log is not None:
+                self.run_log.write('run', src=os.path.abspath(self.src_dir), dst=os.path.abspath(self.dst_dir),
+                                   dry_run=self.dry_run, changed_paths=None if changes is None else len(changes), ok=ok,
+                                   duration=round(time.monotonic() - started, 3), **metrics)
+
+        self.log_event("Dry run completed." if self.dry_run else "Synchronization completed.")
+        return ok
+
+    # Move renamed files, remove replicas that have to go, then create directories and copy files
+    # The counters of what was done are added to metrics
+    def _run_plan(self, plan, manifest, progress, metrics):
+        engine = CopyEngine(workers=self.workers, delta=self.delta, dedup=self.dedup, throttle=self.throttle)
+        throttled_before = self.throttle.throttled_seconds
+        net_throttled_before = self.net_throttle.throttled_seconds if self.net_throttle is not None else 0.0
+        pool = None
+        if self.host:
+            # Copied files are handed to a fixed pool of pipelined connections, which pushes back when it falls behind
+            pool = SenderPool(self.host, self.port, connections=self.connections,
+                              max_in_flight_bytes=self.max_in_flight_bytes, delta=self.delta,
+                              compression=self.compression, throttle=self.net_throttle)
+            pool.start()
+
+        # Function to queue a freshly copied file for sending
+        def send_copied(source_path):
+            pool.submit(source_path, os.path.relpath(source_path, self.src_dir))
+
+        ok = True
+        bytes_moved = 0
+        try:
+            # Moves come first, the old replica may be inside a directory that is deleted next
+            for old_path, rel_path, src_st, digest in plan.moves:
+                self.throttle.operation()
+                try:
+                    self._move(old_path, rel_path, src_st, digest, manifest)
+                    bytes_moved += src_st.st_size
+                    metrics['files_moved'] += 1
+                    if pool:
+                        send_copied(os.path.join(self.src_dir, rel_path))
+                except OSError as e:
+                    self.log(f"Cannot move '{old_path}' to '{rel_path}', copying it: {e}")
+                    plan.copies.append((rel_path, src_st, None))
+
+            # Deletes come next, a replica whose type changed has to make room for the new copy
+            for rel_path, is_dir in plan.deletes:
+                if self.stopped.is_set():
+                    break
+                self.throttle.operation()
+                try:
+                    self._remove(rel_path, is_dir, manifest)
+                    metrics['files_deleted'] += 1
+                except OSError as e:
+                    self.log(f"Error deleting '{rel_path}': {e}")
+                    metrics['errors'] += 1
+                    ok = False
+
+            total = len(plan.mkdirs) + len(plan.copies)
+            progress.stage = COPYING
+            progress.total_files = total
+            progress.total_bytes = plan.bytes_to_copy
+            progress.started = time.monotonic()
+            with tqdm(total=total, desc="Syncing files", unit="file", disable=not self.progress) as pbar:
+                # Function to count a handled directory or file, called from the copy threads
+                def on_progress(source_path, size):
+                    pbar.update(1)
+                    progress.advance(source_path, size)
+                    self.publish_progress(progress)
+
+                stats = engine.sync(self.src_dir, self.dst_dir, plan, manifest, on_progress=on_progress,
+                                    on_copied=send_copied if pool else None, cancelled=self.stopped)
+        finally:
+            # Wait for the senders to finish
+            send_stats = pool.close() if pool is not None else None
+
+        for source_path, error in stats.errors:
+            self.log(f"Error copying '{source_path}': {error}")
+        self.log(stats.summary())
+        if self.dedup:
+            self.log(f"Deduplication saved {(stats.bytes_linked + bytes_moved) / (1024 * 1024):.1f} MB: "
+                     f"{stats.files_linked} files linked, {metrics['files_moved']} renames moved.")
+        metrics['files_copied'] += stats.files_copied
+        metrics['files_linked'] += stats.files_linked
+        metrics['bytes_copied'] += stats.bytes_copied
+        metrics['errors'] += len(stats.errors)
+        ok = ok and not stats.errors
+        if send_stats is not None:
+            for file_path, error in send_stats.errors:
+                self.log(f"Error sending '{file_path}': {error}")
+            self.log(f"{send_stats.summary()} to {self.host}:{self.port}.")
+            metrics['bytes_sent'] += send_stats.bytes_sent
+            metrics['errors'] += len(send_stats.errors)
+            ok = ok and not send_stats.errors
+
+        throttled = self.throttle.throttled_seconds - throttled_before
+        net_throttled = 0.0
+        if self.net_throttle is not None:
+            net_throttled = self.net_throttle.throttled_seconds - net_throttled_before
+        if throttled or net_throttled:
+            self.log(f"Throttled for {throttled:.1f} s copying and {net_throttled:.1f} s sending "
+                     f"(now limited to {describe_limits(*self.throttle.current_limits())}).")
+        metrics['throttled_seconds'] += round(throttled + net_throttled, 3)
+        return ok
+
+    # Apply a detected rename to the replica instead of copying the file again
+    def _move(self, old_path, rel_path, src_st, digest, manifest):
+        replica_path = os.path.join(self.dst_dir, rel_path)
+        os.makedirs(os.path.dirname(replica_path), exist_ok=True)
+        os.rename(os.path.join(self.dst_dir, old_path), replica_path)
+        shutil.copystat(os.path.join(self.src_dir, rel_path), replica_path)
+        manifest.forget(old_path)
+        manifest.record(rel_path, src_st, os.stat(replica_path), digest)
+
+    def _remove(self, rel_path, is_dir, manifest):
+        remove_replica(self.dst_dir, rel_path, is_dir, manifest)
+
+    # Start watching the source directory, returns False if that is not possible
+    def start_watching(self):
+        if not watch_available():
+            self.log("Watching for changes is not available on this system, using the interval.")
+            return False
+        try:
+            self.watcher = ChangeWatcher(self.src_dir)
+        except OSError as e:
+            self.log(f"Cannot watch the source directory: {e}")
+            return False
+        self.watcher.start()
+        self.last_full_sync = time.monotonic()
+        return True
+
+    # Synchronize the paths the watcher reported since the last call
+    def watch_step(self):
+        watcher = self.watcher
+        if watcher is None:
+            return
+        if watcher.error is not None:
+            # The watcher stopped, a full pass covers what it missed and run() goes back to the interval
+            self.log(f"Watching for changes stopped: {watcher.error}. Using the interval instead.")
+            self.watcher = None
+            self.last_full_sync = time.monotonic()
+            self.sync()
+            return
+        changes = watcher.take_changes()
+        if changes is FULL_SYNC or time.monotonic() - self.last_full_sync >= RECONCILE_INTERVAL:
+            # Events were lost, or the periodic full pass that catches anything the watcher missed is due
+            self.last_full_sync = time.monotonic()
+            self.sync()
+        elif changes:
+            self.sync(changes)
+
+    # Run until stop() is called, every interval seconds or, with watch, whenever the source changes
+    def run(self, interval=DEFAULT_INTERVAL, watch=False):
+        self.stopped.clear()
+        if watch and self.start_watching():
+            pause, step = WATCH_POLL, self.watch_step
+        else:
+            pause, step = interval, self.sync
+        # A full pass first, in watch mode only the changed paths are synchronized after that
+        self._run_pass(self.sync)
+        while not self.stopped.wait(pause):
+            self._run_pass(step)
+            if step == self.watch_step and self.watcher is None and not self.stopped.is_set():
+                pause, step = interval, self.sync
+
+    # A failed pass is logged and retried at the next interval instead of ending the daemon
+    def _run_pass(self, step):
+        try:
+            if self.check_directories():
+                step()
+        except Exception as e:
+            logger.debug("Synchronization failed", exc_info=True)
+            self.log(f"Synchronization failed: {e}")
+
+    # Ask a running synchronization to stop, files already being copied are finished
+    def stop(self):
+        self.stopped.set()
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        self.log_event("Synchronization stopped.")
+
+
+# Function to remove a replica file or directory and what the manifest knows about it
+def remove_replica(dst_dir, rel_path, is_dir, manifest):
+    replica_path = os.path.join(dst_dir, rel_path)
+    try:
+        if is_dir:
+            shutil.rmtree(replica_path)
+        else:
+            os.remove(replica_path)
+    except FileNotFoundError:
+        pass  # A renamed file that was moved away already
+    if not is_dir and os.path.exists(partial_path(replica_path)):
+        # An interrupted copy of the file has nothing left to resume
+        os.remove(partial_path(replica_path))
+    manifest.forget(rel_path)
+
+
+# Function to describe a pair of limits for the log, like "10.0 MB/s and 200 files/s"
+def describe_limits(bytes_per_s, ops_per_s):
+    parts = []
+    if bytes_per_s:
+        parts.append(f"{bytes_per_s / (1024 * 1024):.1f} MB/s")
+    if ops_per_s:
+        parts.append(f"{ops_per_s:g} files/s")
+    return " and ".join(parts) or "no limit"
+
+
+# Function to read live limits from a JSON file like {"bwlimit": "5M", "iops_limit": 100}
+# A missing file or one without limits means the configured limits apply
+def read_limits_file(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            limits = json.load(f)
+    except FileNotFoundError:
+        return None, None
+    bytes_per_s = parse_rate(limits['bwlimit']) if limits.get('bwlimit') else None
+    ops_per_s = parse_rate(limits['iops_limit']) if limits.get('iops_limit') else None
+    return bytes_per_s, ops_per_s
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synchronize a source directory into a replica, once or as a daemon.")
+    parser.add_argument("--src", required=True, help="source directory")
+    parser.add_argument("--dst", action="append", default=[],
+                        help="destination directory the replica is kept in, may be given more than once to keep "
+                             "several replicas from a single scan and read of the source; without it every pass "
+                             "sends the whole source (only the changes with --watch) to the --host receivers")
+    parser.add_argument("--interval", type=float, default=0,
+                        help="seconds between synchronizations, 0 runs a single synchronization and exits")
+    parser.add_argument("--watch", action="store_true",
+                        help="synchronize changed paths as soon as they settle (Linux inotify) instead of polling")
+    parser.add_argument("--delete", action="store_true", help="delete extraneous files in the destination")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="number of copy threads")
+    parser.add_argument("--io-concurrency", type=int, default=0,
+                        help="directory listings and stat calls kept in flight while planning, for NFS or SMB "
+                             "mounts where each one is a network round trip (0 plans sequentially)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only report what would be copied and deleted, then exit")
+    parser.add_argument("--hash", action="store_true",
+                        help="track content hashes (ignore touched but unchanged files)")
+    parser.add_argument("--delta", action="store_true",
+                        help="transfer only changed blocks of large files; a replica whose blocks did not move "
+                             "is patched in place, so an interrupted sync leaves it partly updated until the next "
+                             "pass compares it with the source again")
+    parser.add_argument("--dedup", action="store_true",
+                        help="reflink or hardlink identical files in the destination and move renamed files")
+    parser.add_argument("--host", action="append", default=[],
+                        help="also send copied files to a receiver on this host (HOST or HOST:PORT), "
+                             "may be given more than once")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port of receivers given without one")
+    parser.add_argument("--compress", choices=("auto",) + tuple(sorted(CODECS)), default=None,
+                        help="compress what is sent to the receiver, auto picks the best codec both sides have")
+    parser.add_argument("--bwlimit", type=parse_rate, default=None,
+                        help="limit copying, and separately sending, to this many bytes per second "
+                             "(K, M and G suffixes, 0 for no limit)")
+    parser.add_argument("--iops-limit", type=parse_rate, default=None,
+                        help="limit the files and directories created, deleted or sent per second")
+    parser.add_argument("--schedule", type=ScheduleWindow.parse, action="append", default=[],
+                        help="limits for a time of day like 'mon-fri 08:00-18:00=10M,200' (bytes/s, files/s), "
+                             "may be given more than once, the first window that applies wins")
+    parser.add_argument("--limits-file", default=None,
+                        help="JSON file like {\"bwlimit\": \"5M\", \"iops_limit\": 100} that overrides the "
+                             "limits, read at start and again on SIGHUP")
+    parser.add_argument("--log-file", default=LOG_FILE, help="JSON lines file the synchronization runs and their "
+                                                             "metrics are appended to, empty to disable")
+    args = parser.parse_args()
+    if args.interval < 0 or args.workers < 1 or args.io_concurrency < 0:
+        parser.error("--interval and --io-concurrency must not be negative and --workers must be at least 1")
+    if not args.dst and not args.host:
+        parser.error("at least one --dst or --host is required")
+    fanout = len(args.dst) != 1 or len(args.host) > 1
+    if fanout and (args.delta or args.dedup):
+        parser.error("--delta and --dedup need a single --dst and --host")
+    try:
+        receivers = [parse_address(host, args.port) for host in args.host]
+    except ValueError as e:
+        parser.error(str(e))
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s", datefmt='%Y-%m-%d %H:%M:%S')
+    if fanout:
+        # Imported here, the fan-out engine builds on this module
+        from fanout import FanoutEngine
+        engine = FanoutEngine(args.src, args.dst, receivers, delete=args.delete, workers=args.workers,
+                              use_hash=args.hash, dry_run=args.dry_run, compression=args.compress,
+                              log_file=args.log_file, progress=sys.stderr.isatty(), bytes_per_s=args.bwlimit,
+                              ops_per_s=args.iops_limit, schedule=args.schedule)
+    else:
+        host, port = receivers[0] if receivers else (None, args.port)
+        engine = SyncEngine(args.src, args.dst[0], delete=args.delete, workers=args.workers, use_hash=args.hash,
+                            delta=args.delta, dedup=args.dedup, dry_run=args.dry_run, host=host, port=port,
+                            compression=args.compress, log_file=args.log_file, progress=sys.stderr.isatty(),
+                            io_concurrency=args.io_concurrency, bytes_per_s=args.bwlimit, ops_per_s=args.iops_limit,
+                            schedule=args.schedule)
+
+    # Function to apply the limits file, the running pass slows down or speeds up right away
+    def reload_limits():
+        try:
+            bytes_per_s, ops_per_s = read_limits_file(args.limits_file)
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logger.error(f"Cannot read the limits file '{args.limits_file}': {e}")
+            return
+        engine.set_limits(bytes_per_s, ops_per_s)
+
+    if args.limits_file:
+        reload_limits()
+        # systemctl reload sync-folder sends SIGHUP
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, lambda signum, frame: reload_limits())
+
+    # systemd stops the service with SIGTERM: finish the files in progress, then exit
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: engine.stop())
+
+    if args.dry_run or (args.interval == 0 and not args.watch):
+        if not engine.check_directories():
+            return 1
+        return 0 if engine.sync() else 1
+    engine.run(args.interval or DEFAULT_INTERVAL, watch=args.watch)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+import os
+import threading
+
+import pytest
+
+import copy_engine
+from copy_engine import CopyEngine
+from manifest import Manifest
+from planner import plan_sync
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    for i in range(40):
+        write(src / f'dir{i % 4}' / f'file{i}.txt', f'content {i}\n'.encode() * (i + 1))
+    dst.mkdir()
+    return str(src), str(dst)
+
+
+@pytest.fixture
+def manifest(dirs):
+    manifest = Manifest(dirs[1])
+    yield manifest
+    manifest.conn.close()
+
+
+def test_parallel_copy(dirs, manifest):
+    src, dst = dirs
+    progress, copied = [], []
+    lock = threading.Lock()
+
+    def on_progress(path, size):
+        with lock:
+            progress.append(path)
+
+    def on_copied(path):
+        with lock:
+            copied.append(path)
+
+    stats = CopyEngine(workers=4, queue_size=4).sync(src, dst, plan_sync(src, dst, manifest), manifest,
+                                                     on_progress, on_copied)
+    assert not stats.errors
+    assert (stats.files_checked, stats.files_copied) == (40, 40)
+    assert len(progress) == 44 and len(copied) == 40
+    for i in range(40):
+        rel_path = os.path.join(f'dir{i % 4}', f'file{i}.txt')
+        assert read(os.path.join(dst, rel_path)) == read(os.path.join(src, rel_path))
+
+    stats = CopyEngine(workers=4).sync(src, dst, plan_sync(src, dst, manifest), manifest)
+    assert (stats.files_checked, stats.files_copied) == (0, 0)
+
+
+def test_cancelled_pass_starts_nothing(dirs, manifest):
+    src, dst = dirs
+    cancelled = threading.Event()
+    cancelled.set()
+    stats = CopyEngine().sync(src, dst, plan_sync(src, dst, manifest), manifest, cancelled=cancelled)
+    assert stats.files_copied == 0
+
+
+# Errors of one file, whether an OSError or anything else, are counted and do not stop the others
+def test_errors_are_counted(dirs, manifest, monkeypatch):
+    src, dst = dirs
+    real_copy = copy_engine.copy_file
+
+    def flaky_copy(source_path, *args, **kwargs):
+        if source_path.endswith('file3.txt'):
+            raise OSError("disk full")
+        if source_path.endswith('file5.txt'):
+            raise RuntimeError("bug")
+        return real_copy(source_path, *args, **kwargs)
+
+    monkeypatch.setattr(copy_engine, 'copy_file', flaky_copy)
+    stats = CopyEngine(workers=3).sync(src, dst, plan_sync(src, dst, manifest), manifest)
+    assert sorted(os.path.basename(path) for path, error in stats.errors) == ['file3.txt', 'file5.txt']
+    assert (stats.files_checked, stats.files_copied) == (40, 38)
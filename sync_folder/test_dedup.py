@@ -0,0 +1,124 @@
+import os
+
+import pytest
+
+from copy_engine import CopyEngine
+from dedup import clone_file
+from manifest import Manifest
+from planner import group_duplicates, plan_sync
+from sync_engine import SyncEngine
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    dst.mkdir()
+    return str(src), str(dst)
+
+
+# Function to run one pass of the engine, returns what it logged
+def sync(src, dst, **options):
+    messages = []
+    engine = SyncEngine(src, dst, log=messages.append, log_file=None, progress=False, **options)
+    assert engine.check_directories()
+    assert engine.sync()
+    return messages
+
+
+def test_clone_file(tmp_path):
+    write(tmp_path / 'existing', b'content')
+    write(tmp_path / 'source', b'content')
+    assert clone_file(str(tmp_path / 'existing'), str(tmp_path / 'target'), str(tmp_path / 'source')) in \
+        ('reflink', 'hardlink')
+    assert read(tmp_path / 'target') == b'content'
+    assert [name for name in os.listdir(tmp_path) if name.startswith('.')] == []
+
+
+def test_group_duplicates(dirs):
+    src, dst = dirs
+    for name in ('a', 'b', 'c'):
+        write(os.path.join(src, f'{name}.bin'), b'same content')
+    write(os.path.join(src, 'd.bin'), b'other conten')
+    write(os.path.join(src, 'e.bin'), b'unique size')
+    manifest = Manifest(dst, use_hash=True)
+    try:
+        plan = plan_sync(src, dst, manifest)
+        group_duplicates(plan, src)
+    finally:
+        manifest.conn.close()
+    assert plan.duplicates == {'b.bin', 'c.bin'}
+    assert sorted(plan.digests) == ['a.bin', 'b.bin', 'c.bin', 'd.bin']
+
+
+# Identical new files of one pass are copied once and linked, however many workers copy them
+@pytest.mark.parametrize('workers', [1, 4])
+def test_identical_files_of_one_pass(dirs, workers):
+    src, dst = dirs
+    data = os.urandom(256 * 1024)
+    for i in range(3):
+        write(os.path.join(src, f'dir{i}', 'copy.bin'), data)
+    manifest = Manifest(dst, use_hash=True)
+    try:
+        plan = plan_sync(src, dst, manifest)
+        group_duplicates(plan, src)
+        stats = CopyEngine(workers=workers, dedup=True).sync(src, dst, plan, manifest)
+    finally:
+        manifest.conn.close()
+    assert not stats.errors
+    assert (stats.files_copied, stats.files_linked) == (1, 2)
+    for i in range(3):
+        assert read(os.path.join(dst, f'dir{i}', 'copy.bin')) == data
+
+
+# A new file with the content of a replica from an earlier pass is linked to it
+def test_link_to_earlier_replica(dirs):
+    src, dst = dirs
+    write(os.path.join(src, 'first.bin'), b'x' * 10000)
+    sync(src, dst, dedup=True)
+    write(os.path.join(src, 'second.bin'), b'x' * 10000)
+    messages = sync(src, dst, dedup=True)
+    assert any('1 files linked' in message for message in messages)
+    assert read(os.path.join(dst, 'second.bin')) == b'x' * 10000
+
+
+# Turning dedup on for a replica made without it hashes the recorded replicas once, so renames become moves
+def test_rename_after_enabling_dedup(dirs):
+    src, dst = dirs
+    write(os.path.join(src, 'old.bin'), b'y' * 10000)
+    write(os.path.join(src, 'keep.bin'), b'z' * 10000)
+    sync(src, dst)
+    inode = os.stat(os.path.join(dst, 'old.bin')).st_ino
+
+    os.rename(os.path.join(src, 'old.bin'), os.path.join(src, 'new.bin'))
+    messages = sync(src, dst, dedup=True, delete=True)
+    assert "Hashed 2 replicas recorded before deduplication was turned on." in messages
+    assert any('1 renames moved' in message for message in messages)
+    assert sorted(os.listdir(dst))[-2:] == ['keep.bin', 'new.bin']
+    assert os.stat(os.path.join(dst, 'new.bin')).st_ino == inode
+
+    assert not any(message.startswith('Hashed') for message in sync(src, dst, dedup=True))
+
+
+# A replica changed behind the manifest's back no longer holds the recorded content, it is not moved
+def test_changed_replica_is_not_moved(dirs):
+    src, dst = dirs
+    write(os.path.join(src, 'old.bin'), b'y' * 10000)
+    sync(src, dst, dedup=True)
+    write(os.path.join(dst, 'old.bin'), b'changed')
+
+    os.rename(os.path.join(src, 'old.bin'), os.path.join(src, 'new.bin'))
+    messages = sync(src, dst, dedup=True, delete=True)
+    assert any('0 renames moved' in message for message in messages)
+    assert read(os.path.join(dst, 'new.bin')) == b'y' * 10000
+    assert not os.path.exists(os.path.join(dst, 'old.bin'))
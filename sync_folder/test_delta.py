@@ -0,0 +1,89 @@
+import io
+import os
+import random
+
+from delta import COPY, DATA, Signature, apply_delta, compute_delta, delta_copy, file_signature, is_in_place
+
+BLOCK = 1024
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def random_bytes(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+
+def test_unchanged_file_is_all_copies(tmp_path):
+    data = random_bytes(10 * BLOCK + 100)
+    write(tmp_path / 'src', data)
+    write(tmp_path / 'dst', data)
+
+    ops = compute_delta(tmp_path / 'src', file_signature(tmp_path / 'dst', BLOCK))
+    assert all(kind == COPY for kind, offset, length, index in ops)
+    assert delta_copy(tmp_path / 'src', tmp_path / 'dst', BLOCK) == 0
+    assert read(tmp_path / 'dst') == data
+
+
+# Changed blocks stay where they were, so the replica is patched in place and only they are written
+def test_in_place_patch(tmp_path):
+    old = random_bytes(20 * BLOCK)
+    new = bytearray(old)
+    new[3 * BLOCK + 10:3 * BLOCK + 20] = b'x' * 10
+    new[15 * BLOCK:15 * BLOCK + 5] = b'y' * 5
+    new = bytes(new[:-300])
+    write(tmp_path / 'src', new)
+    write(tmp_path / 'dst', old)
+    inode = os.stat(tmp_path / 'dst').st_ino
+
+    written = delta_copy(tmp_path / 'src', tmp_path / 'dst', BLOCK)
+    assert read(tmp_path / 'dst') == new
+    assert os.stat(tmp_path / 'dst').st_ino == inode
+    assert written < 3 * BLOCK
+    assert os.stat(tmp_path / 'dst').st_mtime_ns == os.stat(tmp_path / 'src').st_mtime_ns
+
+
+# Inserted bytes shift the blocks after them, the replica is rebuilt next to the old one and renamed
+def test_shifted_blocks_are_found(tmp_path):
+    old = random_bytes(20 * BLOCK)
+    new = old[:5 * BLOCK + 7] + b'inserted' + old[5 * BLOCK + 7:]
+    write(tmp_path / 'src', new)
+    write(tmp_path / 'dst', old)
+
+    ops = compute_delta(tmp_path / 'src', file_signature(tmp_path / 'dst', BLOCK))
+    assert not is_in_place(ops, BLOCK)
+    written = delta_copy(tmp_path / 'src', tmp_path / 'dst', BLOCK)
+    assert read(tmp_path / 'dst') == new
+    assert written < 2 * BLOCK
+    assert sorted(os.listdir(tmp_path)) == ['dst', 'src']
+
+
+def test_signature_round_trip(tmp_path):
+    write(tmp_path / 'dst', random_bytes(7 * BLOCK + 33))
+    signature = file_signature(tmp_path / 'dst', BLOCK)
+    copy = Signature.from_bytes(signature.to_bytes(), BLOCK)
+    assert copy.blocks == signature.blocks
+    assert copy.strong_index == signature.strong_index
+    assert copy.tail == signature.tail
+
+
+# The receiver side: literal bytes come from the network instead of the source file
+def test_apply_delta_rebuilds_the_source(tmp_path):
+    old = random_bytes(12 * BLOCK, seed=1)
+    new = random_bytes(BLOCK, seed=2) + old[4 * BLOCK:] + old[:2 * BLOCK]
+    write(tmp_path / 'src', new)
+    write(tmp_path / 'dst', old)
+
+    ops = compute_delta(tmp_path / 'src', file_signature(tmp_path / 'dst', BLOCK))
+    assert any(kind == DATA for kind, offset, length, index in ops)
+    out = io.BytesIO()
+    with open(tmp_path / 'dst', 'rb') as replica:
+        apply_delta(replica, ops, BLOCK, lambda offset, length: new[offset:offset + length], out)
+    assert out.getvalue() == new
@@ -0,0 +1,108 @@
+import os
+import threading
+
+import pytest
+
+from fanout import FanoutEngine
+from manifest import MANIFEST_NAME
+from planner import plan_source
+from receiver import SyncReceiver
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def tree(root):
+    return sorted(os.path.relpath(os.path.join(dirpath, name), root)
+                  for dirpath, dirnames, filenames in os.walk(root) for name in filenames
+                  if not name.startswith(MANIFEST_NAME))
+
+
+@pytest.fixture
+def src(tmp_path):
+    src = tmp_path / 'src'
+    write(src / 'a.txt', b'a')
+    write(src / 'sub' / 'b.txt', b'bb' * 1000)
+    return str(src)
+
+
+@pytest.fixture
+def receiver(tmp_path):
+    server = SyncReceiver(tmp_path / 'remote', host='127.0.0.1', port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+# A fan-out engine set up like the command line does it, logging into messages
+def engine(src, dst_dirs, messages, **options):
+    fanout = FanoutEngine(src, dst_dirs, log=messages.append, log_file=None, progress=False, **options)
+    assert fanout.check_directories()
+    return fanout
+
+
+def test_several_destinations(src, tmp_path):
+    dst_dirs = [str(tmp_path / f'dst{i}') for i in range(3)]
+    messages = []
+    assert engine(src, dst_dirs, messages).sync()
+    for dst in dst_dirs:
+        assert tree(dst) == ['a.txt', os.path.join('sub', 'b.txt')]
+        assert read(os.path.join(dst, 'sub', 'b.txt')) == b'bb' * 1000
+
+    # Each replica gets what it lacks, the others are left alone
+    write(os.path.join(src, 'c.txt'), b'c')
+    os.remove(os.path.join(dst_dirs[1], 'a.txt'))
+    messages.clear()
+    assert engine(src, dst_dirs, messages, delete=True).sync()
+    assert all(tree(dst) == ['a.txt', 'c.txt', os.path.join('sub', 'b.txt')] for dst in dst_dirs)
+    copied = [message for message in messages if message.startswith(tuple(dst_dirs)) and 'copied' in message]
+    assert len(copied) == 3
+
+
+# A destination that cannot be written only loses its own files
+def test_failing_destination(src, tmp_path):
+    write(tmp_path / 'blocked', b'not a directory')
+    dst_dirs = [str(tmp_path / 'dst'), str(tmp_path / 'blocked')]
+    assert not engine(src, dst_dirs, []).sync()
+    assert tree(dst_dirs[0]) == ['a.txt', os.path.join('sub', 'b.txt')]
+
+
+def test_destinations_and_receiver(src, tmp_path, receiver):
+    dst_dirs = [str(tmp_path / 'dst0'), str(tmp_path / 'dst1')]
+    assert engine(src, dst_dirs, [], receivers=[('127.0.0.1', receiver.port)]).sync()
+    assert tree(receiver.root) == ['a.txt', os.path.join('sub', 'b.txt')]
+    assert read(os.path.join(receiver.root, 'sub', 'b.txt')) == b'bb' * 1000
+
+
+# Without a local replica every pass sends the source, with changes only those paths
+def test_receivers_only(src, receiver):
+    with pytest.raises(ValueError):
+        FanoutEngine(src, [], log_file=None)
+    messages = []
+    assert engine(src, [], messages, receivers=[('127.0.0.1', receiver.port)]).sync()
+    assert tree(receiver.root) == ['a.txt', os.path.join('sub', 'b.txt')]
+
+    write(os.path.join(src, 'sub', 'b.txt'), b'changed')
+    os.remove(os.path.join(receiver.root, 'a.txt'))
+    assert engine(src, [], messages, receivers=[('127.0.0.1', receiver.port)]).sync([os.path.join('sub', 'b.txt')])
+    assert tree(receiver.root) == [os.path.join('sub', 'b.txt')]
+    assert read(os.path.join(receiver.root, 'sub', 'b.txt')) == b'changed'
+
+
+def test_plan_source(src):
+    assert [rel_path for rel_path, src_st, dst_st in plan_source(src).copies] == \
+        ['a.txt', os.path.join('sub', 'b.txt')]
+    plan = plan_source(src, ['sub', 'gone.txt', os.path.join('sub', 'b.txt')])
+    assert [rel_path for rel_path, src_st, dst_st in plan.copies] == [os.path.join('sub', 'b.txt')]
+    assert not plan.errors
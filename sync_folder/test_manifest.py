@@ -0,0 +1,108 @@
+import os
+
+import pytest
+
+from manifest import MANIFEST_NAME, Manifest, file_digest, is_manifest_path
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+@pytest.fixture
+def replica(tmp_path):
+    for root in ('src', 'dst'):
+        write(tmp_path / root / 'a.txt', b'a')
+        write(tmp_path / root / 'sub' / 'b.txt', b'bb')
+    return str(tmp_path / 'src'), str(tmp_path / 'dst')
+
+
+@pytest.fixture
+def manifest(replica):
+    manifest = Manifest(replica[1])
+    yield manifest
+    manifest.conn.close()
+
+
+def paths(replica, rel_path):
+    return os.path.join(replica[0], rel_path), os.path.join(replica[1], rel_path)
+
+
+def test_recorded_file_needs_no_copy(replica, manifest):
+    source, target = paths(replica, 'a.txt')
+    manifest.record_copy('a.txt', source, target)
+    assert manifest.is_unchanged('a.txt', os.stat(source), os.stat(target))
+    assert not manifest.needs_copy('a.txt', source, target)
+
+
+# Unknown or touched files are compared once, and their stat is recorded so the next pass trusts it
+def test_touched_file_is_compared_once(replica, manifest):
+    source, target = paths(replica, 'a.txt')
+    os.utime(source, ns=(1_000_000_000, 1_000_000_000))
+    assert not manifest.needs_copy('a.txt', source, target)
+    assert manifest.is_unchanged('a.txt', os.stat(source), os.stat(target))
+
+
+def test_changed_or_missing_file_needs_copy(replica, manifest):
+    source, target = paths(replica, 'a.txt')
+    manifest.record_copy('a.txt', source, target)
+    write(source, b'b')
+    assert manifest.needs_copy('a.txt', source, target)
+    write(source, b'longer')
+    assert manifest.needs_copy('a.txt', source, target)
+    os.remove(target)
+    assert manifest.needs_copy('a.txt', source, target)
+
+
+# With hashes a touched source is hashed instead of compared with its replica
+def test_hash_mode(replica):
+    manifest = Manifest(replica[1], use_hash=True)
+    try:
+        source, target = paths(replica, 'a.txt')
+        manifest.record_copy('a.txt', source, target)
+        assert manifest.lookup('a.txt')[7] == file_digest(target)
+        os.utime(source, ns=(1_000_000_000, 1_000_000_000))
+        assert not manifest.needs_copy('a.txt', source, target)
+        write(source, b'b')
+        assert manifest.needs_copy('a.txt', source, target)
+    finally:
+        manifest.conn.close()
+
+
+def test_state_survives_reopening(replica, manifest):
+    source, target = paths(replica, os.path.join('sub', 'b.txt'))
+    manifest.record_copy(os.path.join('sub', 'b.txt'), source, target)
+    manifest.commit()
+
+    reopened = Manifest(replica[1], read_only=True)
+    try:
+        assert reopened.is_unchanged(os.path.join('sub', 'b.txt'), os.stat(source), os.stat(target))
+    finally:
+        reopened.conn.close()
+
+
+# A read-only manifest of a replica without one stays empty and writes nothing
+def test_read_only_manifest_of_new_replica(tmp_path):
+    manifest = Manifest(str(tmp_path), read_only=True)
+    try:
+        manifest.record('a.txt', os.stat(tmp_path), os.stat(tmp_path))
+        assert manifest.lookup('a.txt') is None
+    finally:
+        manifest.conn.close()
+    assert not os.path.exists(tmp_path / MANIFEST_NAME)
+
+
+def test_forget_removes_everything_below(replica, manifest):
+    for rel_path in ('a.txt', os.path.join('sub', 'b.txt')):
+        manifest.record_copy(rel_path, *paths(replica, rel_path))
+    assert [entry[0] for entry in manifest.entries('sub')] == [os.path.join('sub', 'b.txt')]
+    manifest.forget('sub')
+    assert manifest.entries('sub') == []
+    assert manifest.lookup('a.txt') is not None
+
+
+def test_manifest_path(replica):
+    assert is_manifest_path(replica[1], os.path.join(replica[1], MANIFEST_NAME + '-journal'))
+    assert not is_manifest_path(replica[1], os.path.join(replica[1], 'sub', MANIFEST_NAME))
@@ -0,0 +1,105 @@
+import os
+
+import pytest
+
+from copy_engine import CopyEngine
+from manifest import MANIFEST_NAME, Manifest
+from planner import plan_sync
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    write(src / 'a.txt', b'a')
+    write(src / 'sub' / 'b.txt', b'bb')
+    write(src / 'sub' / 'deeper' / 'c.txt', b'ccc')
+    dst.mkdir()
+    return str(src), str(dst)
+
+
+@pytest.fixture
+def manifest(dirs):
+    manifest = Manifest(dirs[1])
+    yield manifest
+    manifest.conn.close()
+
+
+def sync(src, dst, manifest):
+    stats = CopyEngine(workers=2).sync(src, dst, plan_sync(src, dst, manifest), manifest)
+    manifest.commit()
+    assert not stats.errors
+    return stats
+
+
+def copied(plan):
+    return sorted(rel_path for rel_path, src_st, dst_st in plan.copies)
+
+
+def test_first_plan_copies_everything(dirs, manifest):
+    plan = plan_sync(*dirs, manifest)
+    assert plan.mkdirs == ['sub', os.path.join('sub', 'deeper')]
+    assert copied(plan) == ['a.txt', os.path.join('sub', 'b.txt'), os.path.join('sub', 'deeper', 'c.txt')]
+    assert all(dst_st is None for rel_path, src_st, dst_st in plan.copies)
+    assert plan.bytes_to_copy == 6
+
+
+def test_synced_tree_is_unchanged(dirs, manifest):
+    sync(*dirs, manifest)
+    plan = plan_sync(*dirs, manifest)
+    assert (plan.mkdirs, plan.copies, plan.deletes, plan.unchanged) == ([], [], [], 3)
+
+
+def test_changed_and_extraneous_files(dirs, manifest):
+    src, dst = dirs
+    sync(src, dst, manifest)
+    write(os.path.join(src, 'a.txt'), b'a changed')
+    write(os.path.join(dst, 'extra.txt'), b'x')
+
+    plan = plan_sync(src, dst, manifest)
+    assert copied(plan) == ['a.txt']
+    assert plan.deletes == []
+    plan = plan_sync(src, dst, manifest, delete=True)
+    assert plan.deletes == [('extra.txt', False)]
+    assert not any(rel_path.startswith(MANIFEST_NAME) for rel_path, is_dir in plan.deletes)
+
+
+# A directory replaced by a file has to make room before the file is copied
+def test_type_change(dirs, manifest):
+    src, dst = dirs
+    sync(src, dst, manifest)
+    os.remove(os.path.join(src, 'sub', 'deeper', 'c.txt'))
+    os.rmdir(os.path.join(src, 'sub', 'deeper'))
+    write(os.path.join(src, 'sub', 'deeper'), b'now a file')
+
+    plan = plan_sync(src, dst, manifest)
+    assert plan.deletes == [(os.path.join('sub', 'deeper'), True)]
+    assert copied(plan) == [os.path.join('sub', 'deeper')]
+
+
+# The watcher's changed paths limit the plan to those paths and what is below them
+def test_plan_changes_only(dirs, manifest):
+    src, dst = dirs
+    sync(src, dst, manifest)
+    write(os.path.join(src, 'a.txt'), b'a changed')
+    write(os.path.join(src, 'sub', 'b.txt'), b'b changed')
+
+    plan = plan_sync(src, dst, manifest, changes=[os.path.join('sub', 'b.txt')])
+    assert copied(plan) == [os.path.join('sub', 'b.txt')]
+
+
+# A directory that is gone from the source is deleted as a whole, nothing below it is visited
+def test_deleted_directory(dirs, manifest):
+    src, dst = dirs
+    sync(src, dst, manifest)
+    os.remove(os.path.join(src, 'sub', 'deeper', 'c.txt'))
+    os.rmdir(os.path.join(src, 'sub', 'deeper'))
+
+    plan = plan_sync(src, dst, manifest, delete=True)
+    assert plan.deletes == [(os.path.join('sub', 'deeper'), True)]
+    assert plan.copies == [] and plan.unchanged == 2
@@ -0,0 +1,101 @@
+import os
+import random
+import threading
+
+import pytest
+
+from protocol import FileRejected, Sender
+from receiver import SyncReceiver
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+# A receiver on a free local port, running in the background for one test
+@pytest.fixture
+def receiver(tmp_path):
+    server = SyncReceiver(tmp_path / 'replica', host='127.0.0.1', port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'source'
+    path.mkdir()
+    return path
+
+
+def test_send_file(receiver, source):
+    data = random.Random(0).randbytes(3 * 1024 * 1024 + 17)
+    write(source / 'file.bin', data)
+    os.utime(source / 'file.bin', ns=(1_600_000_000_000_000_000,) * 2)
+
+    with Sender('127.0.0.1', receiver.port) as sender:
+        assert sender.send_file(str(source / 'file.bin'), os.path.join('sub', 'file.bin')) == len(data)
+
+    replica = os.path.join(receiver.root, 'sub', 'file.bin')
+    assert read(replica) == data
+    assert os.stat(replica).st_mtime_ns == 1_600_000_000_000_000_000
+
+
+# Files are sent back to back and acknowledged afterwards, in the order they were started
+def test_pipelined_files(receiver, source):
+    names = [f'file{i}.txt' for i in range(5)]
+    for i, name in enumerate(names):
+        write(source / name, f'content {i}\n'.encode() * (i + 1))
+
+    with Sender('127.0.0.1', receiver.port) as sender:
+        sent = [sender.start_file(str(source / name), name) for name in names]
+        for name in names:
+            sender.read_ack()
+
+    assert sent == [os.path.getsize(source / name) for name in names]
+    for name in names:
+        assert read(os.path.join(receiver.root, name)) == read(source / name)
+
+
+# A rejected file leaves the connection in step for the next one
+def test_rejected_file_keeps_the_connection(receiver, source):
+    write(source / 'good.txt', b'good')
+
+    with Sender('127.0.0.1', receiver.port) as sender:
+        with pytest.raises(FileRejected):
+            sender.send_file(str(source / 'good.txt'), os.path.join('..', 'escape.txt'))
+        with pytest.raises(FileRejected):
+            sender.send_file(str(source / 'missing.txt'), 'missing.txt')
+        assert sender.connected
+        sender.send_file(str(source / 'good.txt'), 'good.txt')
+
+    assert read(os.path.join(receiver.root, 'good.txt')) == b'good'
+    assert not os.path.exists(os.path.join(os.path.dirname(receiver.root), 'escape.txt'))
+
+
+# Only the changed blocks go over the wire when the receiver already has an older copy
+def test_delta_transfer(receiver, source):
+    old = random.Random(1).randbytes(1024 * 1024)
+    new = old[:300000] + b'changed' + old[300000:]
+    os.makedirs(receiver.root, exist_ok=True)
+    write(os.path.join(receiver.root, 'big.bin'), old)
+    write(source / 'big.bin', new)
+
+    with Sender('127.0.0.1', receiver.port, delta=True, delta_min_size=0) as sender:
+        sent = sender.send_file(str(source / 'big.bin'), 'big.bin')
+        # Without a replica at the receiver the file is sent in full
+        write(source / 'new.bin', old[:200000])
+        assert sender.send_file(str(source / 'new.bin'), 'new.bin') == 200000
+
+    assert read(os.path.join(receiver.root, 'big.bin')) == new
+    assert read(os.path.join(receiver.root, 'new.bin')) == old[:200000]
+    assert sent < 2 * 64 * 1024
@@ -0,0 +1,182 @@
+import os
+import threading
+
+import pytest
+
+import delta
+import resumable
+from copy_engine import CopyEngine
+from manifest import Manifest, file_digest
+from planner import plan_sync
+from protocol import Sender
+from receiver import SyncReceiver, resume_path
+from resumable import copy_file, partial_path
+
+MB = 1024 * 1024
+
+real_copy_chunk = resumable._copy_chunk
+
+
+# Raised instead of the process being killed in the middle of a copy
+class Interrupted(Exception):
+    pass
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    write(src / 'big.bin', os.urandom(5 * MB + 123))
+    dst.mkdir()
+    return str(src), str(dst)
+
+
+@pytest.fixture
+def manifest(dirs):
+    manifest = Manifest(dirs[1])
+    yield manifest
+    manifest.conn.close()
+
+
+# Files from 1 MB on resume, with a checkpoint after every MB
+@pytest.fixture
+def small_checkpoints(monkeypatch):
+    monkeypatch.setattr(resumable, 'RESUME_MIN_SIZE', MB)
+    monkeypatch.setattr(resumable, 'CHECKPOINT_BYTES', MB)
+
+
+# Function to make the copy of a chunk fail once the copy reached stop_at bytes, records the offsets copied
+def interrupt_at(monkeypatch, stop_at, offsets):
+    def copy_chunk(src, dst, offset, count, view, digest):
+        if stop_at is not None and offset >= stop_at:
+            raise Interrupted
+        offsets.append(offset)
+        return real_copy_chunk(src, dst, offset, count, view, digest)
+
+    monkeypatch.setattr(resumable, '_copy_chunk', copy_chunk)
+
+
+@pytest.mark.parametrize('with_digest', [False, True])
+def test_interrupted_copy_resumes(dirs, manifest, small_checkpoints, monkeypatch, with_digest):
+    src, dst = dirs
+    source, replica = os.path.join(src, 'big.bin'), os.path.join(dst, 'big.bin')
+    src_st = os.stat(source)
+
+    offsets = []
+    interrupt_at(monkeypatch, 3 * MB, offsets)
+    with pytest.raises(Interrupted):
+        copy_file(source, replica, 'big.bin', src_st, manifest, with_digest=with_digest)
+    assert not os.path.exists(replica)
+    checkpoint = manifest.partial_offset('big.bin', src_st)
+    assert checkpoint == 3 * MB
+    assert os.path.getsize(partial_path(replica)) >= checkpoint
+
+    offsets.clear()
+    interrupt_at(monkeypatch, None, offsets)
+    digest = copy_file(source, replica, 'big.bin', src_st, manifest, with_digest=with_digest)
+    assert offsets[0] == checkpoint
+    assert read(replica) == read(source)
+    assert digest == (file_digest(source) if with_digest else None)
+    assert not os.path.exists(partial_path(replica))
+    assert manifest.partial_offset('big.bin', src_st) == 0
+
+
+# A partial record of another version of the source is not continued
+def test_changed_source_starts_over(dirs, manifest, small_checkpoints, monkeypatch):
+    src, dst = dirs
+    source, replica = os.path.join(src, 'big.bin'), os.path.join(dst, 'big.bin')
+    offsets = []
+    interrupt_at(monkeypatch, 2 * MB, offsets)
+    with pytest.raises(Interrupted):
+        copy_file(source, replica, 'big.bin', os.stat(source), manifest)
+
+    write(source, os.urandom(4 * MB))
+    offsets.clear()
+    interrupt_at(monkeypatch, None, offsets)
+    copy_file(source, replica, 'big.bin', os.stat(source), manifest)
+    assert offsets[0] == 0
+    assert read(replica) == read(source)
+
+
+# An unfinished replica stays in the destination for the next pass, unless its source is gone
+def test_planner_keeps_partial_files(dirs, manifest):
+    src, dst = dirs
+    write(partial_path(os.path.join(dst, 'big.bin')), b'partial')
+    write(partial_path(os.path.join(dst, 'gone.bin')), b'partial')
+    plan = plan_sync(src, dst, manifest, delete=True)
+    assert plan.deletes == [(os.path.basename(partial_path('gone.bin')), False)]
+    assert [rel_path for rel_path, src_st, dst_st in plan.copies] == ['big.bin']
+
+
+# A replica being patched in place by a delta copy is compared again after a crash in the middle of the patch
+def test_interrupted_in_place_patch(dirs, manifest, monkeypatch):
+    src, dst = dirs
+    engine = CopyEngine(delta=True, delta_min_size=MB)
+    engine.sync(src, dst, plan_sync(src, dst, manifest), manifest)
+    manifest.commit()
+
+    data = bytearray(read(os.path.join(src, 'big.bin')))
+    data[100:200] = b'x' * 100
+    data[4 * MB:4 * MB + 100] = b'y' * 100
+    write(os.path.join(src, 'big.bin'), bytes(data))
+
+    real_copy_range = delta._copy_range
+    calls = []
+
+    def crash_in_patch(src_file, dst_file, length, digest=None):
+        calls.append(length)
+        if len(calls) == 2:
+            raise OSError("power lost")
+        return real_copy_range(src_file, dst_file, length, digest)
+
+    monkeypatch.setattr(delta, '_copy_range', crash_in_patch)
+    stats = engine.sync(src, dst, plan_sync(src, dst, manifest), manifest)
+    assert len(stats.errors) == 1
+    # The replica is half patched, its entry is gone and the partial record was committed before the patch
+    assert read(os.path.join(dst, 'big.bin')) != bytes(data)
+    manifest.conn.close()
+    reopened = Manifest(dst)
+    try:
+        assert reopened.lookup('big.bin') is None
+        assert reopened.partial_offset('big.bin', os.stat(os.path.join(src, 'big.bin'))) == 0
+        assert reopened.conn.execute('SELECT COUNT(*) FROM partial').fetchone()[0] == 1
+
+        monkeypatch.setattr(delta, '_copy_range', real_copy_range)
+        stats = engine.sync(src, dst, plan_sync(src, dst, reopened), reopened)
+        assert not stats.errors and stats.files_copied == 1
+        assert read(os.path.join(dst, 'big.bin')) == bytes(data)
+        assert reopened.conn.execute('SELECT COUNT(*) FROM partial').fetchone()[0] == 0
+    finally:
+        reopened.conn.close()
+
+
+# The receiver keeps what arrived of a large file and asks the sender for the rest only
+def test_network_transfer_resumes(tmp_path):
+    server = SyncReceiver(tmp_path / 'replica', host='127.0.0.1', port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        data = os.urandom(3 * MB)
+        write(tmp_path / 'big.bin', data)
+        st = os.stat(tmp_path / 'big.bin')
+        target = os.path.join(server.root, 'big.bin')
+        write(resume_path(target, {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}), data[:MB + 7])
+
+        with Sender('127.0.0.1', server.port, resume_min_size=MB) as sender:
+            assert sender.send_file(str(tmp_path / 'big.bin'), 'big.bin') == len(data) - MB - 7
+        assert read(target) == data
+        assert os.listdir(server.root) == ['big.bin']
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
@@ -0,0 +1,95 @@
+import json
+import os
+import time
+
+import pytest
+
+import run_log
+from run_log import RunLog, open_run_log
+
+
+def records(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+# A log that is only flushed when the test says so
+@pytest.fixture
+def make_log(tmp_path):
+    logs = []
+
+    def make(**options):
+        log = RunLog(str(tmp_path / 'sync_log.jsonl'), flush_interval=3600, **options)
+        logs.append(log)
+        return log
+
+    yield make
+    for log in logs:
+        log.close()
+
+
+def test_records_are_buffered(tmp_path, make_log):
+    log = make_log()
+    log.write('sync_started', src='a', files=3)
+    assert not os.path.exists(log.path)
+    log.flush()
+    [record] = records(log.path)
+    assert (record['event'], record['src'], record['files']) == ('sync_started', 'a', 3)
+    log.write('sync_finished')
+    log.close()
+    assert [record['event'] for record in records(log.path)] == ['sync_started', 'sync_finished']
+
+
+def test_rotation_by_size(tmp_path, make_log):
+    log = make_log(max_bytes=200, backup_count=2)
+    for i in range(4):
+        log.write('file_copied', path='x' * 150, number=i)
+        log.flush()
+    log.close()
+    assert [record['number'] for record in records(log.path)] == [3]
+    assert [record['number'] for record in records(log.path + '.1')] == [2]
+    assert [record['number'] for record in records(log.path + '.2')] == [1]
+    assert not os.path.exists(log.path + '.3')
+
+
+def test_rotation_by_age(tmp_path, make_log, monkeypatch):
+    now = time.time()
+    monkeypatch.setattr(run_log.time, 'time', lambda: now)
+    log = make_log(max_age=60)
+    log.write('first')
+    log.flush()
+    now += 30
+    log.write('second')
+    log.flush()
+    assert not os.path.exists(log.path + '.1')
+    now += 31
+    log.write('third')
+    log.flush()
+    log.close()
+    assert [record['event'] for record in records(log.path + '.1')] == ['first', 'second']
+    assert [record['event'] for record in records(log.path)] == ['third']
+
+
+# A log left by an earlier run is rotated on opening when its first record is too old
+def test_old_log_is_rotated_on_open(tmp_path, make_log, monkeypatch):
+    log = make_log(max_age=60)
+    log.write('earlier run')
+    log.close()
+
+    later = time.time() + 120
+    monkeypatch.setattr(run_log.time, 'time', lambda: later)
+    log = make_log(max_age=60)
+    log.write('this run')
+    log.flush()
+    assert [record['event'] for record in records(log.path + '.1')] == ['earlier run']
+    assert [record['event'] for record in records(log.path)] == ['this run']
+
+
+def test_open_run_log_is_shared(tmp_path):
+    path = str(tmp_path / 'shared.jsonl')
+    log = open_run_log(path)
+    try:
+        assert open_run_log(os.path.join(str(tmp_path), '.', 'shared.jsonl')) is log
+    finally:
+        log.close()
+        run_log._run_logs.pop(os.path.abspath(path))
@@ -0,0 +1,127 @@
+import os
+import socket
+import threading
+
+import pytest
+
+import sender_pool
+from protocol import Sender
+from receiver import SyncReceiver
+from sender_pool import BACKOFF_BASE, SenderPool
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def receiver(tmp_path):
+    server = SyncReceiver(tmp_path / 'replica', host='127.0.0.1', port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+@pytest.fixture
+def files(tmp_path):
+    source = tmp_path / 'source'
+    source.mkdir()
+    names = [f'file{i}.txt' for i in range(20)]
+    for i, name in enumerate(names):
+        write(source / name, f'content {i}\n'.encode() * (i * 100 + 1))
+    return [(str(source / name), name) for name in names]
+
+
+# The backoff sleeps are recorded instead of slept, with the jitter at its top
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(sender_pool.time, 'sleep', delays.append)
+    monkeypatch.setattr(sender_pool.random, 'uniform', lambda low, high: high)
+    return delays
+
+
+def test_pool_sends_everything(receiver, files):
+    with SenderPool('127.0.0.1', receiver.port, connections=3, pipeline_depth=4, max_in_flight_bytes=4096) as pool:
+        for source_path, rel_path in files:
+            pool.submit(source_path, rel_path)
+    assert (pool.stats.files_sent, pool.stats.retries, pool.stats.errors) == (len(files), 0, [])
+    assert pool.in_flight_bytes == 0
+    for source_path, rel_path in files:
+        assert read(os.path.join(receiver.root, rel_path)) == read(source_path)
+
+
+# Files on a connection that broke are sent again on a new one, after a pause that grows while it keeps failing
+def test_broken_connection_is_retried(receiver, files, sleeps, monkeypatch):
+    real_start = Sender.start_file
+    failures = iter([True, True, True])
+
+    def flaky_start(sender, source_path, rel_path):
+        if rel_path == 'file5.txt' and next(failures, False):
+            raise ConnectionResetError("connection reset")
+        return real_start(sender, source_path, rel_path)
+
+    monkeypatch.setattr(Sender, 'start_file', flaky_start)
+    with SenderPool('127.0.0.1', receiver.port, connections=1, pipeline_depth=1, retries=5) as pool:
+        for source_path, rel_path in files:
+            pool.submit(source_path, rel_path)
+
+    assert (pool.stats.files_sent, pool.stats.errors) == (len(files), [])
+    assert pool.stats.retries >= 3
+    assert sleeps == [BACKOFF_BASE, BACKOFF_BASE * 2, BACKOFF_BASE * 4]
+    assert read(os.path.join(receiver.root, 'file5.txt')) == read(files[5][0])
+    assert pool.in_flight_bytes == 0
+
+
+# Unexpected errors are handled like a broken connection instead of stopping the worker
+def test_unexpected_error_is_retried(receiver, files, sleeps, monkeypatch):
+    real_ack = Sender.read_ack
+    failures = iter([True])
+
+    def flaky_ack(sender):
+        real_ack(sender)
+        if next(failures, False):
+            raise ValueError("garbled acknowledgement")
+
+    monkeypatch.setattr(Sender, 'read_ack', flaky_ack)
+    with SenderPool('127.0.0.1', receiver.port, connections=1) as pool:
+        for source_path, rel_path in files[:5]:
+            pool.submit(source_path, rel_path)
+    assert (pool.stats.files_sent, pool.stats.errors) == (5, [])
+    assert pool.stats.retries >= 1
+    assert pool.in_flight_bytes == 0
+
+
+def test_unreachable_receiver_gives_up(files, sleeps):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+
+    with SenderPool('127.0.0.1', port, connections=1, retries=2) as pool:
+        for source_path, rel_path in files[:3]:
+            pool.submit(source_path, rel_path)
+    assert pool.stats.files_sent == 0
+    assert sorted(os.path.basename(path) for path, error in pool.stats.errors) == \
+        ['file0.txt', 'file1.txt', 'file2.txt']
+    assert all(isinstance(error, OSError) for path, error in pool.stats.errors)
+    assert pool.in_flight_bytes == 0
+    assert max(sleeps) <= sender_pool.BACKOFF_MAX
+
+
+# A file the receiver refused is an error of that file only, it is not sent again
+def test_rejected_file_is_not_retried(receiver, files):
+    with SenderPool('127.0.0.1', receiver.port, connections=2) as pool:
+        pool.submit(files[0][0], os.path.join('..', 'escape.txt'))
+        pool.submit(files[1][0], files[1][1])
+    assert pool.stats.files_sent == 1
+    assert pool.stats.retries == 0
+    assert len(pool.stats.errors) == 1
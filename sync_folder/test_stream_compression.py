@@ -0,0 +1,81 @@
+import io
+import os
+import random
+import threading
+
+import pytest
+
+from protocol import Sender
+from receiver import SyncReceiver
+from stream_compression import CODECS, choose_codec, offered_codecs, sample_entropy, worth_compressing
+
+
+def write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('name', sorted(CODECS))
+def test_codec_round_trip(name):
+    codec = CODECS[name]
+    data = b''.join(f'record {i}\n'.encode() for i in range(20000))
+    compressor = codec.compressor()
+    wire = b''.join(compressor.compress(data[i:i + 4096]) for i in range(0, len(data), 4096)) + compressor.flush()
+    assert len(wire) < len(data) // 4
+    assert codec.decompressor().decompress(wire) == data
+
+
+def test_codec_negotiation():
+    assert offered_codecs('auto')[-1] == 'zlib'
+    assert offered_codecs('zlib') == ['zlib']
+    with pytest.raises(ValueError):
+        offered_codecs('brotli')
+    assert choose_codec(['brotli', 'zlib']) == 'zlib'
+    assert choose_codec(['brotli']) is None
+
+
+# Already compressed or random content is sent as it is
+def test_worth_compressing():
+    text = b'hello world\n' * 10000
+    noise = random.Random(0).randbytes(100000)
+    assert sample_entropy(io.BytesIO(noise), len(noise)) > 7.9
+    assert worth_compressing('notes.txt', io.BytesIO(text), len(text))
+    assert not worth_compressing('noise.bin', io.BytesIO(noise), len(noise))
+    assert not worth_compressing('archive.ZIP', io.BytesIO(text), len(text))
+    assert not worth_compressing('tiny.txt', io.BytesIO(b'abc'), 3)
+
+
+@pytest.fixture
+def receiver(tmp_path):
+    server = SyncReceiver(tmp_path / 'replica', host='127.0.0.1', port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+    thread.join()
+
+
+def test_compressed_transfer(receiver, tmp_path):
+    names = [f'text{i}.txt' for i in range(5)] + ['noise.bin']
+    for i, name in enumerate(names[:-1]):
+        write(tmp_path / name, f'line {i}\n'.encode() * 50000)
+    write(tmp_path / 'noise.bin', random.Random(1).randbytes(200000))
+
+    with Sender('127.0.0.1', receiver.port, compression=['zlib']) as sender:
+        sent = [sender.start_file(str(tmp_path / name), name) for name in names]
+        for name in names:
+            sender.read_ack()
+        assert sender.codec.name == 'zlib'
+
+    stats = sender.compression_stats
+    assert (stats.files_compressed, stats.files_skipped) == (5, 1)
+    assert stats.ratio > 10
+    assert all(count < os.path.getsize(tmp_path / name) for count, name in zip(sent, names[:-1]))
+    for name in names:
+        assert read(os.path.join(receiver.root, name)) == read(tmp_path / name)
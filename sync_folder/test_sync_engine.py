@@ -0,0 +1,79 @@
+import os
+import threading
+
+import pytest
+
+from manifest import MANIFEST_NAME
+from receiver import SyncReceiver
+from sync_engine import SyncEngine
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def tree(root):
+    return sorted(os.path.relpath(os.path.join(dirpath, name), root)
+                  for dirpath, dirnames, filenames in os.walk(root) for name in filenames
+                  if not name.startswith(MANIFEST_NAME))
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    src, dst = tmp_path / 'src', tmp_path / 'dst'
+    write(src / 'a.txt', b'a')
+    write(src / 'sub' / 'b.txt', b'bb')
+    return str(src), str(dst)
+
+
+# An engine set up like the command line does it, logging into messages
+def engine(src, dst, messages, **options):
+    sync_engine = SyncEngine(src, dst, log=messages.append, log_file=None, progress=False, **options)
+    assert sync_engine.check_directories()
+    return sync_engine
+
+
+def test_sync_and_delete(dirs):
+    src, dst = dirs
+    messages = []
+    assert engine(src, dst, messages).sync()
+    assert tree(dst) == ['a.txt', os.path.join('sub', 'b.txt')]
+
+    write(os.path.join(dst, 'extra.txt'), b'x')
+    os.remove(os.path.join(src, 'a.txt'))
+    assert engine(src, dst, messages).sync()
+    assert 'extra.txt' in tree(dst)
+    assert engine(src, dst, messages, delete=True).sync()
+    assert tree(dst) == [os.path.join('sub', 'b.txt')]
+    assert messages[-1] == "Synchronization completed."
+
+
+def test_dry_run_writes_nothing(dirs):
+    src, dst = dirs
+    messages = []
+    assert engine(src, dst, messages, dry_run=True).sync()
+    assert tree(dst) == []
+    assert messages[-1] == "Dry run completed."
+
+
+# Copied files are also sent to a receiver, through the sender pool
+def test_sync_sends_copied_files(dirs, tmp_path):
+    src, dst = dirs
+    server = SyncReceiver(tmp_path / 'remote', host='127.0.0.1', port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        assert engine(src, dst, [], host='127.0.0.1', port=server.port).sync()
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+    assert tree(server.root) == ['a.txt', os.path.join('sub', 'b.txt')]
+    assert read(os.path.join(server.root, 'sub', 'b.txt')) == b'bb'
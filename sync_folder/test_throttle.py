@@ -0,0 +1,121 @@
+from datetime import datetime
+
+import pytest
+
+import throttle
+from throttle import ScheduleWindow, Throttle, TokenBucket, parse_rate
+
+# A Monday
+MONDAY = datetime(2024, 1, 1)
+
+
+def at(day, hour, minute=0):
+    return MONDAY.replace(day=MONDAY.day + day, hour=hour, minute=minute)
+
+
+@pytest.mark.parametrize('text, rate', [
+    ('500', 500),
+    ('500K', 500 * 1024),
+    ('10m', 10 * 1024 * 1024),
+    ('1.5G', 1.5 * 1024 ** 3),
+    ('2MiB/s', 2 * 1024 * 1024),
+    (' 4 kb ', 4 * 1024),
+    ('0', None),
+])
+def test_parse_rate(text, rate):
+    assert parse_rate(text) == rate
+
+
+@pytest.mark.parametrize('text', ['', 'fast', '10T', '-5M', '1.M'])
+def test_parse_rate_rejects(text):
+    with pytest.raises(ValueError):
+        parse_rate(text)
+
+
+def test_parse_window():
+    window = ScheduleWindow.parse('mon-fri 08:00-18:30=10M,200')
+    assert window.days == frozenset(range(5))
+    assert (window.start, window.end) == (8 * 60, 18 * 60 + 30)
+    assert (window.bytes_per_s, window.ops_per_s) == (10 * 1024 * 1024, 200)
+
+    window = ScheduleWindow.parse('sat,sun 00:00-24:00=0')
+    assert window.days == frozenset({5, 6})
+    assert (window.bytes_per_s, window.ops_per_s) == (None, None)
+
+    assert ScheduleWindow.parse('fri-mon 09:00-10:00=1M').days == frozenset({4, 5, 6, 0})
+
+
+@pytest.mark.parametrize('text', [
+    '08:00-18:00',
+    'mon-fry 08:00-18:00=1M',
+    '25:00-26:00=1M',
+    '08:75-09:00=1M',
+    '08:00-09:60=1M',
+    '24:30-01:00=1M',
+])
+def test_parse_window_rejects(text):
+    with pytest.raises(ValueError):
+        ScheduleWindow.parse(text)
+
+
+def test_window_contains():
+    window = ScheduleWindow.parse('mon-fri 08:00-18:00=1M')
+    assert window.contains(at(0, 8))
+    assert window.contains(at(4, 17, 59))
+    assert not window.contains(at(0, 18))
+    assert not window.contains(at(0, 7, 59))
+    assert not window.contains(at(5, 12))
+
+
+# The part of a window after midnight belongs to the day it started on
+def test_window_over_midnight():
+    window = ScheduleWindow.parse('fri 22:00-06:00=1M')
+    assert window.contains(at(4, 23))
+    assert window.contains(at(5, 5, 59))
+    assert not window.contains(at(5, 6))
+    assert not window.contains(at(5, 23))
+    assert not window.contains(at(4, 5))
+
+
+def test_bucket_debt():
+    bucket = TokenBucket(1000)
+    assert bucket.delay() == 0
+    bucket.take(1000)
+    bucket.take(2000)
+    assert bucket.delay() == pytest.approx(2.0, abs=0.05)
+
+    unlimited = TokenBucket()
+    unlimited.take(10 ** 9)
+    assert unlimited.delay() == 0
+
+
+# Debt run up at one rate is not carried over to another
+def test_bucket_rate_change_drops_debt():
+    bucket = TokenBucket(1000)
+    bucket.take(100000)
+    bucket.set_rate(10)
+    assert bucket.delay() == 0
+    assert bucket.tokens <= bucket.capacity == 10
+
+
+def test_throttle_limits(monkeypatch):
+    class Clock(datetime):
+        now_value = at(0, 9)
+
+        @classmethod
+        def now(cls, tz=None):
+            return cls.now_value
+
+    monkeypatch.setattr(throttle, 'datetime', Clock)
+    limits = Throttle(bytes_per_s=100, schedule=[ScheduleWindow.parse('mon 08:00-10:00=50,5')])
+    assert limits.enabled
+    assert limits.current_limits() == (50, 5)
+    Clock.now_value = at(0, 11)
+    assert limits.current_limits() == (100, None)
+
+    limits.set_override(bytes_per_s=7)
+    assert limits.current_limits() == (7, None)
+    assert limits.bytes.rate == 7
+    limits.set_override()
+    assert limits.current_limits() == (100, None)
+    assert not Throttle().enabled
@@ -0,0 +1,88 @@
+import errno
+import os
+import time
+
+import pytest
+
+from watcher import FULL_SYNC, ChangeWatcher, coalesce, watch_available
+
+needs_inotify = pytest.mark.skipif(not watch_available(), reason="inotify is not available")
+
+
+def test_coalesce():
+    assert coalesce([]) == []
+    assert coalesce(['b', 'a', os.path.join('a', 'x'), os.path.join('a', 'y', 'z'), 'ab']) == ['a', 'ab', 'b']
+    siblings = [os.path.join('a', 'b'), os.path.join('a', 'c')]
+    assert coalesce(reversed(siblings)) == siblings
+    assert coalesce([os.path.join('a', 'b'), '', 'c']) == ['']
+
+
+@pytest.fixture
+def watcher(tmp_path):
+    (tmp_path / 'sub').mkdir()
+    watcher = ChangeWatcher(str(tmp_path), debounce=0.1, max_delay=1.0)
+    watcher.start()
+    yield watcher
+    watcher.stop()
+    watcher.join()
+
+
+# Function to wait for the watcher to hand out the next settled changes
+def wait_for_changes(watcher, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        changes = watcher.take_changes()
+        if changes != []:
+            return changes
+        time.sleep(0.02)
+    raise AssertionError("No changes were reported")
+
+
+@needs_inotify
+def test_changes_are_coalesced(tmp_path, watcher):
+    (tmp_path / 'a.txt').write_text('a')
+    (tmp_path / 'sub' / 'b.txt').write_text('b')
+    (tmp_path / 'sub' / 'b.txt').write_text('b again')
+    assert wait_for_changes(watcher) == ['a.txt', os.path.join('sub', 'b.txt')]
+    assert watcher.take_changes() == []
+
+    # A new directory is reported once, what is written into it afterwards is watched too
+    (tmp_path / 'new').mkdir()
+    (tmp_path / 'new' / 'c.txt').write_text('c')
+    assert wait_for_changes(watcher) == ['new']
+    (tmp_path / 'new' / 'c.txt').write_text('changed')
+    assert wait_for_changes(watcher) == [os.path.join('new', 'c.txt')]
+
+
+# Changes are held back while the tree keeps changing, but no longer than max_delay
+@needs_inotify
+def test_debounce(tmp_path, watcher):
+    (tmp_path / 'a.txt').write_text('a')
+    time.sleep(0.02)
+    assert watcher.take_changes() == []
+    assert wait_for_changes(watcher) == ['a.txt']
+
+    started = time.monotonic()
+    while time.monotonic() - started < 2.0:
+        (tmp_path / 'busy.txt').write_text(str(time.monotonic()))
+        changes = watcher.take_changes()
+        if changes:
+            break
+        time.sleep(0.05)
+    assert changes == ['busy.txt']
+    assert 0.9 <= time.monotonic() - started < 2.0
+
+
+# Running out of watches stops the thread, the owner gets a full sync and the reason
+@needs_inotify
+def test_watch_failure_asks_for_a_full_sync(tmp_path, monkeypatch):
+    def no_watches_left(timeout):
+        raise OSError(errno.ENOSPC, "Too many inotify watches")
+
+    failing = ChangeWatcher(str(tmp_path), debounce=0.0)
+    monkeypatch.setattr(failing.tree, 'read_events', no_watches_left)
+    failing.start()
+    failing.join(5.0)
+    assert not failing.is_alive()
+    assert failing.error.errno == errno.ENOSPC
+    assert failing.take_changes() is FULL_SYNC
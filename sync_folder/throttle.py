@@ -0,0 +1,203 @@
+import re
+import threading
+import time
+from datetime import datetime
+
+# A bucket holds up to this many seconds worth of its rate, which is how far a burst may run ahead
+BURST_SECONDS = 1.0
+
+# A waiting thread looks at the rate again at least this often, so live changes and schedules apply quickly
+MAX_SLEEP = 0.5
+
+# Seconds between checks of the schedule
+SCHEDULE_CHECK_INTERVAL = 1.0
+
+DAY_NAMES = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+UNITS = {'': 1, 'k': 1024, 'm': 1024 * 1024, 'g': 1024 * 1024 * 1024}
+
+
+# Function to parse a rate like 500K, 10M or 1.5G (bytes per second, powers of 1024), 0 or '' mean no limit
+def parse_rate(text):
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([kmg]?)(?:i?b)?(?:/s)?\s*', str(text).lower())
+    if match is None:
+        raise ValueError(f"Invalid rate '{text}', expected a number with an optional K, M or G suffix")
+    rate = float(match.group(1)) * UNITS[match.group(2)]
+    return rate or None
+
+
+# Function to parse a list of days like mon-fri or sat,sun into weekday numbers (Monday is 0)
+def _parse_days(text):
+    days = set()
+    for part in text.lower().split(','):
+        first, _, last = part.partition('-')
+        if first not in DAY_NAMES or (last and last not in DAY_NAMES):
+            raise ValueError(f"Invalid days '{text}', expected names like mon-fri or sat,sun")
+        start = DAY_NAMES.index(first)
+        end = DAY_NAMES.index(last) if last else start
+        days.update(day % 7 for day in range(start, end + 1 if end >= start else end + 8))
+    return frozenset(days)
+
+
+# Limits that apply on some days between two times of day
+class ScheduleWindow:
+    def __init__(self, days, start, end, bytes_per_s, ops_per_s):
+        self.days = days
+        self.start = start
+        self.end = end
+        self.bytes_per_s = bytes_per_s
+        self.ops_per_s = ops_per_s
+
+    # Parse "[DAYS ]HH:MM-HH:MM=BYTES[,OPS]", for example "mon-fri 08:00-18:00=10M,200"
+    # A window that ends before it starts runs over midnight
+    @classmethod
+    def parse(cls, text):
+        match = re.fullmatch(r'\s*(?:([a-z,-]+)\s+)?(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})=([^,]*)(?:,(.*))?\s*',
+                             text.lower())
+        if match is None:
+            raise ValueError(f"Invalid schedule '{text}', expected something like 'mon-fri 08:00-18:00=10M,200'")
+        days, start_h, start_m, end_h, end_m, bytes_text, ops_text = match.groups()
+        start = int(start_h) * 60 + int(start_m)
+        end = int(end_h) * 60 + int(end_m)
+        if int(start_m) > 59 or int(end_m) > 59 or start > 24 * 60 or end > 24 * 60:
+            raise ValueError(f"Invalid time of day in schedule '{text}'")
+        return cls(_parse_days(days) if days else frozenset(range(7)), start, end,
+                   parse_rate(bytes_text), parse_rate(ops_text) if ops_text else None)
+
+    def contains(self, now):
+        minute = now.hour * 60 + now.minute
+        if self.start <= self.end:
+            return now.weekday() in self.days and self.start <= minute < self.end
+        # Over midnight: the part after midnight belongs to the day the window started
+        if minute >= self.start:
+            return now.weekday() in self.days
+        return minute < self.end and (now.weekday() - 1) % 7 in self.days
+
+
+# Token bucket shared by threads: taking more than is there runs into debt, which later takers wait out
+# A rate of None means no limit
+class TokenBucket:
+    def __init__(self, rate=None):
+        self.lock = threading.Lock()
+        self.rate = None
+        self.capacity = 0.0
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill()
+            if rate and not self.rate:
+                self.tokens = rate * BURST_SECONDS
+            # Debt run up at the old rate would take a different time to pay off at the new one, it is dropped
+            if (rate or None) != self.rate:
+                self.tokens = max(self.tokens, 0.0)
+            self.rate = rate or None
+            self.capacity = rate * BURST_SECONDS if rate else 0.0
+            self.tokens = min(self.tokens, self.capacity)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount):
+        with self.lock:
+            if self.rate:
+                self._refill()
+                self.tokens -= amount
+
+    # Seconds until the debt is paid off, 0 when tokens can be taken right away
+    def delay(self):
+        with self.lock:
+            if not self.rate:
+                return 0.0
+            self._refill()
+            return max(0.0, -self.tokens / self.rate)
+
+
+# Limits the bytes and the operations per second of a sync, shared by all of its threads
+# The limits come from, in this order: a live override (set_override), the first schedule window that applies
+# now, or the base limits; throttled_seconds counts the wall-clock time at least one thread was held back
+class Throttle:
+    def __init__(self, bytes_per_s=None, ops_per_s=None, schedule=None):
+        self.base = (bytes_per_s, ops_per_s)
+        self.schedule = list(schedule or [])
+        self.override = None
+        self.bytes = TokenBucket()
+        self.ops = TokenBucket()
+        self.lock = threading.Lock()
+        self.waiting = 0
+        self.wait_started = 0.0
+        self.waited = 0.0
+        self.checked = 0.0
+        self.limits = None
+        self._update(force=True)
+
+    @property
+    def enabled(self):
+        return any(self.base) or bool(self.schedule) or self.override is not None
+
+    # Change the limits while the sync is running, None for both goes back to the schedule and base limits
+    def set_override(self, bytes_per_s=None, ops_per_s=None):
+        self.override = None if bytes_per_s is None and ops_per_s is None else (bytes_per_s, ops_per_s)
+        self._update(force=True)
+
+    # The (bytes per second, operations per second) that apply now
+    def current_limits(self):
+        if self.override is not None:
+            return self.override
+        now = datetime.now()
+        for window in self.schedule:
+            if window.contains(now):
+                return window.bytes_per_s, window.ops_per_s
+        return self.base
+
+    def _update(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.checked < SCHEDULE_CHECK_INTERVAL:
+            return
+        self.checked = now
+        limits = self.current_limits()
+        if limits != self.limits:
+            self.limits = limits
+            self.bytes.set_rate(limits[0])
+            self.ops.set_rate(limits[1])
+
+    # Account for bytes read, written or sent, blocking while they exceed the rate
+    def consume(self, nbytes):
+        self._wait(self.bytes, nbytes)
+
+    # Account for one file operation (a copy, a directory, a delete), blocking while they exceed the rate
+    def operation(self):
+        self._wait(self.ops, 1)
+
+    def _wait(self, bucket, amount):
+        self._update()
+        bucket.take(amount)
+        delay = bucket.delay()
+        if not delay:
+            return
+        with self.lock:
+            if self.waiting == 0:
+                self.wait_started = time.monotonic()
+            self.waiting += 1
+        try:
+            while delay:
+                time.sleep(min(delay, MAX_SLEEP))
+                self._update()
+                delay = bucket.delay()
+        finally:
+            with self.lock:
+                self.waiting -= 1
+                if self.waiting == 0:
+                    self.waited += time.monotonic() - self.wait_started
+
+    # Seconds any thread spent waiting so far, including a wait that is still going on
+    @property
+    def throttled_seconds(self):
+        with self.lock:
+            if self.waiting:
+                return self.waited + time.monotonic() - self.wait_started
+            return self.waited
@@ -0,0 +1,209 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+# inotify flags and event masks from <sys/inotify.h>
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+              IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+# Changes are handed out once the tree was quiet for DEBOUNCE seconds, or at the latest after MAX_DELAY
+DEBOUNCE = 0.25
+MAX_DELAY = 2.0
+
+# Returned instead of a set of paths when events were lost and only a full sync is safe
+FULL_SYNC = None
+
+_libc = None
+
+
+# Function to load the inotify functions from libc, returns None where inotify does not exist
+def _load_libc():
+    global _libc
+    if _libc is None and sys.platform.startswith('linux'):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            libc.inotify_init1.argtypes = [ctypes.c_int]
+            libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+            libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+            _libc = libc
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc or None
+
+
+# Function to check if event-based watching is available on this system
+def watch_available():
+    return _load_libc() is not None
+
+
+# Function to drop paths that are inside another changed directory, syncing the parent covers them
+def coalesce(rel_paths):
+    result = []
+    # Sorting by components puts every directory right before its own descendants
+    for rel_path in sorted(rel_paths, key=lambda path: path.split(os.sep) if path else []):
+        if result and (result[-1] == '' or rel_path.startswith(result[-1] + os.sep)):
+            continue
+        result.append(rel_path)
+    return result
+
+
+# Recursive inotify watch on a directory tree
+class TreeWatcher:
+    def __init__(self, root):
+        libc = _load_libc()
+        if libc is None:
+            raise OSError(errno.ENOSYS, "inotify is not available on this system")
+        self.libc = libc
+        self.root = os.path.abspath(root)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}  # watch descriptor -> directory relative to root
+        self.add_tree('')
+
+    # Watch a directory and everything below it
+    def add_tree(self, rel_dir):
+        top = os.path.join(self.root, rel_dir) if rel_dir else self.root
+        for root, dirs, files in os.walk(top):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), WATCH_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC:
+                    raise OSError(err, "Too many inotify watches, raise fs.inotify.max_user_watches")
+                continue  # The directory vanished in the meantime
+            rel = os.path.relpath(root, self.root)
+            self.watches[wd] = '' if rel == '.' else rel
+
+    # Stop watching a directory that was moved away, its watches would report stale paths
+    def remove_tree(self, rel_dir):
+        prefix = rel_dir + os.sep
+        for wd, watched in list(self.watches.items()):
+            if watched == rel_dir or watched.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    # Wait up to timeout seconds for events, returns the changed relative paths or FULL_SYNC on overflow
+    def read_events(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+                offset += EVENT_HEADER.size + length
+                if mask & IN_Q_OVERFLOW:
+                    return FULL_SYNC
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                rel_dir = self.watches.get(wd)
+                if rel_dir is None:
+                    continue
+                rel_path = os.path.join(rel_dir, os.fsdecode(name)) if name else rel_dir
+                changed.add(rel_path)
+                # New directories need their own watches, and may already contain files
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(rel_path)
+                elif mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                    self.remove_tree(rel_path)
+        return changed
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+# Background thread that collects inotify events and hands them out debounced and coalesced
+class ChangeWatcher(threading.Thread):
+    def __init__(self, root, debounce=DEBOUNCE, max_delay=MAX_DELAY):
+        super().__init__(name="sync-watch", daemon=True)
+        self.tree = TreeWatcher(root)
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.changed = set()
+        self.overflow = False
+        self.first_event = None
+        self.last_event = None
+        # Set when watching had to stop, the tree is no longer fully watched (see run)
+        self.error = None
+        self.stopped = threading.Event()
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                changed = self.tree.read_events(0.5)
+                if changed == set():
+                    continue
+                with self.lock:
+                    now = time.monotonic()
+                    if changed is FULL_SYNC:
+                        self.overflow = True
+                    else:
+                        self.changed.update(changed)
+                    if self.first_event is None:
+                        self.first_event = now
+                    self.last_event = now
+        except OSError as e:
+            # Mostly ENOSPC, no watch left for a new directory: changes below it would go unnoticed, so the
+            # owner gets a full pass and, through error, the reason to stop relying on events
+            with self.lock:
+                now = time.monotonic()
+                self.error = e
+                self.overflow = True
+                if self.first_event is None:
+                    self.first_event = now
+                self.last_event = now
+        finally:
+            self.tree.close()
+
+    # Return the changes once they settled, FULL_SYNC after an overflow, or an empty list when there is nothing yet
+    def take_changes(self):
+        with self.lock:
+            if self.first_event is None:
+                return []
+            now = time.monotonic()
+            if now - self.last_event < self.debounce and now - self.first_event < self.max_delay:
+                return []
+            overflow, changed = self.overflow, self.changed
+            self.changed = set()
+            self.overflow = False
+            self.first_event = self.last_event = None
+        return FULL_SYNC if overflow else coalesce(changed)
+
+    def stop(self):
+        self.stopped.set()